@@ -1,12 +1,117 @@
 # pylint: disable=C0111
 #!/usr/bin/python
 from kickstart_salt_imports import *
+from kickstart_salt_download import (BootstrapSaltCache, BootstrapSaltDownloader,
+                                     BootstrapSaltVerifier)
+from kickstart_salt_phases import AdmissionControl, BootstrapReport, PhaseScheduler, PhaseState
+from kickstart_salt_process import LiveProcess
+from kickstart_salt_metadata import JSONFileMetadataProvider, MetadataProvider
+# The peer, bundle, keys, merge and stand-in modules are imported by the
+#  phases and CLI branches which use them.
 
 # Borrowed some code from
 #  https://github.com/facebook/IT-CPE/blob/master/chef/tools/chef_bootstrap.py
 
-class GCEMetadataWrapper:
+class UrllibMetadataSession:
+    '''
+    Stdlib stand-in for the parts of requests.Session that GCEMetadataWrapper
+    uses, with the same retry/backoff behaviour. Used in minimal mode, or
+    when requests isn't installed.
+    '''
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+    class Response:
+        def __init__(self, status_code, content, headers):
+            self.status_code = status_code
+            self.content = content
+            self.headers = headers
+
+    def __init__(self, retries=3, backoff_factor=0.2):
+        self.headers = {}
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    def get(self, url, params=None, timeout=None):
+        if params:
+            url += ('&' if '?' in url else '?') + urllib_parse.urlencode(params)
+        attempt = 0
+        while True:
+            try:
+                response = urllib.urlopen(urllib.Request(url, headers=self.headers),
+                                          timeout=timeout)
+                return self.Response(response.status, response.read(), response.headers)
+            except urllib.HTTPError as err:
+                if err.code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    return self.Response(err.code, err.read(), err.headers)
+            except (OSError, http.client.HTTPException):
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff_factor * 2 ** attempt)
+            attempt += 1
+
+class GCEMetadataWrapper(MetadataProvider):
     '''Wrapper class for retrieving Instance & Project Metadata'''
+    METADATA_URL = "http://metadata.google.internal/computeMetadata/v1"
+
+    # pylint: disable=R0913
+    def __init__(self,
+                 metadata_url=None,
+                 timeout=5,
+                 retries=3,
+                 backoff_factor=0.2,
+                 max_workers=8,
+                 snapshot=False,
+                 minimal=False):
+        '''
+        Sets up a keep-alive session, shared by every metadata request, which
+        retries with exponential backoff on connection errors and 5xx/429
+        responses. Values are cached by url for the life of the wrapper.
+
+        With snapshot=True the whole instance and project trees are fetched
+        once, in two recursive requests, and every lookup is served from an
+        in-memory index of those trees.
+
+        requests is only imported here, and not at all with minimal=True (or
+        if it isn't installed), in which case urllib is used instead.
+        '''
+        self.metadata_url = (metadata_url or self.METADATA_URL).rstrip('/')
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.cache = {}
+        self.snapshot = snapshot
+        self.index = None
+
+        requests = None
+        if not minimal:
+            try:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+            except ImportError:
+                requests = None
+
+        if requests is None:
+            self.session = UrllibMetadataSession(retries=retries,
+                                                 backoff_factor=backoff_factor)
+            self.connection_errors = (OSError, http.client.HTTPException)
+            self.request_errors = self.connection_errors
+        else:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max_workers,
+                max_retries=Retry(total=retries,
+                                  backoff_factor=backoff_factor,
+                                  status_forcelist=[429, 500, 502, 503, 504],
+                                  raise_on_status=False)
+            )
+            self.session = requests.Session()
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self.connection_errors = (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout)
+            self.request_errors = (requests.exceptions.RequestException,)
+        self.session.headers.update({"Metadata-Flavor":"Google"})
+
     @staticmethod
     def return_request(request):
         '''Returns Get request if status code is 200; others returns None'''
@@ -16,44 +121,101 @@ class GCEMetadataWrapper:
 
     def get_metadata_value(self, url):
         '''Executes Get request against GCP Metadata server with proper headers'''
+        if url in self.cache:
+            return self.cache[url]
         try:
-            request = requests.get(url, headers={"Metadata-Flavor":"Google"})
-        except requests.exceptions.ConnectionError as err:
+            request = self.session.get(url, timeout=self.timeout)
+        except self.connection_errors as err:
             print(err, end="\n\n")
             print("This is likely not a GCE server.")
             exit(1)
-        return self.return_request(request)
+        self.cache[url] = self.return_request(request)
+        return self.cache[url]
 
-    def get_instance_metadata_value(self, key):
-        '''Helper method for retrieving Instance Metadata values'''
-        url = "http://metadata.google.internal/computeMetadata/v1/instance/{0}"
-        url = url.format(key)
-        return self.get_metadata_value(url)
+    def fetch_many(self, keys):
+        '''
+        Fetches a list of keys, relative to the metadata root (for example
+        "instance/attributes/dns" or "project/project-id"), concurrently.
+        Returns a dict of key -> value, where missing keys map to None.
+        '''
+        urls = {key: "{0}/{1}".format(self.metadata_url, key) for key in keys}
+        pending = [url for url in urls.values() if url not in self.cache]
+        if pending:
+            import concurrent.futures
+            workers = min(self.max_workers, len(pending))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(self.get_metadata_value, pending))
+        return {key: self.cache[url] for key, url in urls.items()}
 
-    def get_project_metadata_value(self, key):
-        '''Helper method for retrieving Project Metadata values'''
-        url = "http://metadata.google.internal/computeMetadata/v1/project/{0}"
-        url = url.format(key)
-        return self.get_metadata_value(url)
+    def load_snapshot(self):
+        '''Fetches and indexes the instance and project trees, once.'''
+        if self.index is None:
+            trees = self.fetch_many(["instance/?recursive=true&alt=json",
+                                     "project/?recursive=true&alt=json"])
+            self.index = {}
+            for key, tree in trees.items():
+                if tree is not None:
+                    self.index_tree(json.loads(tree), key.split('/')[0], self.index)
+        return self.index
+
+    def get_many(self, keys):
+        '''
+        Returns a dict of key -> value for a list of keys relative to the
+        metadata root, served from the snapshot in snapshot mode.
+        '''
+        if self.snapshot:
+            index = self.load_snapshot()
+            return {key: index.get(key) for key in keys}
+        return self.fetch_many(keys)
 
-    def get_any_metadata_value(self, key, default=None):
+    def wait_for_change(self, key, last_etag=None, timeout_sec=300):
         '''
-        Helper method for retrieving either instance metadata, if it exists,
-        or project metadata. If metadata can't be found for the passed key in
-        either instance or project metadata, the value of default is returned.
+        Long-polls key with wait_for_change=true. The metadata server answers
+        once the value's ETag differs from last_etag, or when timeout_sec
+        elapses. Returns a tuple of (value, etag).
         '''
-        instance_metadata_value = self.get_instance_metadata_value(key)
-        project_metadata_value = self.get_project_metadata_value(key)
-        if instance_metadata_value is None:
-            if project_metadata_value is None:
-                return default
-            return project_metadata_value
+        params = {"wait_for_change": "true", "timeout_sec": timeout_sec}
+        if last_etag is not None:
+            params["last_etag"] = last_etag
+        request = self.session.get("{0}/{1}".format(self.metadata_url, key),
+                                   params=params,
+                                   timeout=self.timeout + timeout_sec)
+        return self.return_request(request), request.headers.get("ETag")
 
-        return instance_metadata_value
+class StandInMetadataProvider(GCEMetadataWrapper):
+    '''
+    GCEMetadataWrapper talking to a MetadataStandInServer on localhost which
+    serves the json file at path, so the HTTP code path can be exercised
+    offline, with injected latency and errors if wanted.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, path, latency=0.0, jitter=0.0, error_rate=0.0, **kwargs):
+        if path is None:
+            raise ValueError("path can't be None")
+        with open(path) as metadata_file:
+            trees = json.load(metadata_file)
+        from kickstart_salt_standin import MetadataStandInServer
+        self.standin = MetadataStandInServer(trees,
+                                             latency=latency,
+                                             jitter=jitter,
+                                             error_rate=error_rate).start()
+        GCEMetadataWrapper.__init__(self, metadata_url=self.standin.url, **kwargs)
 
 # pylint: disable=R0902
 class KickstartSalt:
     '''A class to kickstart bootstrap-salt.sh!'''
+    # Extra run_live() arguments (log tee, timestamps) for every command.
+    run_live_options = {}
+
+    PACKAGE_QUERY_COMMAND = ["rpm", "-q"]
+    PACKAGE_INSTALL_COMMAND = ["sudo", "yum", "install"]
+    YUM_LOCAL_REPO_PATH = "/etc/yum.repos.d/kickstart_salt_local.repo"
+    YUM_BUNDLE_REPO_PATH = "/etc/yum.repos.d/kickstart_salt_bundle.repo"
+    STATE_PATH = ("c:\\kickstart_salt\\state.json" if platform.system() == "Windows"
+                  else "/var/lib/kickstart_salt/state.json")
+    # Root of the filesystem being bootstrapped; None means this host.
+    target_root = None
+
     @staticmethod
     def filter_by(data, attr=platform.system()):
         try:
@@ -72,9 +234,39 @@ class KickstartSalt:
                  etc_salt_master_d=None,
                  salt_master_autosign_patterns=None,
                  salt_master_prerequisite_yum_packages=None,
-                 bootstrap_salt_download_url=None):
+                 bootstrap_salt_download_url=None,
+                 bootstrap_salt_cache_dir=None,
+                 bootstrap_salt_cache_max_bytes=None,
+                 kickstart_salt_report_path=None,
+                 kickstart_salt_report_log=False,
+                 kickstart_salt_log_path=None,
+                 kickstart_salt_log_timestamps=False,
+                 bootstrap_salt_timeout=None,
+                 salt_master_yum_repo_dir=None,
+                 salt_master_yum_cache_dir=None,
+                 bootstrap_salt_expected_hashes=None,
+                 bootstrap_salt_signature_url=None,
+                 bootstrap_salt_public_key_path=None,
+                 bootstrap_salt_signature_hash_type=None,
+                 kickstart_salt_state_path=None,
+                 kickstart_salt_target_root=None,
+                 bootstrap_salt_command_prefix=None,
+                 kickstart_salt_admission=None,
+                 kickstart_salt_peer=None,
+                 kickstart_salt_bundle=None,
+                 salt_minion_id=None,
+                 salt_minion_key=None,
+                 salt_minion_keys_dir=None,
+                 salt_master_preseed_keys_dir=None,
+                 force=False):
 
         # Setting up object instance variables
+        self.target_root = kickstart_salt_target_root
+        self.bootstrap_salt_command_prefix = bootstrap_salt_command_prefix
+        if self.target_root and not self.bootstrap_salt_command_prefix:
+            # Without one, bootstrap-salt would install salt on this host.
+            raise ValueError("bootstrap_salt_command_prefix can't be None "
+                             "when kickstart_salt_target_root is set")
         self.dns_entries = dns_entries
         self.bootstrap_salt_save_path = bootstrap_salt_save_path
         self.bootstrap_salt_expected_hash = bootstrap_salt_expected_hash
@@ -94,97 +286,482 @@ class KickstartSalt:
         self.etc_salt_master_d = etc_salt_master_d
         self.salt_master_autosign_patterns = salt_master_autosign_patterns
         self.salt_master_prerequisite_yum_packages = salt_master_prerequisite_yum_packages
+        self.salt_master_yum_repo_dir = salt_master_yum_repo_dir
+        self.salt_master_yum_cache_dir = salt_master_yum_cache_dir
+        self.salt_minion_id = salt_minion_id
+        self.salt_minion_key = salt_minion_key
+        self.salt_minion_keys_dir = salt_minion_keys_dir
+        self.salt_master_preseed_keys_dir = salt_master_preseed_keys_dir
         self.bootstrap_salt_download_url = bootstrap_salt_download_url
+        self.bootstrap_salt_cache = None
+        if bootstrap_salt_cache_dir is not None:
+            self.bootstrap_salt_cache = BootstrapSaltCache(
+                bootstrap_salt_cache_dir,
+                max_bytes=bootstrap_salt_cache_max_bytes or 64 * 1024 * 1024
+            )
+        self.report = BootstrapReport(report_path=(kickstart_salt_report_path and
+                                                   self.target_path(kickstart_salt_report_path)),
+                                      log_phases=kickstart_salt_report_log)
+        self.run_live_options = {
+            'log_path': kickstart_salt_log_path and self.target_path(kickstart_salt_log_path),
+            'timestamps': kickstart_salt_log_timestamps
+        }
+        self.bootstrap_salt_timeout = bootstrap_salt_timeout
+        self.bootstrap_salt_expected_hashes = bootstrap_salt_expected_hashes
+        self.bootstrap_salt_signature_url = bootstrap_salt_signature_url
+        self.bootstrap_salt_public_key_path = bootstrap_salt_public_key_path
+        self.bootstrap_salt_signature_hash_type = bootstrap_salt_signature_hash_type or "sha256"
+        if self.bootstrap_salt_signature_url and not self.bootstrap_salt_public_key_path:
+            raise ValueError("bootstrap_salt_public_key_path can't be None "
+                             "when bootstrap_salt_signature_url is set")
+        self.state = PhaseState(self.target_path(kickstart_salt_state_path or self.STATE_PATH))
+        admission = kickstart_salt_admission or {}
+        seed = admission.get('seed')
+        if self.target_root:
+            # Targets on one host share a hostname; spread them out too.
+            seed = "{0}:{1}".format(platform.node() if seed is None else seed,
+                                    self.target_root)
+        self.admission = AdmissionControl(phases=admission.get('phases'),
+                                          seed=seed,
+                                          download_retries=admission.get('download_retries', 3),
+                                          max_retry_after=admission.get('max_retry_after', 120))
+        self.bundle = None
+        if kickstart_salt_bundle is not None:
+            # tarfile is only imported when a bundle is used.
+            from kickstart_salt_bundle import BootstrapBundle
+            self.bundle = BootstrapBundle.open(kickstart_salt_bundle)
+            if self.salt_master_yum_repo_dir is None:
+                self.salt_master_yum_repo_dir = self.bundle.repo_path()
+            if self.salt_minion_keys_dir is None:
+                self.salt_minion_keys_dir = self.bundle.keys_path()
+            if self.salt_master_preseed_keys_dir is None:
+                self.salt_master_preseed_keys_dir = self.bundle.keys_path()
+        self.peers = None
+        if kickstart_salt_peer and kickstart_salt_peer.get('peers'):
+            from kickstart_salt_peer import Peers
+            self.peers = Peers(kickstart_salt_peer['peers'],
+                               fanout=kickstart_salt_peer.get('fanout', 2),
+                               timeout=kickstart_salt_peer.get('timeout', 5))
+        self.force = force
 
         # Run the bootstrap!!
         self.run_bootstrap()
 
+    def target_path(self, path):
+        '''
+        Maps an absolute path on the target (e.g. /etc/resolv.conf) to where
+        it is on this host: under target_root, if one is set.
+        '''
+        if not self.target_root:
+            return path
+        return os.path.join(self.target_root, os.path.splitdrive(path)[1].lstrip('/\\'))
+
+    def minion_id(self):
+        '''salt_minion_id, else bootstrap-salt's -i, else the FQDN salt defaults to'''
+        import socket
+        return (self.salt_minion_id or self.bootstrap_salt_json_args.get('-i') or
+                socket.getfqdn())
+
+    def minion_key(self):
+        '''
+        The pre-generated key pair ({"pem", "pub"}) for this minion: from
+        metadata, else from salt_minion_keys_dir. None if there isn't one.
+        '''
+        if self.salt_minion_key is not None:
+            return self.salt_minion_key
+        if self.salt_minion_keys_dir is not None:
+            from kickstart_salt_keys import MinionKeys
+            return MinionKeys.load(self.salt_minion_keys_dir, self.minion_id())
+        return None
+
     def run_bootstrap(self):
         '''
-        Main bootstrapping function. Program flow is defined here. Meat and
-        potatoes.
+        Main bootstrapping function. Runs the phases from add_phases() and
+        writes out the report, even if the bootstrap fails.
         '''
-        operating_system = platform.system()
-        if operating_system == 'Linux':
-            # Write array of DNS entries to resolv.conf
-            self.set_dns_linux(self.dns_entries)
-            # set the shell to "sh" because we are on linux
-            shell = "sh"
-            # pylint: disable=C0301
-            # '-M' and '-J' signify that we are bootstrapping a master as per
-            #  https://docs.saltstack.com/en/latest/topics/tutorials/salt_bootstrap.html#command-line-options
-
-            # so... if we are, do master specific bootstrapping things...
-            if '-M' in self.bootstrap_salt_json_args:
-                if not os.path.isdir("/root/.ssh/"):
-                    os.mkdir('/root/.ssh')
+        scheduler = PhaseScheduler(report=self.report, state=self.state, force=self.force,
+                                   admission=self.admission)
+        self.add_phases(scheduler)
+        try:
+            scheduler.run()
+        finally:
+            self.report.write()
 
-                pathlib.Path("/etc/salt/master.d").mkdir(parents=True,
-                                                         exist_ok=True)
-                self.write_etc_salt_master_d_conf(
-                    etc_salt_master_d=self.etc_salt_master_d
-                )
-                self.write_autosign_conf(patterns=self.salt_master_autosign_patterns)
-                # Install prereq yum packages.
-                self.install_yum_packages(packages=self.salt_master_prerequisite_yum_packages)
+    def add_phases(self, scheduler):
+        '''
+        Program flow is defined here. Meat and potatoes.
 
-        elif operating_system == "Windows":
-            self.set_dns_windows(self.dns_entries)
-            shell = "powershell"
+        The flow is a small graph of phases run by a PhaseScheduler: phases
+        which don't depend on each other (the master.d/autosign writes, the
+        yum install and the bootstrap script download) run concurrently.
+        Every phase is timed by self.report, which is written out even if
+        the bootstrap fails.
 
-        else:
+        The yum install, the download and bootstrap-salt itself are recorded
+        in self.state with a digest of their inputs, and skipped on later
+        runs (every boot, on GCE) until those inputs change, unless
+        self.force is set.
+        '''
+        operating_system = platform.system()
+        if operating_system not in ("Linux", "Windows"):
             msg = "{0} is not a supported platform of kickstart-salt.py"
             formatted_msg = msg.format(operating_system)
             print(formatted_msg)
             exit(1)
+        if self.target_root and operating_system != "Linux":
+            print("kickstart_salt_target_root is only supported on Linux")
+            exit(1)
 
-        # download and save the bootstrap script from upstream.
-        bootstrap_path = self.download_salt(url=self.bootstrap_salt_download_url,
-                                            save_path=(self.bootstrap_salt_save_path))
-        # verify hash of upstream bootstrap
-        if self.hash_matches(file_path=bootstrap_path,
-                             hash_type=self.bootstrap_salt_hash_type,
-                             expected_hash=self.bootstrap_salt_expected_hash):
+        if self.bootstrap_salt_expected_hash is None:
+            raise ValueError("bootstrap_salt_expected_hash can't be None")
 
-            print(bootstrap_path + " hash matches bootstrap_salt_expected_hash.")
-            cmd = [shell, bootstrap_path]
+        scheduler.add("dns", self.phase_dns)
+        # A minion with its key in place connects without generating one.
+        if operating_system == 'Linux' and self.minion_key() is not None:
+            scheduler.add("minion_key", self.phase_minion_key)
+        # pylint: disable=C0301
+        # '-M' and '-J' signify that we are bootstrapping a master as per
+        #  https://docs.saltstack.com/en/latest/topics/tutorials/salt_bootstrap.html#command-line-options
+
+        # so... if we are, do master specific bootstrapping things...
+        if operating_system == 'Linux' and '-M' in self.bootstrap_salt_json_args:
+            scheduler.add("master_d", self.phase_master_d)
+            scheduler.add("autosign", self.phase_autosign)
+            if self.salt_master_preseed_keys_dir is not None:
+                scheduler.add("master_keys", self.phase_master_keys)
+            # yum and the download need working DNS.
+            scheduler.add("yum", self.phase_yum, depends_on=["dns"],
+                          inputs=[self.salt_master_prerequisite_yum_packages,
+                                  self.salt_master_yum_repo_dir,
+                                  self.salt_master_yum_cache_dir])
+        if (operating_system == 'Linux' and self.bundle is not None and
+                self.bundle.repo_path() is not None):
+            scheduler.add("bundle_repo", self.phase_bundle_repo)
+        scheduler.add("download", self.phase_download, depends_on=["dns"],
+                      inputs=[self.bootstrap_salt_download_url,
+                              self.bootstrap_salt_save_path,
+                              self.bootstrap_salt_hash_type,
+                              self.bootstrap_salt_expected_hash,
+                              self.bootstrap_salt_expected_hashes,
+                              self.bootstrap_salt_signature_url,
+                              self.bootstrap_salt_public_key_path])
+        scheduler.add("bootstrap", self.phase_bootstrap,
+                      depends_on=list(scheduler.phases),
+                      inputs=[operating_system,
+                              self.bootstrap_salt_hash_type,
+                              self.bootstrap_salt_expected_hash,
+                              self.bootstrap_salt_json_args])
+
+    # pylint: disable=W0613
+    def phase_dns(self, span):
+        if platform.system() == "Windows":
+            self.set_dns_windows(self.dns_entries)
+        else:
+            if self.dns_entries is None:
+                logging.warning("dns_entries not provided, leaving resolv.conf alone.")
+                return
+            # Write array of DNS entries to resolv.conf
+            resolv_conf_path = self.target_path("/etc/resolv.conf")
+            if self.target_root:
+                pathlib.Path(os.path.dirname(resolv_conf_path)).mkdir(parents=True,
+                                                                       exist_ok=True)
+            self.set_dns_linux(self.dns_entries, resolv_conf_path=resolv_conf_path)
+
+    def phase_master_d(self, span):
+        ssh_dir = self.target_path("/root/.ssh")
+        if not os.path.isdir(ssh_dir):
+            os.makedirs(ssh_dir)
 
-            # Munge the bootstrap args into normal CLI flags that are valid for
-            #  the upstream bootstrap script
-            cmd.extend(self.process_bootstrap_salt_json_args(self.bootstrap_salt_json_args))
+        master_d_dir = self.target_path("/etc/salt/master.d")
+        pathlib.Path(master_d_dir).mkdir(parents=True,
+                                         exist_ok=True)
+        self.write_etc_salt_master_d_conf(
+            etc_salt_master_d=self.etc_salt_master_d,
+            master_d_dir=master_d_dir
+        )
+
+    def phase_autosign(self, span):
+        self.write_autosign_conf(patterns=self.salt_master_autosign_patterns,
+                                 autosign_path=self.target_path("/etc/salt/autosign.conf"))
+
+    def phase_minion_key(self, span):
+        from kickstart_salt_keys import MinionKeys
+        key = self.minion_key()
+        pki_dir = self.target_path(MinionKeys.MINION_PKI_DIR)
+        pathlib.Path(pki_dir).mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.write_if_changed(os.path.join(pki_dir, MinionKeys.PEM_NAME), key['pem'],
+                              mode=0o600)
+        self.write_if_changed(os.path.join(pki_dir, MinionKeys.PUB_NAME), key['pub'])
+        span.update(minion_id=self.minion_id(), fingerprint=MinionKeys.fingerprint(key['pub']))
+
+    def phase_master_keys(self, span):
+        from kickstart_salt_keys import MinionKeys
+        public_keys = MinionKeys.public_keys(self.salt_master_preseed_keys_dir)
+        written = MinionKeys.preseed(public_keys,
+                                     master_pki_dir=self.target_path(MinionKeys.MASTER_PKI_DIR))
+        print("Pre-seeded {0} accepted minion keys ({1} changed).".format(len(public_keys),
+                                                                          written))
+        span.update(keys=len(public_keys), keys_written=written)
+
+    def phase_yum(self, span):
+        # Install prereq yum packages, from the local repo if there is one.
+        if self.salt_master_prerequisite_yum_packages is not None:
+            self.write_yum_local_repo()
+        self.install_yum_packages(packages=self.salt_master_prerequisite_yum_packages)
+
+    def phase_bundle_repo(self, span):
+        # bootstrap-salt installs salt from the bundle's repo, not the network.
+        repo_path = self.target_path(self.YUM_BUNDLE_REPO_PATH)
+        pathlib.Path(os.path.dirname(repo_path)).mkdir(parents=True, exist_ok=True)
+        self.write_if_changed(
+            repo_path,
+            "[kickstart_salt_bundle]\n"
+            "name=kickstart_salt bundle packages\n"
+            "baseurl=file://{0}\n"
+            "enabled=1\n"
+            "gpgcheck=1\n"
+            "{1}"
+            "skip_if_unavailable=0\n".format(os.path.abspath(self.bundle.repo_path()),
+                                             self.yum_gpgkey_option(self.bundle.gpg_key_paths()))
+        )
+
+    def copy_bundle_script(self, save_path, span):
+        '''
+        Copies the bundle's script to save_path if it matches
+        bootstrap_salt_expected_hash, which is checked, along with the
+        digests verify_bootstrap_salt needs, as it's copied. Returns
+        save_path, or None.
+        '''
+        script_path = self.bundle.script_path()
+        pathlib.Path(os.path.dirname(os.path.abspath(save_path))).mkdir(parents=True,
+                                                                        exist_ok=True)
+        tmp_path, digests = BootstrapSaltDownloader.copy_hashed(
+            script_path, save_path, self.bootstrap_salt_hash_type,
+            self.verification_hash_types())
+        if not BootstrapSaltVerifier.digest_matches(digests[self.bootstrap_salt_hash_type],
+                                                    self.bootstrap_salt_expected_hash):
+            os.remove(tmp_path)
+            print("{0} doesn't match bootstrap_salt_expected_hash.".format(script_path))
+            return None
+        os.replace(tmp_path, save_path)
+        self.bootstrap_digests.update(digests)
+        print("Using {0} from the bundle.".format(script_path))
+        span.update(bytes_downloaded=0, source='bundle')
+        return save_path
+
+    def phase_download(self, span):
+        self.fetch_bootstrap_salt(span, BootstrapSaltDownloader.race)
+
+    def fetch_bootstrap_salt(self, span, race):
+        '''
+        The download phase of both engines, which differ only in the mirror
+        race they pass (called like BootstrapSaltDownloader.race). The
+        script is taken from the bundle, a peer, the cache or the mirrors,
+        in that order; whichever it comes from, it must match
+        bootstrap_salt_expected_hash and is verified before the phase ends.
+        '''
+        # download and save the bootstrap script from upstream. The hash is
+        #  verified while downloading; nothing is saved unless it matches.
+        save_path = self.target_path(self.bootstrap_salt_save_path)
+        if self.target_root:
+            pathlib.Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+        self.bootstrap_path = None
+        # Every digest verify_bootstrap_salt needs is computed as the script
+        #  is written, wherever it comes from, so it's never read back.
+        self.bootstrap_digests = {}
+        if self.bundle is not None:
+            self.bootstrap_path = self.copy_bundle_script(save_path, span)
+        if self.bootstrap_path is None and self.peers is not None:
+            # Peers are tried first; their copy is held to the same hash.
+            self.bootstrap_path = self.peers.fetch(save_path,
+                                                   self.bootstrap_salt_hash_type,
+                                                   self.bootstrap_salt_expected_hash,
+                                                   stats=span,
+                                                   hash_types=self.verification_hash_types(),
+                                                   digests=self.bootstrap_digests)
+        if self.bootstrap_path is None:
+            self.bootstrap_path = self.download_salt(
+                url=self.bootstrap_salt_download_url,
+                save_path=save_path,
+                cache=self.bootstrap_salt_cache,
+                hash_type=self.bootstrap_salt_hash_type,
+                expected_hash=self.bootstrap_salt_expected_hash,
+                stats=span,
+                retries=self.admission.download_retries,
+                max_retry_after=self.admission.max_retry_after,
+                hash_types=self.verification_hash_types(),
+                digests=self.bootstrap_digests,
+                race=race
+            )
+        if self.bootstrap_path is None:
+            # Fail the phase, so neither it nor bootstrap is recorded as done.
+            self.exit_without_bootstrap_salt()
+        if self.bootstrap_salt_expected_hashes or self.bootstrap_salt_signature_url:
+            self.verify_bootstrap_salt(span)
+
+    def exit_without_bootstrap_salt(self):
+        '''Exits, as no copy matching bootstrap_salt_expected_hash was obtained'''
+        print("No copy of " + self.bootstrap_salt_save_path + " matching bootstrap_salt_expected_hash could be downloaded!")
+        exit(1)
+
+    def verification_hash_types(self):
+        '''The hash types verify_bootstrap_salt checks the script with'''
+        hash_types = set(self.bootstrap_salt_expected_hashes or {})
+        if self.bootstrap_salt_signature_url:
+            hash_types.add(self.bootstrap_salt_signature_hash_type)
+        return sorted(hash_types)
+
+    def verify_bootstrap_salt(self, span):
+        '''
+        Checks the downloaded script against bootstrap_salt_expected_hashes
+        and the detached signature at bootstrap_salt_signature_url, using
+        the digests computed while it was downloaded (bootstrap_digests),
+        or else reading the script once. Exits if anything doesn't match.
+        '''
+        signature = None
+        if self.bootstrap_salt_signature_url:
+            try:
+                signature = urllib.urlopen(self.bootstrap_salt_signature_url,
+                                           timeout=30).read()
+            except (urllib.URLError, OSError, http.client.HTTPException) as err:
+                print("Couldn't download {0}: {1}".format(self.bootstrap_salt_signature_url, err))
+                exit(1)
+        result = BootstrapSaltVerifier(
+            expected_hashes=self.bootstrap_salt_expected_hashes,
+            signature=signature,
+            public_key_path=self.bootstrap_salt_public_key_path,
+            signature_hash_type=self.bootstrap_salt_signature_hash_type
+        ).verify(self.bootstrap_path, digests=self.bootstrap_digests)
+        span['verification'] = {key: result[key] for key in
+                                ('digests', 'matches', 'signature', 'size',
+                                 'hash_seconds', 'throughput_mib_s')}
+        if not result['ok']:
+            print("{0} failed verification: {1}".format(
+                self.bootstrap_path,
+                json.dumps({'matches': result['matches'],
+                            'signature': result['signature']}, sort_keys=True)
+            ))
+            exit(1)
+        print("{0} passed verification ({1}).".format(
+            self.bootstrap_path,
+            ', '.join(sorted(result['matches']) +
+                      (['signature'] if result['signature'] else []))
+        ))
+
+    def bootstrap_command(self):
+        '''
+        Returns the command line which runs the downloaded bootstrap script.
+        With bootstrap_salt_command_prefix (e.g. ["chroot", "{target_root}"])
+        the script is run by that command, inside the target, from its
+        path as seen in the target.
+        '''
+        shell = self.filter_by({"Windows": "powershell", "Linux": "sh"},
+                               platform.system())
+        if self.bootstrap_salt_command_prefix:
+            cmd = [part.replace("{target_root}", self.target_root or "/")
+                   for part in self.bootstrap_salt_command_prefix]
+            cmd.extend([shell, self.bootstrap_salt_save_path])
+        else:
+            cmd = [shell, self.bootstrap_path]
+
+        json_args = self.bootstrap_salt_json_args
+        if (self.bundle is not None and self.bundle.repo_path() is not None and
+                platform.system() == "Linux"):
+            # -r: use the repos already configured (the bundle's), don't add
+            #  upstream's.
+            json_args = dict(json_args, **{"-r": ""})
+
+        # Munge the bootstrap args into normal CLI flags that are valid for
+        #  the upstream bootstrap script
+        cmd.extend(self.process_bootstrap_salt_json_args(json_args))
+        return cmd
+
+    def phase_bootstrap(self, span):
+        bootstrap_path = self.bootstrap_path
+        if bootstrap_path is not None:
+
+            print(bootstrap_path + " hash matches bootstrap_salt_expected_hash.")
+            cmd = self.bootstrap_command()
 
             # Finally, run the damn thing!
-            run_bootstrap = self.run_live(cmd)
+            run_bootstrap = self.run_live(cmd,
+                                          timeout=self.bootstrap_salt_timeout,
+                                          **self.run_live_options)
             if run_bootstrap != 0:
                # if the script exits anything but zero, output exit code and exit
                 print(run_bootstrap)
                 exit(1)
         else:
-            print(bootstrap_path + " hash does not match bootstrap_salt_expected_hash!")
+            self.exit_without_bootstrap_salt()
+
+    @staticmethod
+    def write_if_changed(file_path, content, mode=None):
+        '''
+        Writes content (a string) to file_path, unless the file already holds
+        exactly that content, in which case it isn't touched at all. Changed
+        files are written to a temp file, fsynced and renamed into place, so
+        a half-written file is never observed. Returns True if it wrote.
+        mode, if given, is enforced; otherwise an existing file keeps its
+        mode and a new one gets 0644.
+        '''
+        data = content.encode('utf-8')
+        # Write through symlinks (e.g. a resolv.conf managed elsewhere).
+        file_path = os.path.realpath(file_path)
+        if os.path.isfile(file_path):
+            with open(file_path, 'rb') as existing:
+                existing_hash = hashlib.sha256(existing.read()).digest()
+            if existing_hash == hashlib.sha256(data).digest():
+                print("{0} is unchanged.".format(file_path))
+                if mode is not None:
+                    os.chmod(file_path, mode)
+                return False
+            if mode is None:
+                mode = os.stat(file_path).st_mode & 0o7777
+        elif mode is None:
+            mode = 0o644
+
+        handle, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(file_path) + ".",
+                                            dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return True
 
     @staticmethod
-    def write_autosign_conf(patterns=None):
+    def write_autosign_conf(patterns=None, autosign_path="/etc/salt/autosign.conf"):
         '''
         Takes a list of strings, which represent salt master autosign patterns
         and writes it to /etc/salt/autosign.conf.
         '''
         if patterns is not None:
-            if not os.path.isdir("/etc/salt"):
-                os.mkdir('/etc/salt/')
-            with open('/etc/salt/autosign.conf', 'w+') as autosign_conf:
-                for pattern in patterns:
-                    autosign_conf.write(pattern + '\n')
+            if not os.path.isdir(os.path.dirname(autosign_path)):
+                os.makedirs(os.path.dirname(autosign_path))
+            KickstartSalt.write_if_changed(
+                autosign_path,
+                ''.join(pattern + '\n' for pattern in patterns)
+            )
 
     @staticmethod
-    def write_etc_salt_master_d_conf(etc_salt_master_d):
+    def write_etc_salt_master_d_conf(etc_salt_master_d, master_d_dir="/etc/salt/master.d"):
+        # yaml is only needed, and only imported, when writing master.d.
+        import yaml
         for conf_name, json_conf in etc_salt_master_d.items():
             # print(conf_name)
             # print(json_conf)
             # print("conf_name type: " + str(type(conf_name)))
             # print("json_conf type: " + str(type(conf_name)))
-            conf_file_path = "/etc/salt/master.d/{0}".format(conf_name)
-            with open(conf_file_path, 'w') as file_object:
-                yaml.dump(json_conf, file_object, default_flow_style=False)
+            conf_file_path = os.path.join(master_d_dir, conf_name)
+            KickstartSalt.write_if_changed(
+                conf_file_path,
+                yaml.dump(json_conf, default_flow_style=False)
+            )
 
     def set_dns_windows(self, dns_entries):
         '''Use powershell to set DNS'''
@@ -203,59 +780,108 @@ class KickstartSalt:
         dns_entries_pwsh_array = ', '.join(dns_entries_with_quotes)
         cmd = ["powershell", "Set-DnsClientServerAddress", "-InterfaceAlias", "\"Ethernet\"",
                "-serverAddresses", "@(" + dns_entries_pwsh_array + ")"]
-        set_dns_return_code = self.run_live(cmd)
+        set_dns_return_code = self.run_live(cmd, **self.run_live_options)
         if set_dns_return_code != 0:
             print(set_dns_return_code)
             exit(1)
 
     @staticmethod
-    def set_dns_linux(dns_entries):
+    def set_dns_linux(dns_entries, resolv_conf_path="/etc/resolv.conf"):
         '''Write dns_entries to /etc/resolv.conf'''
         if dns_entries is None:
             raise ValueError("dns_entries can't be None")
-        with open('/etc/resolv.conf', 'w') as conf:
-            for item in dns_entries:
-                conf.write("{0}\n".format(item))
+        KickstartSalt.write_if_changed(
+            resolv_conf_path,
+            ''.join("{0}\n".format(item) for item in dns_entries)
+        )
 
     @staticmethod
-    def download_salt(url, save_path):
+    # pylint: disable=R0913
+    def download_salt(url, save_path, cache=None, hash_type=None, expected_hash=None,
+                      stats=None, retries=3, max_retry_after=120, hash_types=(),
+                      digests=None, race=None):
         # pylint: disable=C0301
         # Borrowed from https://github.com/facebook/IT-CPE/blob/master/chef/tools/chef_bootstrap.py#L305
         '''
         Generic function to download a file to a place on disk. For our
         purposes we will use it to download the upstream Salt
         bootstrap-salt.sh or bootstrap-salt.ps1
+
+        url may be a single url or a list of mirrors, which are raced: the
+        first copy to pass hash verification wins and the other transfers
+        are cancelled. Interrupted transfers are resumed with HTTP Range.
+
+        Responses are streamed to disk and hashed on the fly. If
+        expected_hash is passed, the file is only moved into save_path when
+        it matches; None is returned otherwise.
+
+        If a BootstrapSaltCache is passed, a cached copy matching
+        expected_hash is used without any network access, and conditional
+        headers are sent so an unchanged file isn't downloaded again.
+
+        If a stats dict is passed, it's updated with bytes_downloaded and
+        the source the file came from.
+
+        Mirrors answering 429 or 503 are retried up to retries times,
+        waiting as long as their Retry-After asks (up to max_retry_after).
+
+        If a digests dict is passed, it's updated with the file's digests
+        for hash_type and every one of hash_types, computed in the same pass
+        that writes it.
+
+        race, by default BootstrapSaltDownloader.race, races the mirrors.
         '''
+        if stats is None:
+            stats = {}
+        if digests is None:
+            digests = {}
         if url is None:
             raise ValueError("url can't be None")
         if save_path is None:
             raise ValueError("save_path can't be None")
+        if race is None:
+            race = BootstrapSaltDownloader.race
+        urls = [url] if isinstance(url, str) else list(url)
 
+        if cache is not None and cache.fetch(hash_type, expected_hash, save_path,
+                                             hash_types=hash_types, digests=digests):
+            print("Using cached copy of {0}.".format(', '.join(urls)))
+            stats.update(bytes_downloaded=0, source='cache')
+            return save_path
 
         # pylint: disable=W0106
-        print("Downloading from {0}...".format(url), end='')
+        print("Downloading from {0}...".format(', '.join(urls)), end='')
         sys.stdout.flush()
-        try:
-            # handles redirects
-            actual_url = urllib.urlopen(url).geturl()
-
-            # pylint: disable=C0103
-            with open(save_path, 'wb') as f:
-                f.write(urllib.urlopen(actual_url).read())
-            if os.path.exists(save_path):
-                print('success.')
-                return save_path
-        except urllib.URLError:
-            print("failed! Unable to download from %s!" % url)
-      # If we're here, we got nothing.
-        return None
+        winner = race(urls,
+                      save_path,
+                      hash_type or 'sha256',
+                      expected_hash=expected_hash,
+                      cache=cache,
+                      retries=retries,
+                      max_retry_after=max_retry_after,
+                      hash_types=hash_types)
+        if winner is None:
+            print("failed! Unable to download a copy matching the expected hash from %s!" % ', '.join(urls))
+            return None
+        digests.update(winner['digests'])
+
+        if winner['status'] == 'not_modified':
+            print('not modified, using cached copy.')
+            stats.update(bytes_downloaded=0, source='cache')
+        else:
+            stats.update(bytes_downloaded=winner['size'], source=winner['url'])
+            if cache is not None and hash_type is not None:
+                cache.store(winner['url'], save_path, hash_type,
+                            winner.get('headers'), digest=winner['digest'])
+            print('success from {0}.'.format(winner['url']))
+        return save_path
 
     @staticmethod
     def hash_matches(file_path,
                      hash_type,
                      expected_hash):
         '''
-        Check if a file matches an expected sha256 or md5 hash
+        Check if a file matches an expected hash, in constant time
         '''
         lvars = {
             'file_path': file_path,
@@ -273,17 +899,9 @@ class KickstartSalt:
         #     raise ValueError("hash_type can't be None")
         # if expected_hash is None:
         #     raise ValueError("expected_hash can't be None")
-        try:
-            h = getattr(hashlib, hash_type)()
-        except AttributeError:
-            msg = "{0} is not a valid hash type."
-            raise AttributeError(msg.format(hash_type))
-
-        with open(file_path, 'rb', buffering=0) as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                h.update(chunk)
-
-        return h.hexdigest() == expected_hash
+        return BootstrapSaltVerifier(
+            expected_hashes={hash_type: expected_hash}
+        ).verify(file_path)['ok']
 
     @staticmethod
     def process_bootstrap_salt_json_args(jsondict):
@@ -327,81 +945,257 @@ class KickstartSalt:
         return args
 
     @staticmethod
-    def run_live(command):
+    def run_live(command, log_path=None, timestamps=False, timeout=None):
         """
         Run a subprocess with real-time output.
-        Can optionally redirect stdout/stderr to a log file.
+        Can optionally tee stdout/stderr to a rotating log file, prefix each
+        line with a timestamp and kill the process after timeout seconds.
         Returns only the return-code.
         """
-      # Validate that command is not a string
-        # if isinstance(command, basestring):
-        if isinstance(command, str):
-        # Not an array!
-            raise TypeError('Command must be an array')
-        # Run the command
-        if platform.system() == "Windows":
-            proc = subprocess.Popen(command,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
-                                    shell=True)
-        else:
-            proc = subprocess.Popen(command,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-        while proc.poll() is None:
-            # pylint: disable=C0103
-            l = proc.stdout.readline()
-            # pylint: disable=W0106
-            # We need to keep the trailing comma tuple because, for
-            #  some reason it makes the live output much cleaner.
-            # pylint: disable=R1707
-            print(l.decode('utf-8'), end=''),
-        print(proc.stdout.read())
-        return proc.returncode
+        return LiveProcess(command,
+                           log_path=log_path,
+                           timestamps=timestamps,
+                           timeout=timeout).run()
+
+    @staticmethod
+    def missing_packages(packages, query_command=None):
+        '''
+        Returns the packages which aren't installed yet, determined by one
+        bulk rpm query. If the query can't be run, every package is returned.
+        '''
+        query_command = query_command or KickstartSalt.PACKAGE_QUERY_COMMAND
+        try:
+            query = subprocess.run(query_command + list(packages),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        except OSError:
+            return list(packages)
+        output = query.stdout.decode('utf-8', 'replace')
+        not_installed = set(re.findall(r'^package (\S+) is not installed$', output, re.M))
+        if query.returncode != 0 and not not_installed:
+            # Failed for some other reason than missing packages.
+            return list(packages)
+        return [package for package in packages if package in not_installed]
+
+    @staticmethod
+    def yum_gpgkey_option(gpg_keys):
+        '''
+        The gpgkey line of a local repo whose packages are signed with the
+        key files gpg_keys. Without any, yum can only check them against
+        keys already imported into the rpm database.
+        '''
+        if not gpg_keys:
+            logging.warning("No GPG key for a local yum repo; its packages must be "
+                            "signed with a key rpm already has.")
+            return ""
+        return "gpgkey={0}\n".format(' '.join("file://" + os.path.abspath(key)
+                                             for key in gpg_keys))
+
+    def yum_repo_gpg_keys(self):
+        '''The GPG keys of salt_master_yum_repo_dir: the bundle's, or those in it'''
+        # Only imported when a local repo is used.
+        from kickstart_salt_bundle import BootstrapBundle
+        if self.bundle is not None and self.salt_master_yum_repo_dir == self.bundle.repo_path():
+            return self.bundle.gpg_key_paths()
+        return BootstrapBundle.find_gpg_keys(self.salt_master_yum_repo_dir)
+
+    def write_yum_local_repo(self):
+        '''
+        Writes the (disabled) kickstart_salt_local repo for
+        salt_master_yum_repo_dir, checked against the GPG keys at its top
+        (see BootstrapBundle.find_gpg_keys), which yum_options() enables.
+        Does nothing without a salt_master_yum_repo_dir.
+        '''
+        if not self.salt_master_yum_repo_dir:
+            return
+        repo_path = self.target_path(self.YUM_LOCAL_REPO_PATH)
+        # A fresh --installroot has no /etc/yum.repos.d yet.
+        pathlib.Path(os.path.dirname(repo_path)).mkdir(parents=True, exist_ok=True)
+        self.write_if_changed(
+            repo_path,
+            "[kickstart_salt_local]\n"
+            "name=kickstart_salt local packages\n"
+            "baseurl=file://{0}\n"
+            "enabled=0\n"
+            "gpgcheck=1\n"
+            "{1}".format(os.path.abspath(self.salt_master_yum_repo_dir),
+                         self.yum_gpgkey_option(self.yum_repo_gpg_keys()))
+        )
+
+    def yum_options(self):
+        '''
+        Returns extra yum arguments for salt_master_yum_repo_dir (install
+        only from the pre-staged local repo write_yum_local_repo() wrote)
+        and salt_master_yum_cache_dir (keep downloaded packages in a cache
+        which survives re-runs). With a target_root, packages are installed
+        into it.
+        '''
+        options = []
+        if self.target_root:
+            options.append("--installroot={0}".format(os.path.abspath(self.target_root)))
+        if self.salt_master_yum_repo_dir:
+            options.extend(["--disablerepo=*", "--enablerepo=kickstart_salt_local"])
+        if self.salt_master_yum_cache_dir:
+            options.extend(["--setopt=cachedir={0}".format(self.salt_master_yum_cache_dir),
+                            "--setopt=keepcache=1"])
+        return options
+
+    def yum_install_command(self, packages):
+        '''
+        Returns the yum command installing those of packages which aren't
+        installed yet, or None if there's nothing to install.
+        '''
+        query_command = None
+        if self.target_root:
+            query_command = self.PACKAGE_QUERY_COMMAND + ["--root",
+                                                          os.path.abspath(self.target_root)]
+        missing = self.missing_packages(packages, query_command=query_command)
+        if not missing:
+            print("Packages already installed: {0}".format(' '.join(packages)))
+            return None
+        return self.PACKAGE_INSTALL_COMMAND + self.yum_options() + missing + ["-y"]
 
     def install_yum_packages(self, packages=None):
         '''
-        Installs a list of packages via Yum
+        Installs a list of packages via Yum. Packages which are already
+        installed are skipped, and yum isn't run at all if none are missing.
         '''
         if packages is not None:
-            # packages_list = packages.split(',')
-            cmd_string = "sudo yum install {0} -y"
-            cmd = cmd_string.format(' '.join(packages))
-            install_yum_packages = self.run_live(cmd.split(' '))
+            cmd = self.yum_install_command(packages)
+            if cmd is None:
+                return
+            install_yum_packages = self.run_live(cmd, **self.run_live_options)
             if install_yum_packages != 0:
                 print(install_yum_packages)
                 exit(1)
 
 class KickstartSaltGoogleComputeEngine(KickstartSalt):
+    # Every metadata key read while bootstrapping, fetched in one batch.
+    BOOT_METADATA_KEYS = [
+        "instance/attributes/dns",
+        "project/attributes/dns",
+        "instance/attributes/kickstart_salt_args",
+        "project/attributes/kickstart_salt_args",
+        "project/project-id"
+    ]
+
+    JSON_METADATA_KEYS = [
+        ("project/attributes/dns", "'dns' key in project metadata"),
+        ("instance/attributes/dns", "'dns' key in instance metadata"),
+        ("project/attributes/kickstart_salt_args",
+         "'kickstart_salt_args' key in project metadata"),
+        ("instance/attributes/kickstart_salt_args",
+         "'kickstart_salt_args' key in instance metadata")
+    ]
+
+    # The lowest layer kickstart_salt_args are merged over.
+    DEFAULT_KICKSTART_SALT_ARGS = {}
+
+    # Bump when the layout of the resolved configuration artifact changes.
+    CONFIG_VERSION = 9
+    CONFIG_PATH = ("c:\\kickstart_salt\\config.json" if platform.system() == "Windows"
+                   else "/var/cache/kickstart_salt/config.json")
 
     @staticmethod
-    def validate_and_parse_json(json_string, description=""):
+    def validate_and_parse_json(json_string, description="", errors=None):
+        '''
+        Parses json_string. On a syntax error the diagnostic is appended to
+        errors and None is returned, or, without an errors list, it is
+        printed and kickstart-salt exits.
+        '''
         # if we get none here, just return
         if json_string is None:
             return None
         try:
             return json.loads(json_string)
         except json.decoder.JSONDecodeError as err:
-            err_list = (err.doc).split('\n')
-            RED = "\033[1;31m"
-            RESET = "\033[0;0m"
-            # pylint: disable=C0301
-            print("kickstart-salt has crashed while try to parse the json block described as: {0}. ".format(description), end='\n\n')
-            print("We've tried to highlight a line which ", end='')
-            print("is close to the error, though the highlighting may be ", end='')
-            print("a few lines off." + '\n')
-            print(">>> Error: ", end='')
-            print(err)
-            for line in err_list:
-                if err_list.index(line) == int(err.lineno)-1:
-                    sys.stdout.write(RED)
-                    print(line)
-                    sys.stdout.write(RESET)
-                    continue
-
-                print(line)
+            diagnostic = KickstartSaltGoogleComputeEngine.json_diagnostic(err, description)
+            if errors is not None:
+                errors.append(diagnostic)
+                return None
+            print("kickstart-salt has crashed while trying to parse a json block.", end='\n\n')
+            print(diagnostic)
             exit(1)
 
+    @staticmethod
+    def json_diagnostic(err, description="", context_lines=2, width=100):
+        '''
+        Renders a JSONDecodeError with the context_lines lines either side
+        of it and a caret under the offending column. Only that window of
+        the document is sliced out, and lines longer than width (minified
+        json, say) are clipped around the column.
+        '''
+        doc = err.doc
+        line_start = doc.rfind('\n', 0, err.pos) + 1
+        window_start = line_start
+        for _ in range(context_lines):
+            if window_start == 0:
+                break
+            window_start = doc.rfind('\n', 0, window_start - 1) + 1
+        window_end = line_start
+        for _ in range(context_lines + 1):
+            newline = doc.find('\n', window_end)
+            if newline == -1:
+                window_end = len(doc)
+                break
+            window_end = newline + 1
+        lines = doc[window_start:window_end].split('\n')
+        first_lineno = err.lineno - doc.count('\n', window_start, line_start)
+        if len(lines) > 1 and not lines[-1] and first_lineno + len(lines) - 1 > err.lineno:
+            # The window ends with a newline: drop the empty piece after it,
+            # unless it is the (empty) last line the error is on.
+            lines.pop()
+
+        column = err.colno - 1
+        left = 0
+        if max(len(line) for line in lines) > width:
+            left = max(column - width // 2, 0)
+        red, reset = "", ""
+        if sys.stdout.isatty():
+            red, reset = "\033[1;31m", "\033[0;0m"
+
+        out = [">>> Error in {0}: {1}".format(description or "json", err)]
+        for lineno, line in enumerate(lines, first_lineno):
+            text = line[left:left + width]
+            prefix = "..." if left else ""
+            suffix = "..." if len(line) > left + width else ""
+            rendered = "{0:>6} | {1}{2}{3}".format(lineno, prefix, text, suffix)
+            if lineno == err.lineno:
+                out.append(red + rendered + reset)
+                out.append("       | " + " " * (len(prefix) + column - left) + red + "^" + reset)
+            else:
+                out.append(rendered)
+        return '\n'.join(out)
+
+    @staticmethod
+    def check_metadata_json(metadata_provider):
+        '''
+        Parses every json metadata value, instance and project, and returns
+        the diagnostics of all that fail, rather than stopping at the first.
+        '''
+        keys = [key for key, _ in KickstartSaltGoogleComputeEngine.JSON_METADATA_KEYS]
+        values = metadata_provider.get_many(keys)
+        errors = []
+        for key, description in KickstartSaltGoogleComputeEngine.JSON_METADATA_KEYS:
+            KickstartSaltGoogleComputeEngine.validate_and_parse_json(
+                values[key], description=description, errors=errors
+            )
+        return errors
+
+    @staticmethod
+    def merge_layers(layers):
+        '''
+        Deep merges layers, a list of (name, json value) with the lowest
+        precedence first, and returns a MergeResult. Lists are replaced,
+        except at the key paths listed in any layer's
+        kickstart_salt_merge.append, where they are appended.
+        '''
+        append_paths = []
+        for _, value in layers:
+            if isinstance(value, dict) and isinstance(value.get("kickstart_salt_merge"), dict):
+                append_paths.extend(value["kickstart_salt_merge"].get("append", []))
+        from kickstart_salt_merge import JSONMerge
+        return JSONMerge(append_paths=append_paths).merge(layers)
 
     def generate_dns_entries(self):
         dns_project_metadata = self.gce_metadata.get_project_metadata_value(
@@ -429,17 +1223,14 @@ class KickstartSaltGoogleComputeEngine(KickstartSalt):
                 )
             )
 
-        if dns_project_metadata and dns_instance_metadata:
-            dns_metadata = deep_merge.merge(
-                dns_project_metadata,
-                dns_instance_metadata
-            )
-        elif dns_project_metadata and (dns_instance_metadata is None):
-            dns_metadata = dns_project_metadata
-        elif dns_instance_metadata and (dns_project_metadata is None):
-            dns_metadata = dns_instance_metadata
-        else:
+        self.dns_merge = self.merge_layers([
+            ("project", dns_project_metadata or None),
+            ("instance", dns_instance_metadata or None)
+        ])
+        dns_metadata = self.dns_merge.value
+        if dns_metadata is None:
             logging.warning("dns_project_metadata and dns_instance_metadata are both none.")
+            return None
 
         if platform.system() == "Windows":
             return dns_metadata['entries']
@@ -457,9 +1248,13 @@ class KickstartSaltGoogleComputeEngine(KickstartSalt):
 
         return dns_list
 
-    def __init__(self):
-        self.gce_metadata = GCEMetadataWrapper()
-        self.dns_entries = self.generate_dns_entries()
+    def generate_kickstart_salt_args(self):
+        '''
+        Parses kickstart_salt_args from instance and project metadata and
+        deep merges them over DEFAULT_KICKSTART_SALT_ARGS, instance metadata
+        taking precedence.
+        '''
+        import pprint
         # pylint: disable=C0103
         pp = pprint.PrettyPrinter(indent=2)
 
@@ -467,7 +1262,8 @@ class KickstartSaltGoogleComputeEngine(KickstartSalt):
             self.validate_and_parse_json(
                 self.gce_metadata.get_instance_metadata_value(
                     "attributes/kickstart_salt_args"
-                )
+                ),
+                description="'kickstart_salt_args' key in instance metadata"
             )
         )
         print("kickstart_salt_args_instance_metadata:")
@@ -478,7 +1274,8 @@ class KickstartSaltGoogleComputeEngine(KickstartSalt):
             self.validate_and_parse_json(
                 self.gce_metadata.get_project_metadata_value(
                     "attributes/kickstart_salt_args"
-                )
+                ),
+                description="'kickstart_salt_args' key in project metadata"
             )
         )
         print("kickstart_salt_args_project_metadata:")
@@ -486,86 +1283,636 @@ class KickstartSaltGoogleComputeEngine(KickstartSalt):
         print('\n\n')
 
         print("kickstart_salt_args:\n")
-        if self.kickstart_salt_args_instance_metadata and self.kickstart_salt_args_project_metadata:
-            self.kickstart_salt_args = deep_merge.merge(
-                self.kickstart_salt_args_project_metadata,
-                self.kickstart_salt_args_instance_metadata
-            )
-        elif self.kickstart_salt_args_instance_metadata and (self.kickstart_salt_args_project_metadata is None):
-            self.kickstart_salt_args = self.kickstart_salt_args_instance_metadata
-        elif self.kickstart_salt_args_project_metadata and (self.kickstart_salt_args_instance_metadata is None):
-            self.kickstart_salt_args = self.kickstart_salt_args_instance_metadata
-        else:
+        if (not self.kickstart_salt_args_instance_metadata and
+                not self.kickstart_salt_args_project_metadata):
             raise ValueError("kickstart_salt_args_instance_metadata and kickstart_salt_args_project_metadata are both None. This can't be.")
+        self.kickstart_salt_args_merge = self.merge_layers([
+            ("default", self.DEFAULT_KICKSTART_SALT_ARGS or None),
+            ("project", self.kickstart_salt_args_project_metadata or None),
+            ("instance", self.kickstart_salt_args_instance_metadata or None)
+        ])
+        self.kickstart_salt_args = self.kickstart_salt_args_merge.value
 
         pp.pprint(self.kickstart_salt_args)
+        print("kickstart_salt_args sources:")
+        pp.pprint(self.kickstart_salt_args_merge.sources())
+
+        return self.kickstart_salt_args
+
+    def generate_kickstart_salt_kwargs(self):
+        '''Derives the KickstartSalt arguments from kickstart_salt_args'''
+        return dict(
+            dns_entries=self.dns_entries,
+            bootstrap_salt_save_path=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_save_path_{0}".format(platform.system()),
+                    # default value:
+                    self.kickstart_salt_args.get(
+                        "bootstrap_salt_save_path",
+                        self.filter_by(
+                            {"Windows": "c:\\bootstrap-salt.ps1",
+                             "Linux": "/tmp/bootstrap-salt.sh"
+                            },
+                            platform.system()
+                        )
+                    )
+                )
+            ),
+            bootstrap_salt_expected_hash=(
+                self.kickstart_salt_args.get(
+                    'bootstrap_salt_expected_hash',
+                    None
+                )
+            ),
+            bootstrap_salt_hash_type=(
+                self.kickstart_salt_args['bootstrap_salt_hash_type']
+            ),
+            bootstrap_salt_json_args=(
+                self.kickstart_salt_args['bootstrap_salt_json_args']
+            ),
+            etc_salt_master_d=(
+                self.kickstart_salt_args.get(
+                    '/etc/salt/master.d/',
+                    None)
+            ),
+            salt_master_autosign_patterns=(
+                self.kickstart_salt_args.get(
+                    'salt_master_autosign_patterns',
+                    None
+                )
+            ),
+            salt_master_prerequisite_yum_packages=(
+                self.kickstart_salt_args.get(
+                    "salt_master_prerequisite_yum_packages",
+                    None
+                )
+            ),
+            bootstrap_salt_download_url=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_download_url_{0}".format(platform.system()),
+                    # default value:
+                    self.kickstart_salt_args.get(
+                        "bootstrap_salt_download_url",
+                        self.filter_by(
+                            # pylint: disable=C0301
+                            {'Windows': "https://raw.githubusercontent.com/saltstack/salt-bootstrap/e1cb060e655c564cecb857f179e0656ff8faf784/bootstrap-salt.ps1",
+                             'Linux': "https://bootstrap.saltstack.com"
+                            },
+                            platform.system()
+                        )
+                    )
+                )
+            ),
+            bootstrap_salt_cache_dir=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_cache_dir",
+                    None
+                )
+            ),
+            bootstrap_salt_cache_max_bytes=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_cache_max_bytes",
+                    None
+                )
+            ),
+            kickstart_salt_report_path=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_report_path",
+                    None
+                )
+            ),
+            kickstart_salt_report_log=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_report_log",
+                    False
+                )
+            ),
+            kickstart_salt_log_path=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_log_path",
+                    None
+                )
+            ),
+            kickstart_salt_log_timestamps=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_log_timestamps",
+                    False
+                )
+            ),
+            bootstrap_salt_timeout=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_timeout",
+                    None
+                )
+            ),
+            salt_master_yum_repo_dir=(
+                self.kickstart_salt_args.get(
+                    "salt_master_yum_repo_dir",
+                    None
+                )
+            ),
+            salt_master_yum_cache_dir=(
+                self.kickstart_salt_args.get(
+                    "salt_master_yum_cache_dir",
+                    None
+                )
+            ),
+            bootstrap_salt_expected_hashes=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_expected_hashes",
+                    None
+                )
+            ),
+            bootstrap_salt_signature_url=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_signature_url",
+                    None
+                )
+            ),
+            bootstrap_salt_public_key_path=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_public_key_path",
+                    None
+                )
+            ),
+            bootstrap_salt_signature_hash_type=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_signature_hash_type",
+                    None
+                )
+            ),
+            kickstart_salt_state_path=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_state_path",
+                    None
+                )
+            ),
+            kickstart_salt_target_root=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_target_root",
+                    None
+                )
+            ),
+            bootstrap_salt_command_prefix=(
+                self.kickstart_salt_args.get(
+                    "bootstrap_salt_command_prefix",
+                    None
+                )
+            ),
+            kickstart_salt_admission=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_admission",
+                    None
+                )
+            ),
+            kickstart_salt_peer=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_peer",
+                    None
+                )
+            ),
+            kickstart_salt_bundle=(
+                self.kickstart_salt_args.get(
+                    "kickstart_salt_bundle",
+                    None
+                )
+            ),
+            salt_minion_id=(
+                self.kickstart_salt_args.get(
+                    "salt_minion_id",
+                    None
+                )
+            ),
+            salt_minion_keys_dir=(
+                self.kickstart_salt_args.get(
+                    "salt_minion_keys_dir",
+                    None
+                )
+            ),
+            salt_master_preseed_keys_dir=(
+                self.kickstart_salt_args.get(
+                    "salt_master_preseed_keys_dir",
+                    None
+                )
+            )
+        )
+
+    def minion_key_metadata(self):
+        '''
+        The kickstart_salt_minion_key instance attribute ({"pem", "pub"}), or
+        None. It's read apart from the resolved configuration, so the private
+        key is never cached at config_path or printed.
+        '''
+        value = self.gce_metadata.get_instance_metadata_value(
+            "attributes/kickstart_salt_minion_key")
+        if value is None:
+            return None
+        try:
+            key = json.loads(value)
+        except ValueError:
+            key = None
+        if not isinstance(key, dict) or 'pem' not in key or 'pub' not in key:
+            print("The 'kickstart_salt_minion_key' instance attribute isn't "
+                  "a json object with 'pem' and 'pub'.")
+            exit(1)
+        return key
+
+    def metadata_digest(self):
+        '''
+        Digest of everything the resolved configuration depends on: the raw
+        boot metadata values, the platform and the artifact format version.
+        '''
+        inputs = {
+            'version': self.CONFIG_VERSION,
+            'platform': platform.system(),
+            'metadata': self.gce_metadata.get_many(self.BOOT_METADATA_KEYS)
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def load_config(self, config_path, digest):
+        '''Returns the artifact at config_path if it was made from digest'''
+        try:
+            with open(config_path) as config_file:
+                config = json.load(config_file)
+        except (IOError, ValueError):
+            return None
+        if (not isinstance(config, dict) or
+                config.get('version') != self.CONFIG_VERSION or
+                config.get('digest') != digest):
+            return None
+        return config
+
+    def resolve_config(self, config_path=None):
+        '''
+        Returns the resolved configuration: dns_entries, the merged
+        kickstart_salt_args and the KickstartSalt kwargs. It is reused from
+        config_path when the metadata it was made from hasn't changed, and
+        otherwise resolved from metadata and saved to config_path.
+        '''
+        digest = self.metadata_digest()
+        if config_path is not None:
+            config = self.load_config(config_path, digest)
+            if config is not None:
+                print("Using the configuration resolved in {0}".format(config_path))
+                return config
+
+        errors = self.check_metadata_json(self.gce_metadata)
+        if errors:
+            print("kickstart-salt found {0} invalid json metadata value(s).".format(len(errors)),
+                  end='\n\n')
+            print('\n\n'.join(errors))
+            exit(1)
+        self.dns_entries = self.generate_dns_entries()
+        self.kickstart_salt_args = self.generate_kickstart_salt_args()
+        config = {
+            'version': self.CONFIG_VERSION,
+            'digest': digest,
+            'dns_entries': self.dns_entries,
+            'kickstart_salt_args': self.kickstart_salt_args,
+            # Which layer (default/project/instance) each value came from.
+            'sources': {
+                'dns': self.dns_merge.sources(),
+                'kickstart_salt_args': self.kickstart_salt_args_merge.sources()
+            },
+            'kwargs': self.generate_kickstart_salt_kwargs()
+        }
+        if config_path is not None:
+            pathlib.Path(os.path.dirname(os.path.abspath(config_path))).mkdir(
+                parents=True, exist_ok=True)
+            self.write_if_changed(config_path,
+                                  json.dumps(config, indent=2, sort_keys=True) + "\n")
+        return config
 
-        KickstartSalt.__init__(self,
-                               dns_entries=self.dns_entries,
-                               bootstrap_salt_save_path=(
-                                   self.kickstart_salt_args.get(
-                                       "bootstrap_salt_save_path_{0}".format(platform.system()),
-                                       # default value:
-                                       self.kickstart_salt_args.get(
-                                           "bootstrap_salt_save_path",
-                                           self.filter_by(
-                                               {"Windows": "c:\\bootstrap-salt.ps1",
-                                                "Linux": "/tmp/bootstrap-salt.sh"
-                                               },
-                                               platform.system()
-                                           )
-                                       )
-                                   )
-                               ),
-                               bootstrap_salt_expected_hash=(
-                                   self.kickstart_salt_args.get(
-                                       'bootstrap_salt_expected_hash',
-                                       None
-                                   )
-                               ),
-                               bootstrap_salt_hash_type=(
-                                   self.kickstart_salt_args['bootstrap_salt_hash_type']
-                               ),
-                               bootstrap_salt_json_args=(
-                                   self.kickstart_salt_args['bootstrap_salt_json_args']
-                               ),
-                               etc_salt_master_d=(
-                                   self.kickstart_salt_args.get(
-                                       '/etc/salt/master.d/',
-                                       None)
-                               ),
-                               salt_master_autosign_patterns=(
-                                   self.kickstart_salt_args.get(
-                                       'salt_master_autosign_patterns',
-                                       None
-                                   )
-                               ),
-                               salt_master_prerequisite_yum_packages=(
-                                   self.kickstart_salt_args.get(
-                                       "salt_master_prerequisite_yum_packages",
-                                       None
-                                   )
-                               ),
-                               bootstrap_salt_download_url=(
-                                   self.kickstart_salt_args.get(
-                                       "bootstrap_salt_download_url_{0}".format(platform.system()),
-                                       # default value:
-                                       self.kickstart_salt_args.get(
-                                           "bootstrap_salt_download_url",
-                                           self.filter_by(
-                                               # pylint: disable=C0301
-                                               {'Windows': "https://raw.githubusercontent.com/saltstack/salt-bootstrap/e1cb060e655c564cecb857f179e0656ff8faf784/bootstrap-salt.ps1",
-                                                'Linux': "https://bootstrap.saltstack.com"
-                                               },
-                                               platform.system()
-                                           )
-                                       )
-                                   )
-                               )
-                              )
+    # pylint: disable=R0913
+    def __init__(self, minimal=False, metadata_provider=None,
+                 config_path=CONFIG_PATH, dump_config=False, force=False):
+        '''
+        metadata_provider is any MetadataProvider; by default the GCE
+        metadata server is queried. The resolved configuration is cached at
+        config_path (None disables the cache). With dump_config=True the
+        configuration is only resolved and saved, not applied. force=True
+        re-runs phases which already succeeded with the same inputs.
+        '''
+        self.minimal = minimal
+        self.gce_metadata = metadata_provider or GCEMetadataWrapper(snapshot=True,
+                                                                    minimal=minimal)
+        self.gce_metadata.get_many(self.BOOT_METADATA_KEYS)
+        self.config = config = self.resolve_config(config_path)
+        self.dns_entries = config['dns_entries']
+        self.kickstart_salt_args = config['kickstart_salt_args']
+        if dump_config:
+            return
+
+        KickstartSalt.__init__(self, force=force, salt_minion_key=self.minion_key_metadata(),
+                               **config['kwargs'])
 
         # self.disable_firewalld()
         # self.disable_selinux()
 
+class KickstartSaltGoogleComputeEngineWatcher(KickstartSaltGoogleComputeEngine):
+    '''
+    Long-polls instance and project attributes and re-applies DNS, master.d
+    and autosign configuration whenever the relevant metadata changes. The
+    bootstrap itself is left to the startup-script run.
+    '''
+    WATCHED_TREES = ["instance", "project"]
+
+    # pylint: disable=W0231
+    def __init__(self, timeout_sec=300, retry_delay=5, minimal=False,
+                 metadata_provider=None):
+        self.minimal = minimal
+        self.gce_metadata = metadata_provider or GCEMetadataWrapper(snapshot=True,
+                                                                    minimal=minimal)
+        self.gce_metadata.load_snapshot()
+        self.timeout_sec = timeout_sec
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.applied = None
+        self.apply_changes()
+
+    def set_dns(self, dns_entries):
+        if platform.system() == "Windows":
+            self.set_dns_windows(dns_entries)
+        else:
+            self.set_dns_linux(dns_entries)
+
+    def apply_changes(self):
+        '''
+        Resolves the configuration from the current snapshot and applies only
+        the parts that differ from the last applied configuration. The first
+        call records the configuration left behind by the bootstrap.
+        '''
+        errors = self.check_metadata_json(self.gce_metadata)
+        if errors:
+            logging.warning("Ignoring invalid metadata, keeping the last "
+                            "applied configuration:\n%s", '\n\n'.join(errors))
+            return
+        try:
+            self.dns_entries = self.generate_dns_entries()
+            self.kickstart_salt_args = self.generate_kickstart_salt_args()
+            kwargs = self.generate_kickstart_salt_kwargs()
+        except (ValueError, KeyError, SystemExit) as err:
+            logging.warning("Ignoring invalid metadata, keeping the last "
+                            "applied configuration: %s", err)
+            return
+
+        if self.applied is None:
+            self.applied = kwargs
+            return
+
+        changed = [key for key, val in kwargs.items() if self.applied.get(key) != val]
+        if not changed:
+            return
+
+        if 'dns_entries' in changed and kwargs['dns_entries'] is not None:
+            print("Applying dns_entries")
+            self.set_dns(kwargs['dns_entries'])
+        if '-M' in kwargs['bootstrap_salt_json_args']:
+            if 'etc_salt_master_d' in changed and kwargs['etc_salt_master_d']:
+                print("Applying /etc/salt/master.d/")
+                pathlib.Path("/etc/salt/master.d").mkdir(parents=True,
+                                                         exist_ok=True)
+                self.write_etc_salt_master_d_conf(
+                    etc_salt_master_d=kwargs['etc_salt_master_d']
+                )
+            if 'salt_master_autosign_patterns' in changed:
+                print("Applying salt_master_autosign_patterns")
+                self.write_autosign_conf(
+                    patterns=kwargs['salt_master_autosign_patterns']
+                )
+        self.applied = kwargs
+
+    def update_attributes(self, tree, attributes):
+        '''Replaces the snapshot's attributes for tree ("instance"/"project")'''
+        prefix = tree + "/attributes"
+        index = self.gce_metadata.index
+        for key in [key for key in index if key.startswith(prefix + "/")]:
+            del index[key]
+        self.gce_metadata.index_tree(attributes, prefix, index)
+
+    def watch_tree(self, tree):
+        '''
+        Long-polls the attributes of tree forever. A request which fails, or
+        isn't answered with a 200, keeps the last snapshot and etag and is
+        retried after retry_delay: only a 200 can say attributes changed.
+        '''
+        key = tree + "/attributes/?recursive=true&alt=json"
+        etag = None
+        while True:
+            try:
+                value, new_etag = self.gce_metadata.wait_for_change(
+                    key,
+                    last_etag=etag,
+                    timeout_sec=self.timeout_sec
+                )
+            except self.gce_metadata.request_errors as err:
+                logging.warning("Watching %s metadata failed: %s", tree, err)
+                time.sleep(self.retry_delay)
+                continue
+            if value is None:
+                logging.warning("Watching %s metadata got no answer, retrying.", tree)
+                time.sleep(self.retry_delay)
+                continue
+
+            if new_etag != etag:
+                with self.lock:
+                    self.update_attributes(tree, json.loads(value))
+                    self.apply_changes()
+            etag = new_etag
+
+    def watch(self):
+        '''Watches instance and project attributes until interrupted'''
+        threads = [threading.Thread(target=self.watch_tree, args=(tree,))
+                   for tree in self.WATCHED_TREES]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
 if __name__ == '__main__':
-    KickstartSaltGoogleComputeEngine()
+    # pylint: disable=C0103
+    import argparse
+    parser = argparse.ArgumentParser(description="kickstart_salt")
+    parser.add_argument("--watch", action="store_true",
+                        help="long-poll metadata and re-apply DNS and "
+                             "master config as it changes")
+    parser.add_argument("--minimal", action="store_true",
+                        help="only use the standard library: urllib for "
+                             "metadata")
+    parser.add_argument("--metadata-file",
+                        help="read metadata from this json file instead of "
+                             "the GCE metadata server")
+    parser.add_argument("--metadata-standin",
+                        help="serve this json metadata file from a local "
+                             "stand-in metadata server and query it over HTTP")
+    parser.add_argument("--standin-latency", type=float, default=0.0,
+                        help="seconds the stand-in server waits before answering")
+    parser.add_argument("--standin-error-rate", type=float, default=0.0,
+                        help="fraction of stand-in requests answered with a 503")
+    parser.add_argument("--config-path",
+                        default=KickstartSaltGoogleComputeEngine.CONFIG_PATH,
+                        help="where the resolved configuration is cached")
+    parser.add_argument("--no-config-cache", action="store_true",
+                        help="always resolve the configuration from metadata")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the bootstrap on an asyncio event loop")
+    parser.add_argument("--force", action="store_true",
+                        help="re-run phases (including bootstrap-salt) which "
+                             "already succeeded with the same inputs")
+    parser.add_argument("--check-metadata", action="store_true",
+                        help="report every json syntax error in dns and "
+                             "kickstart_salt_args metadata, then exit")
+    parser.add_argument("--dump-config", action="store_true",
+                        help="resolve the configuration, save it to "
+                             "--config-path and exit without bootstrapping")
+    parser.add_argument("--target-root", action="append", metavar="PATH",
+                        help="bootstrap the filesystem at PATH (a chroot or "
+                             "container root) instead of this host; repeat "
+                             "to bootstrap several targets")
+    parser.add_argument("--target-concurrency", type=int, default=4,
+                        help="how many --target-root targets are bootstrapped "
+                             "at once")
+    parser.add_argument("--target-command",
+                        help="command which runs bootstrap-salt inside a "
+                             "target, e.g. 'chroot {target_root}'")
+    parser.add_argument("--target-minion-id",
+                        help="minion id of each --target-root target, with "
+                             "{minion_id}, {target_root} and {target_name} "
+                             "replaced (default: '{minion_id}-{target_name}')")
+    parser.add_argument("--build-bundle", metavar="PATH",
+                        help="resolve the configuration, download and verify "
+                             "the script and write them (with --bundle-packages) "
+                             "to a bundle at PATH for offline bootstraps")
+    parser.add_argument("--bundle-packages", metavar="DIR",
+                        help="yum repo (with repodata) to include in --build-bundle")
+    parser.add_argument("--bundle-gpg-key", action="append", metavar="PATH",
+                        help="GPG key the --bundle-packages are signed with, "
+                             "if it isn't at the top of the repo; repeatable")
+    parser.add_argument("--bundle-keys", metavar="DIR",
+                        help="pre-generated minion keys (a --keys-dir) whose "
+                             "public keys --build-bundle includes, for masters")
+    parser.add_argument("--bundle-private-key", action="append", metavar="MINION_ID",
+                        help="also include this minion's private key from "
+                             "--bundle-keys, for a bundle only it gets; repeatable")
+    parser.add_argument("--bundle", metavar="PATH",
+                        help="bootstrap offline from the bundle (archive or "
+                             "extracted directory) at PATH, using the "
+                             "configuration baked into it")
+    parser.add_argument("--serve-peers", action="store_true",
+                        help="serve the verified bootstrap script (and "
+                             "kickstart_salt_peer's packages_dir) to other "
+                             "nodes until interrupted")
+    parser.add_argument("--generate-minion-keys", nargs='+', metavar="MINION_ID",
+                        help="generate key pairs for these minion ids into "
+                             "--keys-dir and exit")
+    parser.add_argument("--keys-dir", default="minion_keys",
+                        help="where --generate-minion-keys writes key pairs")
+    parser.add_argument("--key-bits", type=int, default=2048,
+                        help="RSA key size for --generate-minion-keys")
+    parser.add_argument("--key-concurrency", type=int,
+                        help="how many keys are generated at once "
+                             "(default: one per CPU)")
+    cli_args = parser.parse_args()
+    if cli_args.generate_minion_keys:
+        from kickstart_salt_keys import MinionKeys
+        try:
+            key_summary = MinionKeys(cli_args.keys_dir, bits=cli_args.key_bits,
+                                     max_workers=cli_args.key_concurrency).generate(
+                                         cli_args.generate_minion_keys)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print("Couldn't generate minion keys: {0}".format(getattr(err, 'stderr', None) or err))
+            exit(1)
+        print(json.dumps(key_summary, indent=2, sort_keys=True))
+        exit(0)
+    config_path = None if cli_args.no_config_cache else cli_args.config_path
+    provider = None
+    if cli_args.metadata_file:
+        provider = JSONFileMetadataProvider(cli_args.metadata_file)
+    elif cli_args.metadata_standin:
+        provider = StandInMetadataProvider(cli_args.metadata_standin,
+                                           latency=cli_args.standin_latency,
+                                           error_rate=cli_args.standin_error_rate,
+                                           snapshot=True,
+                                           minimal=cli_args.minimal)
+    if cli_args.check_metadata:
+        metadata_errors = KickstartSaltGoogleComputeEngine.check_metadata_json(
+            provider or GCEMetadataWrapper(snapshot=True, minimal=cli_args.minimal)
+        )
+        print('\n\n'.join(metadata_errors) or "All json metadata values parse.")
+        exit(1 if metadata_errors else 0)
+    if cli_args.use_async:
+        import asyncio
+        from kickstart_salt_async import AsyncKickstartSaltGoogleComputeEngine
+        asyncio.run(AsyncKickstartSaltGoogleComputeEngine(
+            minimal=cli_args.minimal,
+            metadata_provider=provider,
+            config_path=config_path,
+            force=cli_args.force
+        ).run())
+    elif cli_args.build_bundle:
+        from kickstart_salt_bundle import BootstrapBundle
+        from kickstart_salt_targets import TargetKickstartSalt
+        resolved = KickstartSaltGoogleComputeEngine(minimal=cli_args.minimal,
+                                                    metadata_provider=provider,
+                                                    config_path=config_path,
+                                                    dump_config=True)
+        bundle_script, _ = TargetKickstartSalt.fetch(resolved.config['kwargs'])
+        bundle_manifest = BootstrapBundle.build(cli_args.build_bundle, resolved.config,
+                                                bundle_script,
+                                                packages_dir=cli_args.bundle_packages,
+                                                keys_dir=cli_args.bundle_keys,
+                                                gpg_keys=cli_args.bundle_gpg_key,
+                                                private_keys=cli_args.bundle_private_key)
+        print("Wrote {0} with {1} files.".format(cli_args.build_bundle,
+                                                 len(bundle_manifest['files'])))
+    elif cli_args.bundle:
+        from kickstart_salt_bundle import BootstrapBundle
+        bundle_kwargs = BootstrapBundle.open(cli_args.bundle).config()['kwargs']
+        bundle_kwargs['kickstart_salt_bundle'] = cli_args.bundle
+        KickstartSalt(force=cli_args.force, **bundle_kwargs)
+    elif cli_args.serve_peers:
+        from kickstart_salt_peer import PeerServer
+        resolved = KickstartSaltGoogleComputeEngine(minimal=cli_args.minimal,
+                                                    metadata_provider=provider,
+                                                    config_path=config_path,
+                                                    dump_config=True)
+        resolved_kwargs = resolved.config['kwargs']
+        peer_config = resolved_kwargs.get('kickstart_salt_peer') or {}
+        PeerServer(
+            files=[resolved_kwargs['bootstrap_salt_save_path']],
+            cache=(BootstrapSaltCache(resolved_kwargs['bootstrap_salt_cache_dir'])
+                   if resolved_kwargs.get('bootstrap_salt_cache_dir') else None),
+            packages_dir=peer_config.get('packages_dir'),
+            host=peer_config.get('bind', "0.0.0.0"),
+            port=peer_config.get('port', PeerServer.DEFAULT_PORT)
+        ).serve_forever()
+    elif cli_args.target_root:
+        import shlex
+        from kickstart_salt_targets import MultiTargetRunner
+        resolved = KickstartSaltGoogleComputeEngine(minimal=cli_args.minimal,
+                                                    metadata_provider=provider,
+                                                    config_path=config_path,
+                                                    dump_config=True)
+        summary = MultiTargetRunner(
+            resolved.config['kwargs'],
+            cli_args.target_root,
+            max_workers=cli_args.target_concurrency,
+            command_prefix=(shlex.split(cli_args.target_command)
+                            if cli_args.target_command else None),
+            minion_id_template=cli_args.target_minion_id,
+            force=cli_args.force
+        ).run()
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        exit(1 if summary['failed'] else 0)
+    elif cli_args.watch:
+        KickstartSaltGoogleComputeEngineWatcher(minimal=cli_args.minimal,
+                                                metadata_provider=provider).watch()
+    else:
+        KickstartSaltGoogleComputeEngine(minimal=cli_args.minimal,
+                                         metadata_provider=provider,
+                                         config_path=config_path,
+                                         dump_config=cli_args.dump_config,
+                                         force=cli_args.force)
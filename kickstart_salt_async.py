@@ -0,0 +1,511 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+# asyncio is only imported by this module, so the sync engine doesn't pay
+#  for it.
+import asyncio
+import signal
+import ssl
+from kickstart_salt import KickstartSalt, KickstartSaltGoogleComputeEngine
+from kickstart_salt_download import BootstrapSaltDownloader
+from kickstart_salt_metadata import StaticMetadataProvider
+from kickstart_salt_phases import BootstrapReport, PhaseScheduler
+from kickstart_salt_process import LiveProcess
+
+class AsyncHTTPResponse:
+    '''Status, headers (lower-cased names) and a streaming body'''
+    def __init__(self, status, headers, reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    async def chunks(self, size=64 * 1024, timeout=30):
+        '''Yields the body as it arrives, for any of the framings HTTP/1.1 allows'''
+        reader = self.reader
+        if 'chunked' in self.headers.get('transfer-encoding', ''):
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                length = int(line.split(b';')[0].strip() or b'0', 16)
+                if not length:
+                    # Skip trailers.
+                    while (await asyncio.wait_for(reader.readline(), timeout)).strip():
+                        pass
+                    return
+                yield await asyncio.wait_for(reader.readexactly(length), timeout)
+                await asyncio.wait_for(reader.readline(), timeout)
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(size, remaining)), timeout)
+                if not chunk:
+                    raise http.client.IncompleteRead(b'', remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(size), timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def read(self, timeout=30):
+        return b''.join([chunk async for chunk in self.chunks(timeout=timeout)])
+
+    def close(self):
+        self.writer.close()
+
+class AsyncHTTPClient:
+    '''
+    Minimal HTTP/1.1 client on asyncio streams: GET only, one connection
+    per request, redirects followed. Errors are raised as OSError,
+    asyncio.TimeoutError or http.client.HTTPException.
+    '''
+    MAX_REDIRECTS = 5
+
+    @staticmethod
+    async def get(url, headers=None, timeout=30):
+        '''Returns an open AsyncHTTPResponse; the caller must close() it'''
+        for _ in range(AsyncHTTPClient.MAX_REDIRECTS + 1):
+            parts = urllib_parse.urlsplit(url)
+            https = parts.scheme == 'https'
+            port = parts.port or (443 if https else 80)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, port,
+                                        ssl=ssl.create_default_context() if https else None),
+                timeout
+            )
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = {
+                'Host': parts.netloc,
+                'User-Agent': 'kickstart_salt',
+                'Accept-Encoding': 'identity',
+                'Connection': 'close'
+            }
+            request_headers.update(headers or {})
+            writer.write("GET {0} HTTP/1.1\r\n{1}\r\n".format(
+                path,
+                ''.join("{0}: {1}\r\n".format(k, v) for k, v in request_headers.items())
+            ).encode('latin-1'))
+            try:
+                status_line = await asyncio.wait_for(reader.readline(), timeout)
+                try:
+                    status = int(status_line.split()[1])
+                except (IndexError, ValueError):
+                    raise http.client.BadStatusLine(status_line)
+                response_headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), timeout)
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    response_headers[name.strip().lower()] = value.strip()
+            except BaseException:
+                writer.close()
+                raise
+            response = AsyncHTTPResponse(status, response_headers, reader, writer)
+            if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                response.close()
+                url = urllib_parse.urljoin(url, response_headers['location'])
+                continue
+            return response
+        raise http.client.HTTPException("too many redirects for {0}".format(url))
+
+class AsyncGCEMetadataWrapper:
+    '''
+    asyncio counterpart of GCEMetadataWrapper: concurrent lookups on one
+    event loop, retried with exponential backoff on connection errors and
+    429/5xx responses, and cached by key.
+    '''
+    METADATA_URL = "http://metadata.google.internal/computeMetadata/v1"
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+    request_errors = (OSError, asyncio.TimeoutError, http.client.HTTPException)
+
+    def __init__(self, metadata_url=None, timeout=5, retries=3, backoff_factor=0.2):
+        self.metadata_url = (metadata_url or self.METADATA_URL).rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cache = {}
+
+    async def request(self, key, params=None, timeout=None):
+        '''Returns (status, body, headers) for key, after any retries'''
+        url = "{0}/{1}".format(self.metadata_url, key)
+        if params:
+            url += ('&' if '?' in url else '?') + urllib_parse.urlencode(params)
+        timeout = timeout or self.timeout
+        attempt = 0
+        while True:
+            try:
+                response = await AsyncHTTPClient.get(url, headers={"Metadata-Flavor": "Google"},
+                                                     timeout=timeout)
+                try:
+                    body = await response.read(timeout=timeout)
+                finally:
+                    response.close()
+                if response.status not in self.RETRY_STATUSES or attempt >= self.retries:
+                    return response.status, body, response.headers
+            except self.request_errors:
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+            attempt += 1
+
+    async def get_metadata_value(self, key):
+        if key not in self.cache:
+            status, body, _ = await self.request(key)
+            self.cache[key] = body.decode('utf-8') if status == 200 else None
+        return self.cache[key]
+
+    async def get_many(self, keys):
+        '''Returns a dict of key -> value, fetching every key concurrently'''
+        values = await asyncio.gather(*[self.get_metadata_value(key) for key in keys])
+        return dict(zip(keys, values))
+
+    async def load_trees(self):
+        '''Fetches the instance and project trees in two concurrent requests'''
+        values = await self.get_many(["instance/?recursive=true&alt=json",
+                                      "project/?recursive=true&alt=json"])
+        return {key.split('/')[0]: json.loads(value) if value is not None else None
+                for key, value in values.items()}
+
+    async def wait_for_change(self, key, last_etag=None, timeout_sec=300):
+        params = {"wait_for_change": "true", "timeout_sec": timeout_sec}
+        if last_etag is not None:
+            params["last_etag"] = last_etag
+        status, body, headers = await self.request(key, params=params,
+                                                   timeout=self.timeout + timeout_sec)
+        return (body.decode('utf-8') if status == 200 else None), headers.get('etag')
+
+class AsyncBootstrapSaltDownloader:
+    '''
+    asyncio counterpart of BootstrapSaltDownloader.race: mirrors are
+    streamed concurrently into temp files, hashed as bytes arrive, and the
+    first copy matching expected_hash wins; the other transfers are
+    cancelled. Broken transfers are resumed with Range/If-Range, and a
+    BootstrapSaltCache's validators are sent, as they are by the sync race.
+    '''
+    # pylint: disable=R0913,R0914
+    @staticmethod
+    async def fetch_mirror(url, save_path, hash_type, headers=None, timeout=30, retries=3,
+                           max_retry_after=120, hash_types=()):
+        result = {'url': url, 'status': 'failed', 'path': None}
+        hashes = BootstrapSaltDownloader.new_hashes(hash_type, hash_types)
+        tmp_path = BootstrapSaltDownloader.temp_path(save_path)
+        size = 0
+        attempt = 0
+        validator = None
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    request_headers = dict(headers or {})
+                    if size:
+                        request_headers['Range'] = 'bytes={0}-'.format(size)
+                        if validator:
+                            request_headers['If-Range'] = validator
+                    try:
+                        response = await AsyncHTTPClient.get(url, headers=request_headers,
+                                                             timeout=timeout)
+                        try:
+                            if response.status == 304:
+                                result['status'] = 'not_modified'
+                                break
+                            if (response.status in BootstrapSaltDownloader.THROTTLE_STATUSES
+                                    and attempt < retries):
+                                attempt += 1
+                                delay = BootstrapSaltDownloader.retry_delay(
+                                    response.headers, attempt, max_retry_after)
+                                logging.warning("%s returned HTTP %s, retrying in %.1f seconds",
+                                                url, response.status, delay)
+                                await asyncio.sleep(delay)
+                                continue
+                            if response.status not in (200, 206):
+                                logging.warning("%s returned HTTP %s", url, response.status)
+                                break
+                            if response.status != 206 and size:
+                                # The mirror ignored the Range, so start over.
+                                f.seek(0)
+                                f.truncate()
+                                hashes = BootstrapSaltDownloader.new_hashes(hash_type,
+                                                                            hash_types)
+                                size = 0
+                            if not size:
+                                result['headers'] = response.headers
+                                validator = (response.headers.get('etag') or
+                                             response.headers.get('last-modified'))
+                            async for chunk in response.chunks(
+                                    size=BootstrapSaltDownloader.CHUNK_SIZE, timeout=timeout):
+                                f.write(chunk)
+                                for h in hashes.values():
+                                    h.update(chunk)
+                                size += len(chunk)
+                        finally:
+                            response.close()
+                        f.flush()
+                        os.fsync(f.fileno())
+                        digests = {name: h.hexdigest() for name, h in hashes.items()}
+                        result.update(status='ok', path=tmp_path, digest=digests[hash_type],
+                                      digests=digests, size=size)
+                        return result
+                    except AsyncGCEMetadataWrapper.request_errors as err:
+                        attempt += 1
+                        if attempt > retries:
+                            logging.warning("Giving up on %s: %s", url, err)
+                            break
+                        logging.warning("Resuming %s at byte %s after: %s", url, size, err)
+                        await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+        finally:
+            if result['path'] is None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return result
+
+    @staticmethod
+    async def race(urls, save_path, hash_type, expected_hash=None, cache=None, timeout=30,
+                   retries=3, max_retry_after=120, hash_types=()):
+        '''Takes the arguments BootstrapSaltDownloader.race does and returns the same'''
+        tasks = [asyncio.ensure_future(AsyncBootstrapSaltDownloader.fetch_mirror(
+            url, save_path, hash_type,
+            headers=cache.conditional_headers(url) if cache is not None else None,
+            timeout=timeout, retries=retries, max_retry_after=max_retry_after,
+            hash_types=hash_types)) for url in urls]
+        winner = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if BootstrapSaltDownloader.settle(result, save_path, expected_hash, cache,
+                                                  hash_types):
+                    winner = result
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled transfers remove their temp files.
+            done = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in done:
+                if (isinstance(result, dict) and result is not winner and
+                        result['path'] is not None and os.path.exists(result['path'])):
+                    os.remove(result['path'])
+        return winner
+
+class AsyncLiveProcess(LiveProcess):
+    '''
+    LiveProcess whose output is pumped by a coroutine rather than a thread,
+    so many processes can stream on one event loop. It's reaped in the
+    loop's thread pool rather than by asyncio's child watcher, so its CPU
+    time is known. Timestamps, log rotation and the timeout behave the same.
+    '''
+    async def pump(self, stream):
+        while True:
+            chunk = await stream.read(self.READ_SIZE)
+            if not chunk:
+                return
+            self.emit(chunk)
+
+    async def kill(self, proc, waiter):
+        self.signal_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.KILL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            self.signal_group(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            await waiter
+
+    async def run(self):
+        '''Runs the command and returns its return code'''
+        loop = asyncio.get_running_loop()
+        if not hasattr(os, 'wait4'):
+            # Windows pipes can't be read by the event loop, nor usage reaped.
+            return await loop.run_in_executor(None, super().run)
+        proc = self.spawn()
+        stream = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stream), proc.stdout)
+        reader = asyncio.ensure_future(self.pump(stream))
+        waiter = loop.run_in_executor(None, self.reap, proc)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            await self.kill(proc, waiter)
+            print("\nKilled {0} after {1} seconds.".format(self.command[0], self.timeout))
+        finally:
+            try:
+                # Orphaned grandchildren can hold the pipe open after a kill.
+                await asyncio.wait_for(reader, self.KILL_GRACE_SECONDS if self.timed_out else None)
+            except asyncio.TimeoutError:
+                pass
+            transport.close()
+            if self.log is not None:
+                self.log.close()
+        BootstrapReport.add_subprocess_cpu(self.cpu_seconds())
+        return proc.returncode
+
+class AsyncPhaseScheduler(PhaseScheduler):
+    '''
+    PhaseScheduler on an event loop. Coroutine phases are awaited; plain
+    phases run in the loop's default thread pool, so they don't block it.
+    '''
+    async def run_phase(self, name):
+        func = self.phases[name][0]
+        with self.report.phase(name) as span:
+            if self.skip_phase(name, span):
+                return None
+            if self.admission is not None:
+                await self.admit(name, span)
+            if asyncio.iscoroutinefunction(func):
+                result = await func(span)
+            else:
+                # In this task's context, so subprocesses add to its span.
+                context = contextvars.copy_context()
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: context.run(func, span))
+        if self.state is not None and name in self.digests:
+            self.state.record(name, self.digests[name])
+        return result
+
+    async def admit(self, name, span):
+        '''AdmissionControl.admit(), waiting on the loop instead of blocking it'''
+        waited = self.admission.jitter(name)
+        bucket = self.admission.bucket(name)
+        await asyncio.sleep(waited)
+        if bucket is not None:
+            wait = bucket.reserve()
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            span['admission_wait_seconds'] = round(waited, 6)
+
+    async def run_phase_guarded(self, name):
+        '''
+        run_phase, with SystemExit (phases call exit() on failure) caught and
+        re-raised by run(), as it would otherwise escape the event loop.
+        '''
+        try:
+            return await self.run_phase(name)
+        except SystemExit as err:
+            return err
+
+    async def run(self):
+        self.validate()
+        self.skipped = self.plan_skips()
+        results = {}
+        running = {}
+        failure = None
+        while True:
+            if failure is None:
+                for name, (_, depends_on) in self.phases.items():
+                    if (name not in results and name not in running.values()
+                            and all(dep in results for dep in depends_on)):
+                        running[asyncio.ensure_future(self.run_phase_guarded(name))] = name
+            if not running:
+                break
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                name = running.pop(task)
+                try:
+                    result = task.result()
+                    if isinstance(result, SystemExit):
+                        raise result
+                    results[name] = result
+                except BaseException as err:  # pylint: disable=W0703
+                    if failure is None:
+                        failure = err
+        if failure is not None:
+            raise failure
+        return results
+
+class AsyncKickstartSalt(KickstartSalt):
+    '''
+    KickstartSalt whose bootstrap runs on an event loop: the download
+    streams over asyncio, yum and bootstrap-salt run as AsyncLiveProcesses,
+    and the file-writing phases run in the loop's thread pool. It takes the
+    same arguments as KickstartSalt but doesn't start on construction;
+    await run() instead. Several can run concurrently on one loop.
+    '''
+    def run_bootstrap(self):
+        '''Does nothing: the bootstrap starts when run() is awaited.'''
+
+    async def run(self):
+        scheduler = AsyncPhaseScheduler(report=self.report, state=self.state, force=self.force,
+                                        admission=self.admission)
+        self.add_phases(scheduler)
+        try:
+            await scheduler.run()
+        finally:
+            self.report.write()
+
+    async def run_live_async(self, command, timeout=None):
+        return await AsyncLiveProcess(command, timeout=timeout, **self.run_live_options).run()
+
+    async def phase_yum(self, span):
+        packages = self.salt_master_prerequisite_yum_packages
+        if packages is None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.write_yum_local_repo)
+        cmd = await loop.run_in_executor(None, self.yum_install_command, packages)
+        if cmd is not None:
+            returncode = await self.run_live_async(cmd)
+            if returncode != 0:
+                print(returncode)
+                exit(1)
+
+    async def phase_download(self, span):
+        loop = asyncio.get_running_loop()
+
+        def race(*args, **kwargs):
+            # The shared download phase runs in the thread pool; the race
+            #  itself runs on the loop.
+            return asyncio.run_coroutine_threadsafe(
+                AsyncBootstrapSaltDownloader.race(*args, **kwargs), loop).result()
+        context = contextvars.copy_context()
+        await loop.run_in_executor(None, lambda: context.run(self.fetch_bootstrap_salt,
+                                                             span, race))
+
+    async def phase_bootstrap(self, span):
+        if self.bootstrap_path is None:
+            self.exit_without_bootstrap_salt()
+        print(self.bootstrap_path + " hash matches bootstrap_salt_expected_hash.")
+        returncode = await self.run_live_async(self.bootstrap_command(),
+                                               timeout=self.bootstrap_salt_timeout)
+        if returncode != 0:
+            print(returncode)
+            exit(1)
+
+class AsyncKickstartSaltGoogleComputeEngine:
+    '''
+    Bootstraps from GCE metadata on an event loop: the metadata trees are
+    fetched concurrently with AsyncGCEMetadataWrapper (unless a sync
+    metadata_provider is passed), the configuration is resolved the same
+    way as KickstartSaltGoogleComputeEngine does, and an AsyncKickstartSalt
+    runs it.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, minimal=False, metadata_provider=None, metadata_url=None,
+                 config_path=KickstartSaltGoogleComputeEngine.CONFIG_PATH, force=False):
+        self.minimal = minimal
+        self.metadata_provider = metadata_provider
+        self.metadata_url = metadata_url
+        self.config_path = config_path
+        self.force = force
+        self.engine = None
+
+    async def run(self):
+        provider = self.metadata_provider
+        if provider is None:
+            try:
+                trees = await AsyncGCEMetadataWrapper(metadata_url=self.metadata_url).load_trees()
+            except AsyncGCEMetadataWrapper.request_errors as err:
+                print(err, end="\n\n")
+                print("This is likely not a GCE server.")
+                exit(1)
+            provider = StaticMetadataProvider(trees)
+        resolved = KickstartSaltGoogleComputeEngine(minimal=self.minimal,
+                                                    metadata_provider=provider,
+                                                    config_path=self.config_path,
+                                                    dump_config=True)
+        self.engine = AsyncKickstartSalt(force=self.force,
+                                         salt_minion_key=resolved.minion_key_metadata(),
+                                         **resolved.config['kwargs'])
+        await self.engine.run()
+        return self.engine
@@ -0,0 +1,493 @@
+# pylint: disable=C0111
+#!/usr/bin/python
+from kickstart_salt_imports import *
+import argparse
+import concurrent.futures
+import math
+from kickstart_salt import GCEMetadataWrapper, KickstartSaltGoogleComputeEngine
+from kickstart_salt_merge import JSONMerge
+from kickstart_salt_standin import MetadataStandInServer, MirrorStandInServer
+
+class ImportTimeBenchmark:
+    '''
+    Measures how long a fresh interpreter takes to import kickstart_salt.
+    "lazy" is what a minion pays today; "eager" also imports the heavy
+    modules (yaml, requests, pprint), which is what every run
+    paid while kickstart_salt_imports star-imported them.
+    '''
+    SCENARIOS = {
+        'lazy': "import kickstart_salt",
+        'eager': "import kickstart_salt, yaml, requests, pprint"
+    }
+
+    def __init__(self, runs=10):
+        self.runs = runs
+        self.here = os.path.dirname(os.path.abspath(__file__))
+
+    def measure(self, statement):
+        '''Returns the seconds a fresh interpreter spends running statement'''
+        code = ("import time; started = time.perf_counter(); {0}; "
+                "print(time.perf_counter() - started)").format(statement)
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=self.here)
+        return float(output.decode('utf-8').strip().splitlines()[-1])
+
+    def run(self):
+        results = {'runs': self.runs, 'scenarios': {}}
+        for name, statement in sorted(self.SCENARIOS.items()):
+            samples = sorted(self.measure(statement) for _ in range(self.runs))
+            results['scenarios'][name] = {
+                'median_ms': round(samples[len(samples) // 2] * 1000, 3),
+                'min_ms': round(samples[0] * 1000, 3),
+                'max_ms': round(samples[-1] * 1000, 3)
+            }
+        scenarios = results['scenarios']
+        results['speedup'] = round(
+            scenarios['eager']['median_ms'] / scenarios['lazy']['median_ms'], 2
+        )
+        return results
+
+def percentile(samples, percent):
+    '''Nearest-rank percentile of a non-empty list of numbers'''
+    ordered = sorted(samples)
+    rank = max(int(math.ceil(percent / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+def summarize(samples):
+    if not samples:
+        return None
+    return {
+        'min': round(min(samples), 6),
+        'p50': round(percentile(samples, 50), 6),
+        'p99': round(percentile(samples, 99), 6),
+        'max': round(max(samples), 6),
+        'mean': round(sum(samples) / float(len(samples)), 6)
+    }
+
+class SimulatedNode(KickstartSaltGoogleComputeEngine):
+    '''
+    A full kickstart_salt run confined to work_dir: resolv.conf, the
+    downloaded script, the resolved configuration, the phase report and
+    state are written there instead of to the host, and download urls are
+    tagged with the node's name so the mirror stand-in can attribute
+    requests to it.
+    '''
+    def __init__(self, name, work_dir, metadata_provider, minimal=False):
+        self.name = name
+        self.work_dir = work_dir
+        KickstartSaltGoogleComputeEngine.__init__(
+            self, minimal=minimal, metadata_provider=metadata_provider,
+            config_path=os.path.join(work_dir, "config.json")
+        )
+
+    def set_dns_linux(self, dns_entries, resolv_conf_path=None):
+        self.write_if_changed(os.path.join(self.work_dir, "resolv.conf"),
+                              ''.join("{0}\n".format(item) for item in dns_entries))
+
+    def tag_url(self, url):
+        parts = urllib_parse.urlsplit(url)
+        return urllib_parse.urlunsplit(parts._replace(path="/" + self.name + parts.path))
+
+    def generate_kickstart_salt_kwargs(self):
+        kwargs = KickstartSaltGoogleComputeEngine.generate_kickstart_salt_kwargs(self)
+        urls = kwargs['bootstrap_salt_download_url']
+        if isinstance(urls, list):
+            kwargs['bootstrap_salt_download_url'] = [self.tag_url(url) for url in urls]
+        else:
+            kwargs['bootstrap_salt_download_url'] = self.tag_url(urls)
+        kwargs['bootstrap_salt_save_path'] = os.path.join(self.work_dir, "bootstrap-salt.sh")
+        kwargs['kickstart_salt_report_path'] = os.path.join(self.work_dir, "report.json")
+        kwargs['kickstart_salt_state_path'] = os.path.join(self.work_dir, "state.json")
+        kwargs['bootstrap_salt_cache_dir'] = None
+        admission = kwargs.get('kickstart_salt_admission')
+        if admission and 'seed' not in admission:
+            # Simulated nodes share the host's name; seed each by its own.
+            kwargs['kickstart_salt_admission'] = dict(admission, seed=self.name)
+        return kwargs
+
+class FleetBenchmark:
+    '''
+    Boots nodes simulated kickstart_salt runs, each in its own process, at
+    the same time (or concurrency at a time) against one stand-in metadata
+    server and one stand-in mirror serving a stub bootstrap-salt.sh of
+    script_bytes. Reports time-to-bootstrap percentiles, per node request
+    counts, the bytes transferred and the mirror's peak load.
+
+    The mirror can throttle at mirror_max_rps, and admission (the
+    kickstart_salt_admission setting) is handed to every node.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, nodes=50, concurrency=None, metadata_latency=0.0,
+                 metadata_error_rate=0.0, mirror_latency=0.0, mirror_error_rate=0.0,
+                 script_bytes=300 * 1024, minimal=False, snapshot=True, seed=None,
+                 mirror_max_rps=None, admission=None):
+        self.nodes = nodes
+        self.concurrency = concurrency or nodes
+        self.metadata_latency = metadata_latency
+        self.metadata_error_rate = metadata_error_rate
+        self.mirror_latency = mirror_latency
+        self.mirror_error_rate = mirror_error_rate
+        self.script_bytes = script_bytes
+        self.minimal = minimal
+        self.snapshot = snapshot
+        self.seed = seed
+        self.mirror_max_rps = mirror_max_rps
+        self.admission = admission
+        self.here = os.path.dirname(os.path.abspath(__file__))
+
+    @staticmethod
+    def stub_script(size):
+        '''A shell script of about size bytes which does nothing'''
+        header = b"#!/bin/sh\n# kickstart_salt fleet benchmark stub\n"
+        footer = b"exit 0\n"
+        padding = max(size - len(header) - len(footer), 0)
+        line = b"#" * 79 + b"\n"
+        body = (line * (padding // len(line) + 1))[:padding]
+        return header + body + footer
+
+    @staticmethod
+    def metadata_trees(download_url, expected_hash, admission=None):
+        kickstart_salt_args = {
+            "bootstrap_salt_download_url": download_url,
+            "bootstrap_salt_expected_hash": expected_hash,
+            "bootstrap_salt_hash_type": "sha256",
+            "bootstrap_salt_json_args": {}
+        }
+        if admission is not None:
+            kickstart_salt_args["kickstart_salt_admission"] = admission
+        return {
+            "instance": {
+                "hostname": "fleet-node.c.kickstart-salt-bench.internal",
+                "attributes": {
+                    "dns": json.dumps({"entries": ["10.0.0.2"]}),
+                    "kickstart_salt_args": json.dumps(kickstart_salt_args)
+                }
+            },
+            "project": {
+                "projectId": "kickstart-salt-bench",
+                "attributes": {}
+            }
+        }
+
+    def run_node(self, name, metadata_url, work_dir):
+        '''Boots one node in a fresh interpreter; returns its result dict'''
+        pathlib.Path(work_dir).mkdir(parents=True)
+        command = [sys.executable, os.path.join(self.here, "kickstart_salt_bench.py"),
+                   "node", "--name", name, "--metadata-url", metadata_url,
+                   "--work-dir", work_dir]
+        if self.minimal:
+            command.append("--minimal")
+        if not self.snapshot:
+            command.append("--per-key")
+        with open(os.path.join(work_dir, "node.log"), 'wb') as log:
+            started = time.perf_counter()
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT,
+                                         cwd=self.here)
+            seconds = time.perf_counter() - started
+        result = {'name': name, 'returncode': returncode, 'seconds': seconds,
+                  'phases': []}
+        try:
+            with open(os.path.join(work_dir, "report.json")) as report_file:
+                result['phases'] = json.load(report_file)['phases']
+        except (IOError, ValueError):
+            pass
+        return result
+
+    def run(self):
+        script = self.stub_script(self.script_bytes)
+        mirror = MirrorStandInServer({"bootstrap-salt.sh": script},
+                                     latency=self.mirror_latency,
+                                     error_rate=self.mirror_error_rate,
+                                     seed=self.seed,
+                                     max_rps=self.mirror_max_rps).start()
+        metadata = MetadataStandInServer(
+            self.metadata_trees(mirror.url + "/bootstrap-salt.sh",
+                                hashlib.sha256(script).hexdigest(),
+                                admission=self.admission),
+            latency=self.metadata_latency,
+            error_rate=self.metadata_error_rate,
+            seed=self.seed
+        ).start()
+        work_root = tempfile.mkdtemp(prefix="kickstart_salt_fleet.")
+        root = metadata.url[:-len(metadata.ROOT) + 1]
+        started = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = []
+                for i in range(self.nodes):
+                    name = "node-{0}".format(i)
+                    futures.append(pool.submit(
+                        self.run_node, name,
+                        "{0}/{1}{2}".format(root, name, metadata.ROOT.rstrip('/')),
+                        os.path.join(work_root, name)
+                    ))
+                nodes = [future.result() for future in futures]
+            wall_seconds = time.perf_counter() - started
+        finally:
+            metadata.stop()
+            mirror.stop()
+            shutil.rmtree(work_root, ignore_errors=True)
+
+        booted = [node for node in nodes if node['returncode'] == 0]
+        phase_names = sorted({span['phase'] for node in booted for span in node['phases']})
+        return {
+            'nodes': self.nodes,
+            'concurrency': self.concurrency,
+            'settings': {
+                'metadata_latency': self.metadata_latency,
+                'metadata_error_rate': self.metadata_error_rate,
+                'mirror_latency': self.mirror_latency,
+                'mirror_error_rate': self.mirror_error_rate,
+                'mirror_max_rps': self.mirror_max_rps,
+                'admission': self.admission,
+                'script_bytes': len(script),
+                'minimal': self.minimal,
+                'snapshot': self.snapshot,
+                'python': platform.python_version()
+            },
+            'wall_seconds': round(wall_seconds, 6),
+            'failed': self.nodes - len(booted),
+            'time_to_bootstrap_seconds': summarize([node['seconds'] for node in booted]),
+            'phase_seconds': {
+                name: summarize([span['wall_seconds'] for node in booted
+                                 for span in node['phases'] if span['phase'] == name])
+                for name in phase_names
+            },
+            'requests': {
+                'metadata': metadata.requests,
+                'metadata_errors': metadata.errors,
+                'mirror': mirror.requests,
+                'mirror_errors': mirror.errors
+            },
+            'mirror_load': mirror.load(),
+            'requests_per_node': {
+                'metadata': summarize([metadata.requests_by_tag.get(node['name'], 0)
+                                       for node in nodes]),
+                'mirror': summarize([mirror.requests_by_tag.get(node['name'], 0)
+                                     for node in nodes])
+            },
+            'bytes': {
+                'metadata': metadata.bytes_sent,
+                'mirror': mirror.bytes_sent,
+                'mirror_per_node': summarize([mirror.bytes_by_tag.get(node['name'], 0)
+                                              for node in nodes])
+            }
+        }
+
+class MergeBenchmark:
+    '''
+    Times merging large, nested /etc/salt/master.d/ configurations across
+    layers: the first layer has `files` master.d files, each a tree `depth`
+    levels deep and `width` keys wide, and every later layer overrides
+    `override_fraction` of its leaves. JSONMerge is compared with
+    deep_merge, if it's installed, for time, peak memory and how many of
+    the first layer's dicts the result shares instead of copying.
+    deep_merge merges into its first argument, so it's timed both with
+    the copy that leaves the layers intact and, as deep_merge_in_place,
+    without it.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, files=20, depth=4, width=6, layers=2, override_fraction=0.01,
+                 runs=5, seed=None):
+        if layers < 2:
+            raise ValueError("layers can't be less than 2")
+        self.files = files
+        self.depth = depth
+        self.width = width
+        self.layers = layers
+        self.override_fraction = override_fraction
+        self.runs = runs
+        self.random = random.Random(seed)
+
+    def tree(self, depth):
+        '''A nested dict of master config-like values'''
+        if depth == 0:
+            return self.random.choice([
+                self.random.randint(0, 1 << 16),
+                "value-{0}".format(self.random.getrandbits(32)),
+                ["item-{0}".format(i) for i in range(3)]
+            ])
+        return {"key{0}".format(i): self.tree(depth - 1) for i in range(self.width)}
+
+    @staticmethod
+    def leaf_paths(tree, path=()):
+        if not isinstance(tree, dict):
+            return [path]
+        return [leaf for key, child in tree.items()
+                for leaf in MergeBenchmark.leaf_paths(child, path + (key,))]
+
+    @staticmethod
+    def dict_ids(tree):
+        '''ids of every dict in tree'''
+        ids = set()
+        pending = [tree]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, dict):
+                ids.add(id(node))
+                pending.extend(node.values())
+        return ids
+
+    def make_layers(self):
+        base = {"/etc/salt/master.d/": {"file{0}.conf".format(i): self.tree(self.depth)
+                                        for i in range(self.files)}}
+        leaves = self.leaf_paths(base)
+        layers = [("layer0", base)]
+        for index in range(1, self.layers):
+            override = {}
+            for path in self.random.sample(leaves,
+                                           max(1, int(len(leaves) * self.override_fraction))):
+                node = override
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = "override-{0}".format(index)
+            layers.append(("layer{0}".format(index), override))
+        return layers, len(leaves)
+
+    def measure(self, merge, layers, prepare=None):
+        '''Times merge(layers) over self.runs runs, then its peak memory'''
+        import tracemalloc
+        samples = []
+        for _ in range(self.runs):
+            args = prepare(layers) if prepare else layers
+            started = time.perf_counter()
+            merge(args)
+            samples.append(time.perf_counter() - started)
+        args = prepare(layers) if prepare else layers
+        tracemalloc.start()
+        try:
+            merged = merge(args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        samples.sort()
+        base_ids = self.dict_ids(args[0][1])
+        merged_ids = self.dict_ids(merged)
+        return merged, {
+            'median_ms': round(samples[len(samples) // 2] * 1000, 3),
+            'min_ms': round(samples[0] * 1000, 3),
+            'peak_kib': round(peak / 1024.0, 1),
+            'shared_dicts': len(merged_ids & base_ids),
+            'new_dicts': len(merged_ids - base_ids)
+        }
+
+    def run(self):
+        import copy
+        layers, leaves = self.make_layers()
+        results = {
+            'files': self.files, 'depth': self.depth, 'width': self.width,
+            'layers': self.layers, 'leaves': leaves,
+            'dicts': len(self.dict_ids(layers[0][1])),
+            'engines': {}
+        }
+        merged, results['engines']['kickstart_salt'] = self.measure(
+            lambda args: JSONMerge().merge(args).value, layers)
+        results['provenance_entries'] = len(JSONMerge().merge(layers).sources())
+        try:
+            import deep_merge
+        except ImportError:
+            return results
+        deep_merged, results['engines']['deep_merge'] = self.measure(
+            lambda args: deep_merge.merge(copy.deepcopy(args[0][1]),
+                                          *[value for _, value in args[1:]]),
+            layers)
+        _, results['engines']['deep_merge_in_place'] = self.measure(
+            lambda args: deep_merge.merge(*[value for _, value in args]), layers,
+            prepare=lambda args: [(args[0][0], copy.deepcopy(args[0][1]))] + args[1:])
+        results['results_match'] = merged == deep_merged
+        return results
+
+def write_results(results, output_path=None):
+    '''Prints results as json, and writes them to output_path if given'''
+    rendered = json.dumps(results, indent=2, sort_keys=True)
+    print(rendered)
+    if output_path is not None:
+        with open(output_path, 'w') as output_file:
+            output_file.write(rendered + '\n')
+
+if __name__ == '__main__':
+    # pylint: disable=C0103
+    parser = argparse.ArgumentParser(description="kickstart_salt benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    import_time = subparsers.add_parser("import-time",
+                                        help="time importing kickstart_salt")
+    import_time.add_argument("--runs", type=int, default=10)
+    import_time.add_argument("--output", help="also write results to this file")
+
+    fleet = subparsers.add_parser("fleet",
+                                  help="boot simulated nodes against stand-in "
+                                       "metadata and mirror servers")
+    fleet.add_argument("--nodes", type=int, default=50)
+    fleet.add_argument("--concurrency", type=int,
+                       help="nodes booting at once (default: all of them)")
+    fleet.add_argument("--metadata-latency", type=float, default=0.0)
+    fleet.add_argument("--metadata-error-rate", type=float, default=0.0)
+    fleet.add_argument("--mirror-latency", type=float, default=0.0)
+    fleet.add_argument("--mirror-error-rate", type=float, default=0.0)
+    fleet.add_argument("--mirror-max-rps", type=int,
+                       help="requests a second the mirror serves before "
+                            "answering 429 with a Retry-After")
+    fleet.add_argument("--admission", type=json.loads,
+                       help="kickstart_salt_admission json handed to every node")
+    fleet.add_argument("--script-bytes", type=int, default=300 * 1024)
+    fleet.add_argument("--minimal", action="store_true")
+    fleet.add_argument("--per-key", action="store_true",
+                       help="request metadata key by key instead of as a snapshot")
+    fleet.add_argument("--seed", type=int)
+    fleet.add_argument("--output", help="also write results to this file")
+
+    merge = subparsers.add_parser("merge",
+                                  help="time merging large nested master.d "
+                                       "configurations across layers")
+    merge.add_argument("--files", type=int, default=20)
+    merge.add_argument("--depth", type=int, default=4)
+    merge.add_argument("--width", type=int, default=6)
+    merge.add_argument("--layers", type=int, default=2,
+                       help="layers merged, e.g. 3 for org -> project -> instance")
+    merge.add_argument("--override-fraction", type=float, default=0.01)
+    merge.add_argument("--runs", type=int, default=5)
+    merge.add_argument("--seed", type=int)
+    merge.add_argument("--output", help="also write results to this file")
+
+    node = subparsers.add_parser("node", help="boot one simulated node (used by fleet)")
+    node.add_argument("--name", required=True)
+    node.add_argument("--metadata-url", required=True)
+    node.add_argument("--work-dir", required=True)
+    node.add_argument("--minimal", action="store_true")
+    node.add_argument("--per-key", action="store_true")
+
+    cli_args = parser.parse_args()
+    if cli_args.benchmark == "import-time":
+        write_results(ImportTimeBenchmark(runs=cli_args.runs).run(),
+                      cli_args.output)
+    elif cli_args.benchmark == "fleet":
+        write_results(FleetBenchmark(nodes=cli_args.nodes,
+                                     concurrency=cli_args.concurrency,
+                                     metadata_latency=cli_args.metadata_latency,
+                                     metadata_error_rate=cli_args.metadata_error_rate,
+                                     mirror_latency=cli_args.mirror_latency,
+                                     mirror_error_rate=cli_args.mirror_error_rate,
+                                     script_bytes=cli_args.script_bytes,
+                                     minimal=cli_args.minimal,
+                                     snapshot=not cli_args.per_key,
+                                     seed=cli_args.seed,
+                                     mirror_max_rps=cli_args.mirror_max_rps,
+                                     admission=cli_args.admission).run(),
+                      cli_args.output)
+    elif cli_args.benchmark == "merge":
+        write_results(MergeBenchmark(files=cli_args.files,
+                                     depth=cli_args.depth,
+                                     width=cli_args.width,
+                                     layers=cli_args.layers,
+                                     override_fraction=cli_args.override_fraction,
+                                     runs=cli_args.runs,
+                                     seed=cli_args.seed).run(),
+                      cli_args.output)
+    elif cli_args.benchmark == "node":
+        SimulatedNode(cli_args.name, cli_args.work_dir,
+                      GCEMetadataWrapper(metadata_url=cli_args.metadata_url,
+                                         snapshot=not cli_args.per_key,
+                                         minimal=cli_args.minimal),
+                      minimal=cli_args.minimal)
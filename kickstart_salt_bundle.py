@@ -0,0 +1,255 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+# tarfile and fnmatch are only needed, and only imported, when a bundle is used.
+import fnmatch
+import io
+import tarfile
+from kickstart_salt_keys import MinionKeys
+
+class BootstrapBundle:
+    '''
+    One .tar.gz holding everything an offline bootstrap needs, built at
+    image-build time: the verified bootstrap script, an optional local
+    package repo (repo/) with the GPG keys its packages are signed with,
+    and the resolved configuration. manifest.json records the sha256 of
+    every other member, checked while extracting. It can also carry
+    pre-generated minion public keys (keys/, see MinionKeys), for masters
+    to accept, and the private keys of the minions it is built for.
+
+    A bundle is used either as the archive, which is extracted to
+    extract_dir once, or as a directory it was already extracted (or
+    mounted) to.
+    '''
+    VERSION = 1
+    MANIFEST_NAME = "manifest.json"
+    REPO_DIR = "repo"
+    KEYS_DIR = "keys"
+    # Names GPG keys are published under at the top of a yum repo.
+    GPG_KEY_PATTERNS = ("RPM-GPG-KEY*", "*GPG-KEY*", "*GPG-PUBKEY*", "*.gpg", "*.asc")
+    EXTRACT_DIR = ("c:\\kickstart_salt\\bundle" if platform.system() == "Windows"
+                   else "/var/cache/kickstart_salt/bundle")
+    # Records which archive extract_dir holds, so it's extracted only once.
+    SOURCE_NAME = ".source.json"
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+
+    def script_path(self):
+        return os.path.join(self.path, self.manifest['script'])
+
+    def repo_path(self):
+        '''The bundle's package repo, or None if it has none'''
+        if not self.manifest.get('repo'):
+            return None
+        return os.path.join(self.path, self.REPO_DIR)
+
+    def gpg_key_paths(self):
+        '''The GPG keys the bundle's packages are checked against'''
+        return [os.path.join(self.path, *name.split('/'))
+                for name in self.manifest.get('gpg_keys', [])]
+
+    def keys_path(self):
+        '''The bundle's minion keys directory, or None if it has none'''
+        if not self.manifest.get('keys'):
+            return None
+        return os.path.join(self.path, self.KEYS_DIR)
+
+    def config(self):
+        '''The resolved configuration the bundle was built with'''
+        return self.manifest['config']
+
+    @staticmethod
+    def file_digest(file_path):
+        h = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def find_gpg_keys(repo_dir):
+        '''The files at the top of repo_dir named like GPG keys, sorted'''
+        try:
+            names = os.listdir(repo_dir)
+        except OSError:
+            return []
+        return sorted(os.path.join(repo_dir, name) for name in names
+                      if os.path.isfile(os.path.join(repo_dir, name)) and
+                      any(fnmatch.fnmatch(name, pattern)
+                          for pattern in BootstrapBundle.GPG_KEY_PATTERNS))
+
+    # pylint: disable=R0913
+    @staticmethod
+    def build(output_path, config, script_path, packages_dir=None, keys_dir=None,
+              gpg_keys=None, private_keys=None):
+        '''
+        Writes a bundle of script_path, the files under packages_dir (a yum
+        repo, with its repodata), the public keys under keys_dir and config
+        to output_path. Returns the manifest.
+
+        A bundle is usually copied to many machines, so the only private
+        keys in it are those of the minion ids in private_keys: the minions
+        that bundle (or the image it's baked into) is for.
+
+        The repo's packages are checked against the GPG keys at the top of
+        packages_dir (see GPG_KEY_PATTERNS) and the key files in gpg_keys,
+        which are added to repo/; a repo without any raises ValueError.
+        '''
+        if config is None:
+            raise ValueError("config can't be None")
+        if script_path is None:
+            raise ValueError("script_path can't be None")
+        members = {"bootstrap-salt" + os.path.splitext(script_path)[1]: script_path}
+        if packages_dir is not None:
+            for root, dirs, files in os.walk(packages_dir):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    relative = os.path.relpath(path, packages_dir).replace(os.sep, '/')
+                    members[BootstrapBundle.REPO_DIR + '/' + relative] = path
+        private_keys = sorted(set(private_keys or []))
+        if private_keys and keys_dir is None:
+            raise ValueError("keys_dir can't be None when private_keys are bundled")
+        if keys_dir is not None:
+            public_ids = MinionKeys.public_keys(keys_dir)
+            for minion_id in private_keys:
+                if minion_id not in public_ids or MinionKeys.load(keys_dir, minion_id) is None:
+                    raise ValueError("no key pair for {0} in {1}".format(minion_id, keys_dir))
+            for minion_id in public_ids:
+                names = [MinionKeys.PUB_NAME]
+                if minion_id in private_keys:
+                    names.append(MinionKeys.PEM_NAME)
+                for name in names:
+                    members["{0}/{1}/{2}".format(BootstrapBundle.KEYS_DIR, minion_id, name)] = \
+                        os.path.join(keys_dir, minion_id, name)
+        key_names = []
+        if packages_dir is not None:
+            key_names = [BootstrapBundle.REPO_DIR + '/' + os.path.basename(path)
+                         for path in BootstrapBundle.find_gpg_keys(packages_dir)]
+            for path in gpg_keys or []:
+                name = BootstrapBundle.REPO_DIR + '/' + os.path.basename(path)
+                members[name] = path
+                key_names.append(name)
+            if not key_names:
+                raise ValueError("no GPG key for the packages in {0}".format(packages_dir))
+
+        manifest = {
+            'version': BootstrapBundle.VERSION,
+            'created': time.time(),
+            'script': [name for name in members if name.startswith("bootstrap-salt")][0],
+            'repo': packages_dir is not None,
+            'gpg_keys': sorted(set(key_names)),
+            'keys': keys_dir is not None,
+            'private_keys': private_keys,
+            'config': config,
+            'files': {name: BootstrapBundle.file_digest(path)
+                      for name, path in members.items()}
+        }
+        manifest_data = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(output_path) + ".",
+                                            dir=output_dir)
+        os.close(handle)
+        try:
+            with tarfile.open(tmp_path, 'w:gz') as tar:
+                # The manifest goes first, so extraction can check as it goes.
+                info = tarfile.TarInfo(BootstrapBundle.MANIFEST_NAME)
+                info.size = len(manifest_data)
+                info.mtime = int(manifest['created'])
+                tar.addfile(info, fileobj=io.BytesIO(manifest_data))
+                for name, path in members.items():
+                    tar.add(path, arcname=name, recursive=False)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return manifest
+
+    @staticmethod
+    def open(path, extract_dir=None):
+        '''
+        Returns the BootstrapBundle at path: a directory holding an extracted
+        bundle, or an archive, which is extracted to extract_dir unless it
+        already holds it. Exits if the bundle is damaged.
+        '''
+        if path is None:
+            raise ValueError("path can't be None")
+        if os.path.isdir(path):
+            try:
+                with open(os.path.join(path, BootstrapBundle.MANIFEST_NAME)) as manifest_file:
+                    return BootstrapBundle(path, json.load(manifest_file))
+            except (IOError, ValueError) as err:
+                print("{0} isn't a kickstart_salt bundle: {1}".format(path, err))
+                exit(1)
+
+        extract_dir = extract_dir or BootstrapBundle.EXTRACT_DIR
+        stat = os.stat(path)
+        source = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        try:
+            with open(os.path.join(extract_dir, BootstrapBundle.SOURCE_NAME)) as source_file:
+                if json.load(source_file) == source:
+                    return BootstrapBundle.open(extract_dir)
+        except (IOError, ValueError):
+            pass
+
+        try:
+            manifest = BootstrapBundle.extract(path, extract_dir)
+        except (IOError, ValueError, tarfile.TarError) as err:
+            print("Couldn't extract bundle {0}: {1}".format(path, err))
+            exit(1)
+        with open(os.path.join(extract_dir, BootstrapBundle.SOURCE_NAME), 'w') as source_file:
+            json.dump(source, source_file)
+        return BootstrapBundle(extract_dir, manifest)
+
+    @staticmethod
+    def extract(path, extract_dir):
+        '''
+        Extracts the archive at path into extract_dir, hashing every member
+        as it's written. Raises ValueError for unsafe names, members missing
+        from the manifest, or content which doesn't match it.
+        '''
+        if os.path.isdir(extract_dir):
+            shutil.rmtree(extract_dir)
+        pathlib.Path(extract_dir).mkdir(parents=True)
+        root = os.path.realpath(extract_dir)
+        manifest = None
+        with tarfile.open(path, 'r:gz') as tar:
+            for member in tar:
+                if manifest is None:
+                    if member.name != BootstrapBundle.MANIFEST_NAME:
+                        raise ValueError("the manifest isn't the first member")
+                    manifest = json.load(tar.extractfile(member))
+                    if manifest.get('version') != BootstrapBundle.VERSION:
+                        raise ValueError("unsupported bundle version {0}".format(
+                            manifest.get('version')))
+                    with open(os.path.join(extract_dir, member.name), 'w') as manifest_file:
+                        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+                    continue
+                target = os.path.realpath(os.path.join(extract_dir, member.name))
+                if not member.isfile() or not target.startswith(root + os.sep):
+                    raise ValueError("unsafe member {0}".format(member.name))
+                expected = manifest['files'].get(member.name)
+                if expected is None:
+                    raise ValueError("{0} isn't in the manifest".format(member.name))
+                pathlib.Path(os.path.dirname(target)).mkdir(parents=True, exist_ok=True)
+                h = hashlib.sha256()
+                source = tar.extractfile(member)
+                # Private until chmod-ed to the member's mode (keys are 0600).
+                with os.fdopen(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                               'wb') as f:
+                    for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                        h.update(chunk)
+                        f.write(chunk)
+                os.chmod(target, member.mode & 0o755)
+                if h.hexdigest() != expected:
+                    raise ValueError("{0} doesn't match the manifest".format(member.name))
+        if manifest is None:
+            raise ValueError("the bundle is empty")
+        missing = [name for name in manifest['files']
+                   if not os.path.isfile(os.path.join(extract_dir, name))]
+        if missing:
+            raise ValueError("missing {0}".format(', '.join(missing)))
+        return manifest
@@ -0,0 +1,572 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+import hmac
+import queue
+
+class BootstrapSaltDownloader:
+    '''
+    Streams downloads to disk while hashing them, so a file is read exactly
+    once and never held in memory as a whole. Several mirrors can be raced
+    against each other; interrupted transfers are resumed with HTTP Range.
+    '''
+    CHUNK_SIZE = 1024 * 1024
+    # Responses which mean "busy, come back later" rather than "broken".
+    THROTTLE_STATUSES = (429, 503)
+
+    @staticmethod
+    def new_hash(hash_type):
+        try:
+            return getattr(hashlib, hash_type)()
+        except (AttributeError, TypeError):
+            msg = "{0} is not a valid hash type."
+            raise AttributeError(msg.format(hash_type))
+
+    @staticmethod
+    def new_hashes(hash_type, hash_types=()):
+        '''Returns {hash type: new hash} for hash_type and every one of hash_types'''
+        return {name: BootstrapSaltDownloader.new_hash(name)
+                for name in set(hash_types) | {hash_type}}
+
+    @staticmethod
+    def copy_hashed(source_path, save_path, hash_type, hash_types=()):
+        '''
+        Copies source_path to a temp file beside save_path, hashing it with
+        hash_type and every one of hash_types as it's copied, so it's read
+        only once. Returns (temp path, {hash type: hex digest}); the caller
+        renames or removes the temp file.
+        '''
+        hashes = BootstrapSaltDownloader.new_hashes(hash_type, hash_types)
+        tmp_path = BootstrapSaltDownloader.temp_path(save_path)
+        try:
+            with open(source_path, 'rb') as source, open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: source.read(BootstrapSaltDownloader.CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    for h in hashes.values():
+                        h.update(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, {name: h.hexdigest() for name, h in hashes.items()}
+
+    @staticmethod
+    def temp_path(save_path):
+        '''Returns a unique temp file path next to save_path'''
+        directory, name = os.path.split(os.path.abspath(save_path))
+        handle, tmp_path = tempfile.mkstemp(prefix="." + name + ".",
+                                            suffix=".tmp",
+                                            dir=directory)
+        os.close(handle)
+        return tmp_path
+
+    @staticmethod
+    def expected_length(response):
+        '''Returns the full size of the file behind response, if known'''
+        content_range = response.headers.get('Content-Range')
+        if response.status == 206 and content_range:
+            total = content_range.rsplit('/', 1)[-1]
+            return int(total) if total.isdigit() else None
+        content_length = response.headers.get('Content-Length')
+        return int(content_length) if content_length else None
+
+    @staticmethod
+    def retry_delay(headers, attempt, max_retry_after=120):
+        '''
+        Seconds to wait before retry number attempt of a throttled request:
+        the server's Retry-After (seconds or an HTTP date) plus up to half as
+        much again, so throttled clients don't all return at once, or else
+        exponential backoff with full jitter. Capped at max_retry_after.
+        '''
+        value = ''
+        if headers is not None:
+            # The asyncio client lower-cases header names.
+            value = (headers.get('Retry-After') or headers.get('retry-after') or '').strip()
+        retry_after = None
+        if value.isdigit():
+            retry_after = float(value)
+        elif value:
+            import email.utils
+            parsed = email.utils.parsedate_tz(value)
+            if parsed is not None:
+                retry_after = max(email.utils.mktime_tz(parsed) - time.time(), 0.0)
+        if retry_after is None:
+            delay = random.uniform(0, 0.5 * 2 ** attempt)
+        else:
+            delay = retry_after + random.uniform(0, retry_after / 2.0)
+        return min(delay, max_retry_after)
+
+    # pylint: disable=R0913,R0914
+    @staticmethod
+    def fetch_mirror(url, save_path, hash_type, headers=None, cancel=None,
+                     timeout=30, retries=3, max_retry_after=120, hash_types=()):
+        '''
+        Streams url into a temp file beside save_path, hashing as bytes
+        arrive with hash_type and every one of hash_types. A transfer which
+        breaks off is resumed from the last byte written with a Range
+        request (guarded by If-Range, so a file which changed in the
+        meantime is fetched again from the start). A 429 or 503 is retried
+        after the mirror's Retry-After (see retry_delay()).
+
+        Returns a dict with a status of "ok", "not_modified", "failed" or
+        "cancelled"; "ok" results carry the temp path, the hash_type digest,
+        every digest (digests) and the size.
+        '''
+        cancel = cancel or threading.Event()
+        result = {'url': url, 'status': 'failed', 'path': None}
+        hashes = BootstrapSaltDownloader.new_hashes(hash_type, hash_types)
+        tmp_path = BootstrapSaltDownloader.temp_path(save_path)
+        size = 0
+        attempt = 0
+        validator = None
+        with open(tmp_path, 'wb') as f:
+            while not cancel.is_set():
+                request_headers = dict(headers or {})
+                if size:
+                    request_headers['Range'] = 'bytes={0}-'.format(size)
+                    if validator:
+                        request_headers['If-Range'] = validator
+                try:
+                    response = urllib.urlopen(
+                        urllib.Request(url, headers=request_headers),
+                        timeout=timeout
+                    )
+                    if response.status != 206 and size:
+                        # The mirror ignored the Range, so start over.
+                        f.seek(0)
+                        f.truncate()
+                        hashes = BootstrapSaltDownloader.new_hashes(hash_type, hash_types)
+                        size = 0
+                    if not size:
+                        result['headers'] = response.headers
+                        validator = (response.headers.get('ETag') or
+                                     response.headers.get('Last-Modified'))
+                    total = BootstrapSaltDownloader.expected_length(response)
+                    # read1 returns whatever has arrived, so a slow mirror
+                    #  notices cancellation without filling a whole chunk.
+                    for chunk in iter(lambda: response.read1(BootstrapSaltDownloader.CHUNK_SIZE), b""):
+                        if cancel.is_set():
+                            break
+                        f.write(chunk)
+                        for h in hashes.values():
+                            h.update(chunk)
+                        size += len(chunk)
+                    if cancel.is_set():
+                        break
+                    if total is not None and size < total:
+                        raise IOError("connection closed after {0} of {1} bytes".format(size, total))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    digests = {name: h.hexdigest() for name, h in hashes.items()}
+                    result.update(status='ok', path=tmp_path, digest=digests[hash_type],
+                                  digests=digests, size=size)
+                    return result
+                except urllib.HTTPError as err:
+                    err.close()
+                    if err.code == 304:
+                        result['status'] = 'not_modified'
+                    elif (err.code in BootstrapSaltDownloader.THROTTLE_STATUSES and
+                          attempt < retries):
+                        attempt += 1
+                        delay = BootstrapSaltDownloader.retry_delay(err.headers, attempt,
+                                                                    max_retry_after)
+                        logging.warning("%s returned HTTP %s, retrying in %.1f seconds",
+                                        url, err.code, delay)
+                        cancel.wait(delay)
+                        continue
+                    else:
+                        logging.warning("%s returned HTTP %s", url, err.code)
+                    break
+                except (urllib.URLError, OSError, http.client.HTTPException) as err:
+                    attempt += 1
+                    if attempt > retries:
+                        logging.warning("Giving up on %s: %s", url, err)
+                        break
+                    logging.warning("Resuming %s at byte %s after: %s", url, size, err)
+                    time.sleep(min(0.1 * 2 ** attempt, 2))
+
+        if cancel.is_set():
+            result['status'] = 'cancelled'
+        os.remove(tmp_path)
+        return result
+
+    # pylint: disable=R0913
+    @staticmethod
+    def race(urls, save_path, hash_type, expected_hash=None, cache=None,
+             timeout=30, retries=3, max_retry_after=120, hash_types=()):
+        '''
+        Downloads from every url at once. The first file that matches
+        expected_hash (or simply the first to finish, if there is no
+        expected_hash) is renamed into save_path and the other transfers are
+        cancelled. Returns the winning result dict, or None; its digests
+        hold hash_type's and hash_types' digests of the file.
+        '''
+        cancel = threading.Event()
+        lock = threading.Lock()
+        results = queue.Queue()
+
+        def worker(url):
+            headers = {}
+            if cache is not None:
+                headers = cache.conditional_headers(url)
+            try:
+                result = BootstrapSaltDownloader.fetch_mirror(
+                    url, save_path, hash_type, headers=headers, cancel=cancel,
+                    timeout=timeout, retries=retries, max_retry_after=max_retry_after,
+                    hash_types=hash_types
+                )
+            except Exception as err:  # pylint: disable=W0703
+                # Report it like a failed mirror, so race() isn't left waiting.
+                logging.warning("Downloading %s failed: %r", url, err)
+                result = {'url': url, 'status': 'failed', 'path': None}
+            with lock:
+                if cancel.is_set():
+                    if result['path'] is not None:
+                        os.remove(result['path'])
+                    return
+                results.put(result)
+
+        for url in urls:
+            thread = threading.Thread(target=worker, args=(url,))
+            thread.daemon = True
+            thread.start()
+
+        winner = None
+        for _ in urls:
+            result = results.get()
+            if BootstrapSaltDownloader.settle(result, save_path, expected_hash, cache,
+                                              hash_types):
+                winner = result
+                break
+
+        with lock:
+            cancel.set()
+        while not results.empty():
+            result = results.get_nowait()
+            if result['path'] is not None:
+                os.remove(result['path'])
+        return winner
+
+    # pylint: disable=R0913
+    @staticmethod
+    def settle(result, save_path, expected_hash=None, cache=None, hash_types=()):
+        '''
+        Returns True if a mirror's result wins the race: an "ok" copy which
+        matches expected_hash is renamed into save_path, and a
+        "not_modified" one is copied out of cache. A copy which loses has
+        its temp file removed. Shared by the sync and asyncio races.
+        '''
+        if result['status'] == 'not_modified':
+            digests = {}
+            # Without a cache (as for peers) there is nothing to fall back on.
+            if cache is not None and cache.fetch_not_modified(
+                    result['url'], save_path, expected_hash,
+                    hash_types=hash_types, digests=digests):
+                result['digests'] = digests
+                return True
+        elif result['status'] == 'ok':
+            if (expected_hash is None or
+                    BootstrapSaltVerifier.digest_matches(result['digest'], expected_hash)):
+                os.replace(result['path'], save_path)
+                return True
+            logging.warning("%s served %s, which doesn't match the expected hash",
+                            result['url'], result['digest'])
+            os.remove(result['path'])
+        return False
+
+class BootstrapSaltVerifier:
+    '''
+    Checks a file against several expected digests at once and, optionally,
+    a detached signature made with a pinned public key. Digests computed
+    while the file was downloaded are used as they are; otherwise the file
+    is mapped into memory and read once: with more than one algorithm,
+    each digest is computed in its own thread over the same pages (hashlib
+    releases the GIL while hashing). Digests are compared in constant time,
+    and the signature is checked by openssl against the digest already
+    computed.
+    '''
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, expected_hashes=None, signature=None, public_key_path=None,
+                 signature_hash_type="sha256"):
+        self.expected_hashes = dict(expected_hashes or {})
+        self.signature = signature
+        self.public_key_path = public_key_path
+        self.signature_hash_type = signature_hash_type
+        if signature is not None and public_key_path is None:
+            raise ValueError("public_key_path can't be None")
+        # Fail on unknown algorithms before touching the file.
+        for hash_type in self.hash_types():
+            BootstrapSaltDownloader.new_hash(hash_type)
+
+    @staticmethod
+    def digest_matches(digest, expected):
+        '''Compares hex digests in constant time, ignoring case'''
+        return hmac.compare_digest(str(digest).lower().encode('utf-8'),
+                                   str(expected).lower().encode('utf-8'))
+
+    def hash_types(self):
+        hash_types = set(self.expected_hashes)
+        if self.signature is not None:
+            hash_types.add(self.signature_hash_type)
+        return sorted(hash_types)
+
+    def digests(self, file_path):
+        '''Returns ({hash_type: hex digest}, size) from one pass over file_path'''
+        # Only needed when no digests were computed while downloading.
+        import concurrent.futures
+        import mmap
+        hashes = {hash_type: BootstrapSaltDownloader.new_hash(hash_type)
+                  for hash_type in self.hash_types()}
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+
+                def feed(h):
+                    for offset in range(0, size, self.CHUNK_SIZE):
+                        h.update(view[offset:offset + self.CHUNK_SIZE])
+
+                try:
+                    if len(hashes) > 1:
+                        with concurrent.futures.ThreadPoolExecutor(
+                                max_workers=len(hashes)) as pool:
+                            list(pool.map(feed, hashes.values()))
+                    else:
+                        for h in hashes.values():
+                            feed(h)
+                finally:
+                    view.release()
+                    mapped.close()
+        return {hash_type: h.hexdigest() for hash_type, h in hashes.items()}, size
+
+    def verify_signature(self, digest):
+        '''
+        Checks self.signature over the hex digest with openssl pkeyutl.
+        Returns "ok", "failed", or "error" if openssl couldn't be run.
+        '''
+        tmp_dir = tempfile.mkdtemp(prefix="kickstart_salt_verify.")
+        try:
+            signature_path = os.path.join(tmp_dir, "signature")
+            digest_path = os.path.join(tmp_dir, "digest")
+            with open(signature_path, 'wb') as signature_file:
+                signature_file.write(self.signature)
+            with open(digest_path, 'wb') as digest_file:
+                digest_file.write(bytes.fromhex(digest))
+            try:
+                proc = subprocess.run(
+                    ["openssl", "pkeyutl", "-verify", "-pubin",
+                     "-inkey", self.public_key_path,
+                     "-sigfile", signature_path,
+                     "-in", digest_path,
+                     "-pkeyopt", "digest:" + self.signature_hash_type],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT
+                )
+            except OSError as err:
+                logging.warning("Couldn't run openssl: %s", err)
+                return 'error'
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if proc.returncode != 0:
+            logging.warning("openssl: %s", proc.stdout.decode('utf-8', 'replace').strip())
+            return 'failed'
+        return 'ok'
+
+    def verify(self, file_path, digests=None):
+        '''
+        Returns a dict with the digests, which of them matched, the
+        signature status (None if there is no signature), the size and the
+        hashing throughput; "ok" is True only if everything checked out.
+
+        digests ({hash type: hex digest}), if given, are digests of
+        file_path already computed while it was downloaded or copied. If
+        they include every hash type needed, the file isn't read again, and
+        hash_seconds is 0.
+        '''
+        known = digests or {}
+        started = time.perf_counter()
+        if all(hash_type in known for hash_type in self.hash_types()):
+            digests = {hash_type: known[hash_type] for hash_type in self.hash_types()}
+            size = os.path.getsize(file_path)
+            seconds = 0.0
+        else:
+            digests, size = self.digests(file_path)
+            seconds = time.perf_counter() - started
+        matches = {
+            hash_type: self.digest_matches(digests[hash_type], expected)
+            for hash_type, expected in self.expected_hashes.items()
+        }
+        signature = None
+        if self.signature is not None:
+            signature = self.verify_signature(digests[self.signature_hash_type])
+        return {
+            'path': file_path,
+            'ok': all(matches.values()) and signature in (None, 'ok'),
+            'size': size,
+            'digests': digests,
+            'matches': matches,
+            'signature': signature,
+            'hash_seconds': round(seconds, 6),
+            'throughput_mib_s': round(size / (1024.0 * 1024.0) / seconds, 3) if seconds else None
+        }
+
+class BootstrapSaltCache:
+    '''
+    Content-addressed, on-disk cache for bootstrap-salt.sh/.ps1.
+
+    Each copy is stored as <hash_type>-<digest> inside cache_dir, so a copy
+    matching bootstrap_salt_expected_hash can be used without touching the
+    network. index.json remembers the ETag and Last-Modified headers of every
+    url, which are replayed as conditional request headers.
+    '''
+    INDEX_NAME = "index.json"
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+        if cache_dir is None:
+            raise ValueError("cache_dir can't be None")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, self.INDEX_NAME)
+
+    @staticmethod
+    def digest(file_path, hash_type):
+        '''Returns the hex digest of file_path'''
+        h = BootstrapSaltDownloader.new_hash(hash_type)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(BootstrapSaltDownloader.CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def object_path(self, hash_type, digest):
+        return os.path.join(self.cache_dir, "{0}-{1}".format(hash_type, digest))
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    # pylint: disable=R0913
+    def fetch(self, hash_type, digest, save_path, hash_types=(), digests=None):
+        '''
+        Copies the cached object for digest to save_path, verifying it as
+        it's copied. Returns True on a hit; corrupt objects are dropped and
+        count as a miss. If a digests dict is passed, it's updated with the
+        copy's digests for hash_type and hash_types.
+        '''
+        if hash_type is None or digest is None:
+            return False
+        # Objects are named by their lower-case hex digest.
+        digest = digest.lower()
+        object_path = self.object_path(hash_type, digest)
+        if not os.path.isfile(object_path):
+            return False
+        tmp_path, copied = BootstrapSaltDownloader.copy_hashed(object_path, save_path,
+                                                               hash_type, hash_types)
+        if copied[hash_type] != digest:
+            logging.warning("Removing corrupt cache object %s", object_path)
+            os.remove(tmp_path)
+            os.remove(object_path)
+            return False
+        # Bump the mtime so eviction treats this object as recently used.
+        os.utime(object_path, None)
+        os.replace(tmp_path, save_path)
+        if digests is not None:
+            digests.update(copied)
+        return True
+
+    def conditional_headers(self, url):
+        '''Returns If-None-Match/If-Modified-Since headers for url, if cached'''
+        entry = self.read_index().get(url)
+        headers = {}
+        if entry is None or not os.path.isfile(
+                self.object_path(entry['hash_type'], entry['digest'])):
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # pylint: disable=R0913
+    def fetch_not_modified(self, url, save_path, expected_hash=None, hash_types=(),
+                           digests=None):
+        '''
+        Handles a 304 for url by copying the object it was last saved as,
+        unless that object doesn't match expected_hash. hash_types and
+        digests are as for fetch().
+        '''
+        entry = self.read_index().get(url)
+        if entry is None:
+            return False
+        if (expected_hash is not None and
+                not BootstrapSaltVerifier.digest_matches(entry['digest'], expected_hash)):
+            return False
+        return self.fetch(entry['hash_type'], entry['digest'], save_path,
+                          hash_types=hash_types, digests=digests)
+
+    # pylint: disable=R0913
+    def store(self, url, file_path, hash_type, headers=None, digest=None):
+        '''
+        Adds file_path to the cache under its digest, records url's
+        validators and evicts the least recently used objects if the cache
+        grew beyond max_bytes. Returns the digest.
+        '''
+        headers = headers or {}
+        # The asyncio client lower-cases header names.
+        etag = headers.get('ETag') or headers.get('etag')
+        last_modified = headers.get('Last-Modified') or headers.get('last-modified')
+        if digest is None:
+            digest = self.digest(file_path, hash_type)
+        object_path = self.object_path(hash_type, digest)
+        if not os.path.isfile(object_path):
+            tmp_path = object_path + ".tmp"
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, object_path)
+
+        index = self.read_index()
+        index[url] = {
+            'hash_type': hash_type,
+            'digest': digest,
+            'etag': etag,
+            'last_modified': last_modified
+        }
+        self.write_index(index)
+        self.evict()
+        return digest
+
+    def evict(self):
+        '''Removes the least recently used objects until under max_bytes'''
+        if not self.max_bytes:
+            return
+        objects = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name == self.INDEX_NAME or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            objects.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in objects)
+        evicted = set()
+        for _, size, path in sorted(objects):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            evicted.add(os.path.basename(path))
+            total -= size
+
+        if evicted:
+            index = self.read_index()
+            index = {
+                url: entry for url, entry in index.items()
+                if "{0}-{1}".format(entry['hash_type'], entry['digest']) not in evicted
+            }
+            self.write_index(index)
@@ -1,18 +1,29 @@
 from __future__ import print_function
+import abc
 import os
 import subprocess
 import hashlib
 import json
-import pprint
 import sys
 import platform
 import pathlib
+import shutil
+import tempfile
+import http.client
+import contextlib
+import re
 import logging
-import yaml
-import deep_merge
-import requests
+import threading
+import time
+import contextvars
+import random
+# Everything else (yaml, requests, http.server, concurrent.futures, ...) is
+#  imported by the module, phase or CLI branch which uses it, so runs which
+#  never need it (e.g. minions) don't pay for importing it.
 
 if sys.version_info[0] < 3:
     import urllib
+    import urllib as urllib_parse
 else:
     import urllib.request as urllib
+    import urllib.parse as urllib_parse
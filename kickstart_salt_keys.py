@@ -0,0 +1,173 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+import concurrent.futures
+
+class MinionKeys:
+    '''
+    Salt minion key pairs generated ahead of time, in batches, so that new
+    minions don't generate keys at first start and masters don't have to
+    autosign them. keys_dir holds one directory per minion id, with
+    minion.pem, minion.pub and kickstart_salt_minion_key.json (both keys,
+    ready to be set as the kickstart_salt_minion_key instance attribute).
+    '''
+    PEM_NAME = "minion.pem"
+    PUB_NAME = "minion.pub"
+    METADATA_NAME = "kickstart_salt_minion_key.json"
+    MINION_PKI_DIR = "/etc/salt/pki/minion"
+    MASTER_PKI_DIR = "/etc/salt/pki/master"
+
+    def __init__(self, keys_dir, bits=2048, max_workers=None, openssl="openssl"):
+        if keys_dir is None:
+            raise ValueError("keys_dir can't be None")
+        if bits < 2048:
+            raise ValueError("bits can't be less than 2048")
+        self.keys_dir = keys_dir
+        self.bits = bits
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.openssl = openssl
+
+    @staticmethod
+    def check_minion_id(minion_id):
+        '''Raises ValueError for ids which can't safely name a file'''
+        if (not minion_id or minion_id in ('.', '..') or '/' in minion_id or
+                '\\' in minion_id or '\0' in minion_id):
+            raise ValueError("invalid minion id {0!r}".format(minion_id))
+        return minion_id
+
+    @staticmethod
+    def fingerprint(pub):
+        '''The fingerprint `salt-key -f` prints for the public key pub'''
+        # Like salt.utils.crypt.pem_finger: the body lines, newlines and all.
+        body = ''.join([line for line in pub.splitlines(True) if line.strip()][1:-1])
+        digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+    @staticmethod
+    def load(keys_dir, minion_id):
+        '''Returns {"pem", "pub"} for minion_id in keys_dir, or None'''
+        key_dir = os.path.join(keys_dir, MinionKeys.check_minion_id(minion_id))
+        try:
+            with open(os.path.join(key_dir, MinionKeys.PEM_NAME)) as pem_file, \
+                    open(os.path.join(key_dir, MinionKeys.PUB_NAME)) as pub_file:
+                return {'pem': pem_file.read(), 'pub': pub_file.read()}
+        except IOError:
+            return None
+
+    @staticmethod
+    def public_keys(keys_dir):
+        '''Returns {minion id: public key} for every key pair in keys_dir'''
+        keys = {}
+        for minion_id in sorted(os.listdir(keys_dir)):
+            if minion_id.startswith('.'):
+                # A pair still being generated.
+                continue
+            pub_path = os.path.join(keys_dir, minion_id, MinionKeys.PUB_NAME)
+            if os.path.isfile(pub_path):
+                with open(pub_path) as pub_file:
+                    keys[minion_id] = pub_file.read()
+        return keys
+
+    def generate_one(self, minion_id):
+        '''
+        Generates the key pair for minion_id, unless keys_dir already has
+        one. The pair is written to a temp directory which is renamed into
+        place, so a half-generated pair is never picked up.
+        '''
+        key_dir = os.path.join(self.keys_dir, self.check_minion_id(minion_id))
+        result = {'minion_id': minion_id, 'status': 'exists'}
+        started = time.perf_counter()
+        if not os.path.isdir(key_dir):
+            tmp_dir = tempfile.mkdtemp(prefix="." + minion_id + ".", dir=self.keys_dir)
+            try:
+                pem_path = os.path.join(tmp_dir, self.PEM_NAME)
+                pub_path = os.path.join(tmp_dir, self.PUB_NAME)
+                subprocess.run([self.openssl, "genrsa", "-out", pem_path, str(self.bits)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               universal_newlines=True, check=True)
+                subprocess.run([self.openssl, "rsa", "-in", pem_path, "-pubout",
+                                "-out", pub_path],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               universal_newlines=True, check=True)
+                os.chmod(pem_path, 0o600)
+                with open(pem_path) as pem_file, open(pub_path) as pub_file:
+                    key = {'pem': pem_file.read(), 'pub': pub_file.read()}
+                metadata_path = os.path.join(tmp_dir, self.METADATA_NAME)
+                with os.fdopen(os.open(metadata_path, os.O_WRONLY | os.O_CREAT, 0o600),
+                               'w') as metadata_file:
+                    json.dump(key, metadata_file)
+                os.rename(tmp_dir, key_dir)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            result['status'] = 'created'
+        with open(os.path.join(key_dir, self.PUB_NAME)) as pub_file:
+            result['fingerprint'] = self.fingerprint(pub_file.read())
+        result['wall_seconds'] = round(time.perf_counter() - started, 6)
+        return result
+
+    def generate(self, minion_ids):
+        '''
+        Generates key pairs for every id in minion_ids, max_workers openssl
+        processes at a time. Returns a summary of the batch.
+        '''
+        started = time.perf_counter()
+        pathlib.Path(self.keys_dir).mkdir(parents=True, exist_ok=True)
+        os.chmod(self.keys_dir, 0o700)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            keys = list(pool.map(self.generate_one, minion_ids))
+        return {
+            'keys_dir': self.keys_dir,
+            'keys': keys,
+            'created': sum(1 for key in keys if key['status'] == 'created'),
+            'bits': self.bits,
+            'max_workers': self.max_workers,
+            'wall_seconds': round(time.perf_counter() - started, 6)
+        }
+
+    @staticmethod
+    def preseed(public_keys, master_pki_dir=MASTER_PKI_DIR):
+        '''
+        Accepts public_keys ({minion id: public key}) on a master in one
+        pass: changed keys are written to temp files in minions/, flushed
+        to disk with a single sync and renamed into place, and any pending
+        (minions_pre/) copy of the same key is dropped. Returns the number
+        of keys written.
+        '''
+        accepted_dir = os.path.join(master_pki_dir, "minions")
+        pending_dir = os.path.join(master_pki_dir, "minions_pre")
+        pathlib.Path(accepted_dir).mkdir(parents=True, exist_ok=True)
+        os.chmod(master_pki_dir, 0o700)
+        staged = []
+        try:
+            for minion_id, pub in sorted(public_keys.items()):
+                path = os.path.join(accepted_dir, MinionKeys.check_minion_id(minion_id))
+                try:
+                    with open(path) as existing:
+                        if existing.read() == pub:
+                            continue
+                except IOError:
+                    pass
+                handle, tmp_path = tempfile.mkstemp(prefix="." + minion_id + ".",
+                                                    dir=accepted_dir)
+                staged.append((tmp_path, path))
+                with os.fdopen(handle, 'w') as tmp_file:
+                    tmp_file.write(pub)
+                os.chmod(tmp_path, 0o644)
+            if staged and hasattr(os, 'sync'):
+                os.sync()
+            for tmp_path, path in staged:
+                os.replace(tmp_path, path)
+        except BaseException:
+            for tmp_path, _ in staged:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        for minion_id, pub in public_keys.items():
+            pending_path = os.path.join(pending_dir, minion_id)
+            try:
+                with open(pending_path) as pending:
+                    if pending.read() == pub:
+                        os.remove(pending_path)
+            except IOError:
+                pass
+        return len(staged)
@@ -0,0 +1,113 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+
+class Provenance:
+    '''
+    Where the value at one key path came from: layer is the name of the
+    layer it was taken from (a list of names for an appended list), and
+    children holds nodes for the keys below it that later layers set.
+    Keys without a node came from the same layer as their parent.
+    '''
+    __slots__ = ('layer', 'children')
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.children = {}
+
+class MergeResult:
+    '''A merged value, and the Provenance tree saying where it came from'''
+    def __init__(self, value, provenance):
+        self.value = value
+        self.provenance = provenance
+
+    def source(self, path):
+        '''The layer (or layers) the value at path, a list of keys, came from'''
+        if self.provenance is None:
+            return None
+        node = self.provenance
+        for key in path:
+            if key not in node.children:
+                break
+            node = node.children[key]
+        return node.layer
+
+    def sources(self):
+        '''
+        The provenance tree as a sorted, json friendly list of
+        [path, layer(s)]: the root's layer, then every key path a later
+        layer set.
+        '''
+        if self.provenance is None:
+            return []
+        flattened = []
+        pending = [((), self.provenance)]
+        while pending:
+            path, node = pending.pop()
+            flattened.append([list(path), node.layer])
+            pending.extend((path + (key,), child) for key, child in node.children.items())
+        return sorted(flattened)
+
+class JSONMerge:
+    '''
+    Deep merges any number of json layers, e.g. org -> project -> instance,
+    later layers taking precedence:
+
+    - dicts merge key by key, recursively.
+    - lists are replaced, unless their key path (a tuple of keys) is in
+      append_paths, in which case a layer's list is appended to the list
+      the layers before it made.
+    - anything else, or values of different types, is replaced.
+
+    Nothing is copied which doesn't have to be: the result is the first
+    layer, with new dicts (and appended lists) made only along the paths
+    later layers change, and everything else shared with the layers. The
+    layers themselves are never modified, but as the result shares their
+    objects, neither should be modified afterwards.
+    '''
+    def __init__(self, append_paths=()):
+        self.append_paths = set(tuple(path) for path in append_paths)
+
+    def merge(self, layers):
+        '''
+        Merges layers, a list of (name, value) with the lowest precedence
+        first; layers whose value is None are left out. Returns a
+        MergeResult, whose value is None if every layer was.
+        '''
+        present = [(name, value) for name, value in layers if value is not None]
+        if not present:
+            return MergeResult(None, None)
+        name, value = present[0]
+        provenance = Provenance(name)
+        # ids of the dicts and lists made here, which can be changed in place.
+        owned = set()
+        for name, update in present[1:]:
+            value, provenance = self.merge_value((), value, update, name, provenance, owned)
+        return MergeResult(value, provenance)
+
+    # pylint: disable=R0913
+    def merge_value(self, path, base, update, layer, node, owned):
+        '''
+        Merges update, from layer, over base, whose Provenance is node.
+        Returns the merged value and its Provenance.
+        '''
+        if isinstance(base, dict) and isinstance(update, dict):
+            if id(base) not in owned:
+                base = dict(base)
+                owned.add(id(base))
+            for key, child in update.items():
+                if key in base:
+                    base[key], node.children[key] = self.merge_value(
+                        path + (key,), base[key], child, layer,
+                        node.children.get(key) or Provenance(node.layer), owned)
+                else:
+                    base[key] = child
+                    node.children[key] = Provenance(layer)
+            return base, node
+        if isinstance(base, list) and isinstance(update, list) and path in self.append_paths:
+            if id(base) not in owned:
+                base = list(base)
+                owned.add(id(base))
+            base.extend(update)
+            layers = node.layer if isinstance(node.layer, list) else [node.layer]
+            return base, Provenance(layers + [layer])
+        return update, Provenance(layer)
@@ -0,0 +1,194 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+
+class MetadataProvider(abc.ABC):
+    '''
+    Base class for sources of instance & project metadata. Keys are paths
+    relative to the metadata root, such as "instance/attributes/dns" or
+    "project/project-id". Subclasses implement get_many() and
+    wait_for_change(); everything else is built on top of them.
+    '''
+    # Exceptions which mean the source couldn't be reached.
+    request_errors = (OSError,)
+
+    @abc.abstractmethod
+    def get_many(self, keys):
+        '''Returns a dict of key -> value, where missing keys map to None'''
+
+    @abc.abstractmethod
+    def wait_for_change(self, key, last_etag=None, timeout_sec=300):
+        '''
+        Blocks until the value of key no longer has last_etag, or until
+        timeout_sec passes. Returns a tuple of (value, etag).
+        '''
+
+    def get_instance_metadata_value(self, key):
+        '''Helper method for retrieving Instance Metadata values'''
+        return self.get_many(["instance/" + key])["instance/" + key]
+
+    def get_project_metadata_value(self, key):
+        '''Helper method for retrieving Project Metadata values'''
+        return self.get_many(["project/" + key])["project/" + key]
+
+    def get_any_metadata_value(self, key, default=None):
+        '''
+        Helper method for retrieving either instance metadata, if it exists,
+        or project metadata. If metadata can't be found for the passed key in
+        either instance or project metadata, the value of default is returned.
+        Both values are requested concurrently.
+        '''
+        values = self.get_many(["instance/" + key, "project/" + key])
+        instance_metadata_value = values["instance/" + key]
+        project_metadata_value = values["project/" + key]
+        if instance_metadata_value is None:
+            if project_metadata_value is None:
+                return default
+            return project_metadata_value
+
+        return instance_metadata_value
+
+    @staticmethod
+    def camel_case(name):
+        '''project-id -> projectId, the naming used by recursive json'''
+        head, *rest = name.split('-')
+        return head + ''.join(part.title() for part in rest)
+
+    @staticmethod
+    def render(node):
+        '''Renders a tree node the way the metadata server does for a leaf'''
+        if isinstance(node, bool):
+            return str(node).upper()
+        return str(node)
+
+    @staticmethod
+    def lookup_tree(trees, path):
+        '''
+        Returns the node of trees ({"instance": ..., "project": ...}) at
+        path, accepting both path (project-id) and json (projectId) names,
+        or None if there's no such node.
+        '''
+        node = trees
+        for name in [name for name in path.split('/') if name]:
+            if isinstance(node, dict):
+                if name in node:
+                    node = node[name]
+                else:
+                    node = node.get(MetadataProvider.camel_case(name))
+            elif isinstance(node, list) and name.isdigit() and int(name) < len(node):
+                node = node[int(name)]
+            else:
+                return None
+            if node is None:
+                return None
+        return node
+
+    @staticmethod
+    def tree_value(trees, key):
+        '''
+        Returns (value, etag) for key in trees, rendered as the metadata
+        server would: json for recursive=true keys. The etag is a digest of
+        the value.
+        '''
+        path, _, query = key.partition('?')
+        node = MetadataProvider.lookup_tree(trees, path)
+        if node is None:
+            value = None
+        elif 'recursive=true' in query:
+            value = json.dumps(node, sort_keys=True)
+        else:
+            value = MetadataProvider.render(node)
+        return value, hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def index_tree(tree, prefix, index):
+        '''
+        Flattens a recursive metadata tree into index, keyed by the same paths
+        used for single-key requests. The recursive json uses camelCase names
+        (projectId), which are mapped back to the path form (project-id);
+        user-defined keys under attributes/ are left untouched.
+        '''
+        if isinstance(tree, dict):
+            items = tree.items()
+        elif isinstance(tree, list):
+            items = enumerate(tree)
+        else:
+            index[prefix] = MetadataProvider.render(tree)
+            return index
+
+        for name, subtree in items:
+            name = str(name)
+            if not prefix.endswith("/attributes"):
+                name = re.sub(r'([A-Z])', lambda m: '-' + m.group(1).lower(), name)
+            MetadataProvider.index_tree(subtree, prefix + "/" + name, index)
+        return index
+
+class StaticMetadataProvider(MetadataProvider):
+    '''
+    Serves metadata from trees already in memory, shaped like the metadata
+    server's recursive output ({"instance": {...}, "project": {...}}).
+    '''
+    def __init__(self, trees):
+        if trees is None:
+            raise ValueError("trees can't be None")
+        self.trees = trees
+        self.index = {}
+        for tree in ("instance", "project"):
+            if trees.get(tree) is not None:
+                self.index_tree(trees[tree], tree, self.index)
+
+    def load_snapshot(self):
+        '''Returns the flattened index, which is built once'''
+        return self.index
+
+    def get_many(self, keys):
+        return {key: self.index.get(key) for key in keys}
+
+    def wait_for_change(self, key, last_etag=None, timeout_sec=300):
+        '''The trees never change, so an up to date caller waits out timeout_sec'''
+        value, etag = self.tree_value(self.trees, key)
+        if etag == last_etag:
+            time.sleep(timeout_sec)
+        return value, etag
+
+class JSONFileMetadataProvider(MetadataProvider):
+    '''
+    Serves metadata from a local json file shaped like the metadata server's
+    recursive output: {"instance": {"attributes": {...}, ...},
+    "project": {"projectId": ..., "attributes": {...}}}.
+    wait_for_change() polls the file for modifications.
+    '''
+    POLL_SECONDS = 1
+
+    def __init__(self, path):
+        if path is None:
+            raise ValueError("path can't be None")
+        self.path = path
+        self.trees = None
+        self.index = None
+        self.mtime = None
+
+    def load_snapshot(self):
+        '''(Re)reads the file if it changed; returns the flattened index'''
+        mtime = os.stat(self.path).st_mtime
+        if self.index is None or mtime != self.mtime:
+            with open(self.path) as metadata_file:
+                self.trees = json.load(metadata_file)
+            self.index = {}
+            for tree in ("instance", "project"):
+                if tree in self.trees:
+                    self.index_tree(self.trees[tree], tree, self.index)
+            self.mtime = mtime
+        return self.index
+
+    def get_many(self, keys):
+        index = self.load_snapshot()
+        return {key: index.get(key) for key in keys}
+
+    def wait_for_change(self, key, last_etag=None, timeout_sec=300):
+        deadline = time.time() + timeout_sec
+        while True:
+            self.load_snapshot()
+            value, etag = self.tree_value(self.trees, key)
+            if etag != last_etag or time.time() >= deadline:
+                return value, etag
+            time.sleep(self.POLL_SECONDS)
@@ -0,0 +1,193 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+import http.server
+from kickstart_salt_download import BootstrapSaltCache, BootstrapSaltDownloader
+from kickstart_salt_standin import StandInHTTPServer
+
+class PeerServer:
+    '''
+    Serves the bootstrap files this node holds to other nodes, addressed by
+    digest: GET /kickstart_salt/v1/<hash_type>/<digest>. The candidates are
+    files (e.g. the downloaded bootstrap-salt.sh) and the objects of a
+    BootstrapSaltCache. A file is only served if it currently hashes to
+    the requested digest, and clients check what they receive against
+    bootstrap_salt_expected_hash anyway, so a peer is trusted no more than
+    a mirror. packages_dir, if given, is served read-only under
+    /kickstart_salt/v1/packages/.
+    '''
+    ROOT = "/kickstart_salt/v1/"
+    DEFAULT_PORT = 8765
+
+    # pylint: disable=R0913
+    def __init__(self, files=(), cache=None, packages_dir=None, host="0.0.0.0",
+                 port=DEFAULT_PORT):
+        self.files = [path for path in files if path]
+        self.cache = cache
+        self.packages_dir = packages_dir and os.path.realpath(packages_dir)
+        self.lock = threading.Lock()
+        # (path, hash_type) -> (mtime, size, digest)
+        self.digests = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = StandInHTTPServer((host, port), self.handler())
+        self.url = "http://{0}:{1}".format(host, self.server.server_address[1])
+        self.thread = None
+
+    def file_digest(self, path, hash_type):
+        '''Digest of path, recomputed only when the file changes'''
+        stat = os.stat(path)
+        with self.lock:
+            known = self.digests.get((path, hash_type))
+        if known is not None and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+        digest = BootstrapSaltCache.digest(path, hash_type)
+        with self.lock:
+            self.digests[(path, hash_type)] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    def lookup(self, hash_type, digest):
+        '''Returns the path of a file matching digest, or None'''
+        if (hash_type not in hashlib.algorithms_guaranteed or
+                not re.match(r'^[0-9a-f]+$', digest)):
+            return None
+        candidates = list(self.files)
+        if self.cache is not None:
+            candidates.insert(0, self.cache.object_path(hash_type, digest))
+        for path in candidates:
+            try:
+                if self.file_digest(path, hash_type) == digest:
+                    return path
+            except (IOError, OSError):
+                continue
+        return None
+
+    def package_path(self, name):
+        '''Returns the file under packages_dir named by name, or None'''
+        if self.packages_dir is None:
+            return None
+        path = os.path.realpath(os.path.join(self.packages_dir,
+                                             urllib_parse.unquote(name)))
+        if not path.startswith(self.packages_dir + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def handler(self):
+        peer = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_empty(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):  # pylint: disable=C0103
+                with peer.lock:
+                    peer.requests += 1
+                _, root, rest = self.path.partition('?')[0].partition(peer.ROOT)
+                path = None
+                if root and rest.startswith("packages/"):
+                    path = peer.package_path(rest[len("packages/"):])
+                elif root and rest.count('/') == 1:
+                    path = peer.lookup(*rest.split('/'))
+                if path is None:
+                    self.send_empty(404)
+                    return
+
+                size = os.path.getsize(path)
+                start = 0
+                match = re.match(r'bytes=(\d+)-$', self.headers.get("Range", ""))
+                if match and int(match.group(1)) < size:
+                    start = int(match.group(1))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                        start, size - 1, size))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(size - start))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    for chunk in iter(lambda: f.read(BootstrapSaltDownloader.CHUNK_SIZE), b""):
+                        self.wfile.write(chunk)
+                        with peer.lock:
+                            peer.bytes_sent += len(chunk)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                pass
+
+        return Handler
+
+    def start(self):
+        '''Serves requests from a background thread; returns self'''
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        print("Serving verified bootstrap files to peers at {0}{1}".format(self.url, self.ROOT))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Peers:
+    '''
+    Fetches bootstrap files from other nodes' PeerServers before falling
+    back to the mirrors. peers are "host:port" (or "host", for the default
+    port) strings, usually from metadata. Each fetch races fanout of them,
+    picked in an order shuffled by seed so a fleet spreads its requests
+    over all peers. A peer which is down or slow costs at most timeout
+    seconds.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, peers, seed=None, fanout=2, timeout=5):
+        self.peers = list(peers or [])
+        self.seed = platform.node() if seed is None else str(seed)
+        self.fanout = max(1, fanout)
+        self.timeout = timeout
+
+    def urls(self, hash_type, digest):
+        '''Returns the urls of the peers to try for digest'''
+        peers = list(self.peers)
+        random.Random("{0}/{1}".format(self.seed, digest)).shuffle(peers)
+        urls = []
+        for peer in peers[:self.fanout]:
+            if ':' not in peer:
+                peer = "{0}:{1}".format(peer, PeerServer.DEFAULT_PORT)
+            urls.append("http://{0}{1}{2}/{3}".format(peer, PeerServer.ROOT,
+                                                      hash_type, digest))
+        return urls
+
+    # pylint: disable=R0913
+    def fetch(self, save_path, hash_type, expected_hash, stats=None, hash_types=(),
+              digests=None):
+        '''
+        Downloads the file matching expected_hash from a peer to save_path.
+        Returns save_path, or None if no peer had a matching copy. If a
+        digests dict is passed, it's updated with the file's digests for
+        hash_type and hash_types, computed as it was downloaded.
+        '''
+        if stats is None:
+            stats = {}
+        if not self.peers or not hash_type or not expected_hash:
+            return None
+        # Peers serve files under their lower-case hex digest.
+        urls = self.urls(hash_type, expected_hash.lower())
+        print("Trying peers {0}...".format(', '.join(urls)), end='')
+        sys.stdout.flush()
+        winner = BootstrapSaltDownloader.race(urls, save_path, hash_type,
+                                              expected_hash=expected_hash,
+                                              timeout=self.timeout, retries=0,
+                                              hash_types=hash_types)
+        if winner is None:
+            print("no peer had it.")
+            return None
+        print("success from {0}.".format(winner['url']))
+        stats.update(bytes_downloaded=winner['size'], source=winner['url'])
+        if digests is not None:
+            digests.update(winner['digests'])
+        return save_path
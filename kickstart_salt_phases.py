@@ -0,0 +1,353 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+
+class BootstrapReport:
+    '''
+    Records a timing span for every bootstrap phase: wall clock, bytes
+    downloaded and the CPU time of the subprocesses (such as
+    bootstrap-salt.sh) the phase ran. Spans can be printed as json lines as
+    they close and are written as a json report when the run finishes.
+    '''
+    VERSION = 1
+    # The span of the phase running in this thread or task. Phases overlap,
+    #  so each subprocess adds its own CPU time to the span that started it.
+    current_span = contextvars.ContextVar('kickstart_salt_span', default=None)
+
+    def __init__(self, report_path=None, log_phases=False):
+        self.report_path = report_path
+        self.log_phases = log_phases
+        self.spans = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def add_subprocess_cpu(cls, seconds):
+        '''Adds seconds of subprocess CPU time to the current phase's span'''
+        span = cls.current_span.get()
+        if span is not None:
+            span['subprocess_cpu_seconds'] = round(span['subprocess_cpu_seconds'] + seconds, 6)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Context manager timing one phase. Yields the span dict, so callers
+        can add fields such as bytes_downloaded.
+        '''
+        span = {
+            'phase': name,
+            'started': time.time(),
+            'status': 'ok',
+            'bytes_downloaded': 0,
+            'subprocess_cpu_seconds': 0.0
+        }
+        wall_start = time.perf_counter()
+        token = self.current_span.set(span)
+        try:
+            yield span
+        except BaseException:
+            span['status'] = 'failed'
+            raise
+        finally:
+            self.current_span.reset(token)
+            span['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+            with self.lock:
+                self.spans.append(span)
+            if self.log_phases:
+                print("kickstart_salt_phase " + json.dumps(span, sort_keys=True))
+
+    def as_dict(self):
+        return {
+            'version': self.VERSION,
+            'hostname': platform.node(),
+            'platform': platform.system(),
+            'started': self.started,
+            'wall_seconds': round(time.time() - self.started, 6),
+            'bytes_downloaded': sum(span['bytes_downloaded'] for span in self.spans),
+            'status': ('failed' if any(span['status'] == 'failed' for span in self.spans)
+                       else 'ok'),
+            'phases': self.spans
+        }
+
+    def write(self):
+        '''Writes the report to report_path, if one was given'''
+        if self.report_path is None:
+            return None
+        directory = os.path.dirname(os.path.abspath(self.report_path))
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        tmp_path = self.report_path + ".tmp"
+        with open(tmp_path, 'w') as report_file:
+            json.dump(self.as_dict(), report_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.report_path)
+        return self.report_path
+
+class PhaseState:
+    '''
+    Remembers which phases finished, and the digest of the inputs they ran
+    with, in a json state file that survives reboots. A phase whose inputs
+    haven't changed since it last succeeded doesn't need to run again.
+    '''
+    VERSION = 1
+
+    def __init__(self, state_path):
+        if state_path is None:
+            raise ValueError("state_path can't be None")
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.phases = {}
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if state.get('version') == self.VERSION:
+                self.phases = state.get('phases', {})
+        except (IOError, ValueError, AttributeError):
+            pass
+
+    @staticmethod
+    def digest(inputs):
+        '''sha256 of inputs (anything json serializable)'''
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def is_current(self, name, digest):
+        entry = self.phases.get(name)
+        return entry is not None and entry.get('digest') == digest
+
+    def record(self, name, digest):
+        '''Records that name succeeded with digest and saves the state file'''
+        with self.lock:
+            self.phases[name] = {'digest': digest, 'finished': time.time()}
+            self.write()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as state_file:
+            json.dump({'version': self.VERSION, 'phases': self.phases}, state_file,
+                      indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+class TokenBucket:
+    '''
+    Admits rate callers per second on average, with bursts of up to burst.
+    Callers reserve() a token, borrowing from the future when the bucket is
+    empty, and wait the number of seconds returned before going ahead.
+    '''
+    def __init__(self, rate, burst=1):
+        if not rate or rate <= 0:
+            raise ValueError("rate must be a positive number")
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''Takes a token; returns the seconds to wait before using it'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0.0)
+
+    def acquire(self):
+        '''Blocks until a token is available; returns the seconds waited'''
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class AdmissionControl:
+    '''
+    Spreads out the phases which load shared infrastructure (the download
+    mirror, the salt master) when a whole fleet boots at once. phases maps
+    a phase name to its limits:
+
+        {"download": {"jitter_seconds": 30, "rate": 5, "burst": 10}}
+
+    A phase first waits a random delay of up to jitter_seconds, drawn from
+    a generator seeded with seed and the phase name. By default the seed is
+    the hostname, so nodes spread evenly across the window, but any one
+    node always waits the same. The phase then takes a token from a
+    TokenBucket of rate/burst. The bucket is shared by every run in this
+    process, such as the targets of a MultiTargetRunner.
+
+    download_retries and max_retry_after bound the retries of throttled
+    (429/503) downloads and how long a Retry-After is honoured.
+    '''
+    buckets = {}
+    buckets_lock = threading.Lock()
+
+    def __init__(self, phases=None, seed=None, download_retries=3, max_retry_after=120):
+        self.phases = phases or {}
+        for name, limits in self.phases.items():
+            if not isinstance(limits, dict):
+                raise ValueError("admission limits for {0} must be a dictionary".format(name))
+        self.seed = platform.node() if seed is None else str(seed)
+        self.download_retries = download_retries
+        self.max_retry_after = max_retry_after
+
+    def jitter(self, name):
+        '''Returns this node's seeded delay, in seconds, for phase name'''
+        jitter_seconds = self.phases.get(name, {}).get('jitter_seconds')
+        if not jitter_seconds:
+            return 0.0
+        return random.Random("{0}/{1}".format(self.seed, name)).uniform(0, jitter_seconds)
+
+    def bucket(self, name):
+        '''Returns the process-wide TokenBucket for phase name, or None'''
+        limits = self.phases.get(name, {})
+        if not limits.get('rate'):
+            return None
+        key = (name, limits['rate'], limits.get('burst', 1))
+        with self.buckets_lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(limits['rate'], limits.get('burst', 1))
+            return self.buckets[key]
+
+    def admit(self, name, span=None):
+        '''
+        Waits until phase name may start; returns the seconds waited, which
+        are also recorded in span as admission_wait_seconds.
+        '''
+        waited = self.jitter(name)
+        if waited:
+            time.sleep(waited)
+        bucket = self.bucket(name)
+        if bucket is not None:
+            waited += bucket.acquire()
+        if waited and span is not None:
+            span['admission_wait_seconds'] = round(waited, 6)
+        return waited
+
+class PhaseScheduler:
+    '''
+    Runs bootstrap phases as a small dependency graph. Each phase starts in
+    a worker thread as soon as the phases it depends on have finished, so
+    independent phases overlap. The first failure stops any phase that
+    hasn't started yet and is re-raised once the running phases are done.
+
+    With a PhaseState, phases added with inputs are skipped when they last
+    succeeded with the same inputs, unless force is set or a phase which
+    does run depends on them. With an AdmissionControl, phases which run
+    first wait until it admits them.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, report=None, max_workers=4, state=None, force=False,
+                 admission=None):
+        self.report = report or BootstrapReport()
+        self.max_workers = max_workers
+        self.state = state
+        self.force = force
+        self.admission = admission
+        self.phases = {}
+        self.digests = {}
+        self.skipped = set()
+
+    def add(self, name, func, depends_on=(), inputs=None):
+        '''
+        Adds a phase. func is called with the phase's report span, once every
+        phase named in depends_on has succeeded. inputs (json serializable)
+        describe everything the phase's outcome depends on; phases without
+        inputs always run.
+        '''
+        if name in self.phases:
+            raise ValueError("phase {0} is already defined".format(name))
+        self.phases[name] = (func, tuple(depends_on))
+        if inputs is not None:
+            self.digests[name] = PhaseState.digest(inputs)
+
+    def plan_skips(self):
+        '''Returns the phases which can be skipped'''
+        if self.state is None or self.force:
+            return set()
+        skipped = {name for name, digest in self.digests.items()
+                   if self.state.is_current(name, digest)}
+        # A phase that runs needs whatever the phases it depends on produce.
+        changed = True
+        while changed:
+            changed = False
+            for name, (_, depends_on) in self.phases.items():
+                if name in skipped:
+                    continue
+                for dependency in depends_on:
+                    if dependency in skipped:
+                        skipped.discard(dependency)
+                        changed = True
+        return skipped
+
+    def validate(self):
+        '''Raises ValueError on unknown dependencies or dependency cycles'''
+        for name, (_, depends_on) in self.phases.items():
+            for dependency in depends_on:
+                if dependency not in self.phases:
+                    raise ValueError("phase {0} depends on unknown phase {1}".format(
+                        name, dependency))
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("phase {0} is part of a dependency cycle".format(name))
+            visiting.add(name)
+            for dependency in self.phases[name][1]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.phases:
+            visit(name)
+
+    def skip_phase(self, name, span):
+        '''Marks span as skipped and returns True if name is to be skipped'''
+        if name not in self.skipped:
+            return False
+        print("Skipping {0}: it already succeeded with the same inputs "
+              "(use --force to run it anyway).".format(name))
+        span['status'] = 'skipped'
+        return True
+
+    def run_phase(self, name):
+        with self.report.phase(name) as span:
+            if self.skip_phase(name, span):
+                return None
+            if self.admission is not None:
+                self.admission.admit(name, span)
+            result = self.phases[name][0](span)
+        if self.state is not None and name in self.digests:
+            self.state.record(name, self.digests[name])
+        return result
+
+    def run(self):
+        '''Runs every phase; returns a dict of phase name -> return value'''
+        import concurrent.futures
+        self.validate()
+        self.skipped = self.plan_skips()
+        results = {}
+        running = {}
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if failure is None:
+                    for name, (_, depends_on) in self.phases.items():
+                        if (name not in results and name not in running.values()
+                                and all(dep in results for dep in depends_on)):
+                            running[pool.submit(self.run_phase, name)] = name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException as err:  # pylint: disable=W0703
+                        if failure is None:
+                            failure = err
+        if failure is not None:
+            raise failure
+        return results
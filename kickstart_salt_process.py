@@ -0,0 +1,182 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+import signal
+from kickstart_salt_phases import BootstrapReport
+
+class RotatingLog:
+    '''
+    Append-only binary log file which rotates to path.1 ... path.<backups>
+    once it grows past max_bytes.
+    '''
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(os.path.abspath(path))
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        self.file = open(path, 'ab')
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = "{0}.{1}".format(self.path, i)
+            if os.path.exists(older):
+                os.replace(older, "{0}.{1}".format(self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        self.file = open(self.path, 'wb')
+
+    def write(self, data):
+        if self.max_bytes and self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class LiveProcess:
+    '''
+    Runs a command with its combined stdout/stderr pumped by a reader thread,
+    in large unbuffered reads, to our stdout and optionally to a rotating log
+    file. Output without a trailing newline is passed through as it arrives.
+    Lines can be prefixed with a timestamp, and the process is killed if it
+    runs longer than timeout seconds. The CPU time of the process (and of
+    the children it waited for) is added to the report span of the phase
+    which ran it.
+    '''
+    READ_SIZE = 64 * 1024
+    KILL_GRACE_SECONDS = 5
+
+    # pylint: disable=R0913
+    def __init__(self, command, log_path=None, log_max_bytes=10 * 1024 * 1024,
+                 log_backups=3, timestamps=False, timeout=None):
+        # Validate that command is not a string
+        if isinstance(command, str):
+            # Not an array!
+            raise TypeError('Command must be an array')
+        self.command = command
+        self.log = None
+        if log_path is not None:
+            self.log = RotatingLog(log_path, max_bytes=log_max_bytes,
+                                   backups=log_backups)
+        self.timestamps = timestamps
+        self.timeout = timeout
+        self.at_line_start = True
+        self.timed_out = False
+        self.new_session = False
+        self.rusage = None
+
+    def stamp(self, data):
+        '''Prefixes every line which starts inside data with a timestamp'''
+        if not self.timestamps:
+            return data
+        out = []
+        for line in data.splitlines(True):
+            if self.at_line_start:
+                stamp = time.strftime("[%Y-%m-%dT%H:%M:%S] ").encode('ascii')
+                out.append(stamp)
+            out.append(line)
+            self.at_line_start = line.endswith(b'\n')
+        return b''.join(out)
+
+    def emit(self, data):
+        data = self.stamp(data)
+        stdout = getattr(sys.stdout, 'buffer', None)
+        if stdout is None:
+            sys.stdout.write(data.decode('utf-8', 'replace'))
+        else:
+            stdout.write(data)
+        sys.stdout.flush()
+        if self.log is not None:
+            self.log.write(data)
+
+    def pump(self, stream):
+        fd = stream.fileno()
+        try:
+            for chunk in iter(lambda: os.read(fd, self.READ_SIZE), b""):
+                self.emit(chunk)
+        except (OSError, ValueError):
+            # The pipe was closed under us after a kill.
+            pass
+
+    def signal_group(self, proc, sig):
+        '''Signals proc, and on unix the process group it leads'''
+        if self.new_session:
+            try:
+                os.killpg(proc.pid, sig)
+                return
+            except OSError:
+                pass
+        if proc.returncode is None:
+            # Not proc.send_signal(): it polls, which could reap proc before
+            #  reap() gets its resource usage.
+            try:
+                os.kill(proc.pid, sig)
+            except OSError:
+                pass
+
+    def kill(self, proc, waiter):
+        '''Terminates proc, escalating to kill if it doesn't exit in time'''
+        self.signal_group(proc, signal.SIGTERM)
+        waiter.join(self.KILL_GRACE_SECONDS)
+        if waiter.is_alive():
+            self.signal_group(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            waiter.join()
+
+    def spawn(self):
+        '''Starts the command with its output on a pipe; returns the Popen'''
+        windows = platform.system() == "Windows"
+        # With a timeout, the command gets its own process group on unix so
+        #  children it spawns (yum, for instance) are killed along with it.
+        self.new_session = self.timeout is not None and not windows
+        return subprocess.Popen(self.command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                bufsize=0,
+                                shell=windows,
+                                start_new_session=self.new_session)
+
+    def reap(self, proc):
+        '''
+        Waits for proc to exit and sets its returncode. On unix it's reaped
+        with os.wait4, which also gives its resource usage (self.rusage).
+        '''
+        if not hasattr(os, 'wait4'):
+            proc.wait()
+            return
+        _, status, self.rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+    def cpu_seconds(self):
+        '''User + system CPU time of the reaped process, 0.0 if not known'''
+        if self.rusage is None:
+            return 0.0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+    def run(self):
+        '''Runs the command and returns its return code'''
+        proc = self.spawn()
+        reader = threading.Thread(target=self.pump, args=(proc.stdout,))
+        reader.daemon = True
+        reader.start()
+        waiter = threading.Thread(target=self.reap, args=(proc,))
+        waiter.daemon = True
+        waiter.start()
+        try:
+            waiter.join(self.timeout)
+            if waiter.is_alive():
+                self.timed_out = True
+                self.kill(proc, waiter)
+                print("\nKilled {0} after {1} seconds.".format(self.command[0], self.timeout))
+        finally:
+            # Orphaned grandchildren can hold the pipe open after a kill.
+            reader.join(self.KILL_GRACE_SECONDS if self.timed_out else None)
+            proc.stdout.close()
+            if self.log is not None:
+                self.log.close()
+        BootstrapReport.add_subprocess_cpu(self.cpu_seconds())
+        return proc.returncode
@@ -0,0 +1,286 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+# Only the stand-ins, the peer server and the benchmarks serve HTTP, so
+#  nothing else pays for importing http.server.
+import http.server
+from kickstart_salt_metadata import MetadataProvider
+
+class StandInHTTPServer(http.server.ThreadingHTTPServer):
+    '''Threaded server with a listen backlog deep enough for a booting fleet'''
+    daemon_threads = True
+    request_queue_size = 1024
+
+class MetadataStandInServer:
+    '''
+    Local HTTP stand-in for metadata.google.internal, serving trees shaped
+    like JSONFileMetadataProvider's file under /computeMetadata/v1/. It
+    supports recursive=true&alt=json, wait_for_change/last_etag, and the
+    Metadata-Flavor header check. Every response can be delayed by latency
+    seconds (plus up to jitter seconds), and a fraction error_rate of
+    requests fail with error_status, to mimic a busy metadata server.
+    Clients may prefix paths with a tag (/<tag>/computeMetadata/v1/...) so
+    requests_by_tag can attribute requests to them.
+    '''
+    ROOT = "/computeMetadata/v1/"
+
+    # pylint: disable=R0913
+    def __init__(self, trees, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503, host="127.0.0.1", port=0, seed=None):
+        self.trees = trees
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.requests_by_tag = {}
+        self.server = StandInHTTPServer((host, port), self.handler())
+        self.url = "http://{0}:{1}/computeMetadata/v1".format(
+            host, self.server.server_address[1]
+        )
+        self.thread = None
+
+    @staticmethod
+    def etag(node):
+        return hashlib.md5(json.dumps(node, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def set_value(self, path, value):
+        '''Sets the leaf at path (e.g. "instance/attributes/dns") and wakes waiters'''
+        with self.condition:
+            *parents, name = path.strip('/').split('/')
+            node = self.trees
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[name] = value
+            self.condition.notify_all()
+
+    def respond(self, path, query):
+        '''Returns (status, body, etag) for a request'''
+        with self.condition:
+            node = MetadataProvider.lookup_tree(self.trees, path)
+            if 'wait_for_change' in query and query.get('last_etag'):
+                deadline = time.time() + float(query.get('timeout_sec', 300))
+                while (self.etag(node) == query['last_etag'] and
+                       time.time() < deadline):
+                    self.condition.wait(deadline - time.time())
+                    node = MetadataProvider.lookup_tree(self.trees, path)
+        if node is None:
+            return 404, b"", None
+        if query.get('recursive') == 'true' and query.get('alt') == 'json':
+            body = json.dumps(node)
+        elif isinstance(node, dict):
+            # Directories are listed one entry per line, like the real server.
+            body = ''.join(
+                "{0}{1}\n".format(name, '/' if isinstance(child, (dict, list)) else '')
+                for name, child in node.items()
+            )
+        else:
+            body = MetadataProvider.render(node)
+        return 200, body.encode('utf-8'), self.etag(node)
+
+    def handler(self):
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # pylint: disable=C0103
+                path, _, query = self.path.partition('?')
+                query = dict(urllib_parse.parse_qsl(query))
+                tag, root, rest = path.partition(standin.ROOT)
+                tag = tag.strip('/')
+                with standin.condition:
+                    standin.requests += 1
+                    standin.requests_by_tag[tag] = standin.requests_by_tag.get(tag, 0) + 1
+                delay = standin.latency + standin.random.uniform(0, standin.jitter)
+                if delay:
+                    time.sleep(delay)
+
+                if standin.random.random() < standin.error_rate:
+                    with standin.condition:
+                        standin.errors += 1
+                    status, body, etag = standin.error_status, b"", None
+                elif self.headers.get("Metadata-Flavor") != "Google":
+                    status, body, etag = 403, b"Missing Metadata-Flavor:Google header.", None
+                elif not root:
+                    status, body, etag = 404, b"", None
+                else:
+                    status, body, etag = standin.respond(rest, query)
+
+                self.send_response(status)
+                self.send_header("Metadata-Flavor", "Google")
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with standin.condition:
+                    standin.bytes_sent += len(body)
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                pass
+
+        return Handler
+
+    def start(self):
+        '''Serves requests from a background thread; returns self'''
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MirrorStandInServer:
+    '''
+    Local HTTP mirror serving files ({name: bytes}) at /<name>, or at
+    /<tag>/<name> so requests and bytes can be attributed to a client.
+    Supports "Range: bytes=N-" and answers a matching If-None-Match with a
+    304 (counted in not_modified); responses can be delayed by latency seconds
+    and a fraction error_rate of requests fail with error_status. With
+    max_rps, requests beyond that many a second get a 429 with a
+    Retry-After of retry_after seconds, like a throttling CDN. With
+    drop_after, full (non-Range) responses break off after that many bytes,
+    so only a client which resumes gets the whole file.
+    '''
+    CHUNK_SIZE = 64 * 1024
+
+    # pylint: disable=R0913
+    def __init__(self, files, latency=0.0, error_rate=0.0, error_status=503,
+                 host="127.0.0.1", port=0, seed=None, max_rps=None, retry_after=1,
+                 drop_after=None):
+        self.files = files
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.drop_after = drop_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.dropped = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.requests_by_tag = {}
+        self.bytes_by_tag = {}
+        self.arrivals_by_second = {}
+        self.served_by_second = {}
+        self.server = StandInHTTPServer((host, port), self.handler())
+        self.url = "http://{0}:{1}".format(host, self.server.server_address[1])
+
+    def count(self, tag, sent=0, error=False):
+        with self.lock:
+            if not sent and not error:
+                self.requests += 1
+                self.requests_by_tag[tag] = self.requests_by_tag.get(tag, 0) + 1
+                second = int(time.monotonic() - self.started)
+                self.arrivals_by_second[second] = self.arrivals_by_second.get(second, 0) + 1
+            self.errors += int(error)
+            self.bytes_sent += sent
+            self.bytes_by_tag[tag] = self.bytes_by_tag.get(tag, 0) + sent
+
+    def admit(self):
+        '''Returns True if a request may be served now, under max_rps'''
+        with self.lock:
+            second = int(time.monotonic() - self.started)
+            served = self.served_by_second.get(second, 0)
+            if self.max_rps is not None and served >= self.max_rps:
+                self.throttled += 1
+                return False
+            self.served_by_second[second] = served + 1
+            return True
+
+    def load(self):
+        '''Peak requests a second, as they arrived and as they were served'''
+        with self.lock:
+            return {
+                'peak_arrivals_per_second': max(self.arrivals_by_second.values() or [0]),
+                'peak_served_per_second': max(self.served_by_second.values() or [0]),
+                'throttled': self.throttled
+            }
+
+    def handler(self):
+        mirror = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # pylint: disable=C0103
+                tag, _, name = self.path.partition('?')[0].rpartition('/')
+                tag = tag.strip('/')
+                mirror.count(tag)
+                if mirror.latency:
+                    time.sleep(mirror.latency)
+                body = mirror.files.get(name)
+                if not mirror.admit():
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(mirror.retry_after))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if mirror.random.random() < mirror.error_rate:
+                    mirror.count(tag, error=True)
+                    self.send_response(mirror.error_status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+                if self.headers.get("If-None-Match") == etag:
+                    with mirror.lock:
+                        mirror.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                start = 0
+                match = re.match(r'bytes=(\d+)-$', self.headers.get("Range", ""))
+                if match and int(match.group(1)) < len(body):
+                    start = int(match.group(1))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                        start, len(body) - 1, len(body)))
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body) - start))
+                self.end_headers()
+                end = len(body)
+                if mirror.drop_after is not None and not start and mirror.drop_after < end:
+                    end = mirror.drop_after
+                    self.close_connection = True
+                    with mirror.lock:
+                        mirror.dropped += 1
+                for offset in range(start, end, mirror.CHUNK_SIZE):
+                    chunk = body[offset:min(offset + mirror.CHUNK_SIZE, end)]
+                    self.wfile.write(chunk)
+                    mirror.count(tag, sent=len(chunk))
+
+            def log_message(self, *args):  # pylint: disable=W0221
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
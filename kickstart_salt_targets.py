@@ -0,0 +1,141 @@
+# pylint: disable=C0111
+from kickstart_salt_imports import *
+import concurrent.futures
+import socket
+from kickstart_salt import KickstartSalt
+
+class TargetKickstartSalt(KickstartSalt):
+    '''
+    KickstartSalt for one target root of a MultiTargetRunner. Given a
+    shared_script_path, its download phase copies that already verified
+    script into the target instead of fetching it again. It doesn't start
+    on construction; the runner calls run().
+    '''
+    def __init__(self, shared_script_path=None, **kwargs):
+        self.shared_script_path = shared_script_path
+        KickstartSalt.__init__(self, **kwargs)
+
+    def run_bootstrap(self):
+        '''Does nothing: the bootstrap starts when run() is called.'''
+
+    def run(self):
+        KickstartSalt.run_bootstrap(self)
+
+    @staticmethod
+    def fetch(kwargs):
+        '''
+        Downloads and verifies the script described by kwargs to its
+        bootstrap_salt_save_path on the host, without bootstrapping.
+        Returns (path, download span); exits if no copy matches.
+        '''
+        fetcher = TargetKickstartSalt(**dict(kwargs, kickstart_salt_target_root=None,
+                                             kickstart_salt_report_path=None))
+        fetcher.bootstrap_path = None
+        with fetcher.report.phase("download") as span:
+            fetcher.phase_download(span)
+        return fetcher.bootstrap_path, span
+
+    def phase_download(self, span):
+        if self.shared_script_path is None:
+            KickstartSalt.phase_download(self, span)
+            return
+        save_path = self.target_path(self.bootstrap_salt_save_path)
+        directory = os.path.dirname(save_path)
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(save_path) + ".",
+                                            dir=directory)
+        os.close(handle)
+        try:
+            shutil.copyfile(self.shared_script_path, tmp_path)
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        span.update(bytes_downloaded=0, source=self.shared_script_path)
+        self.bootstrap_path = save_path
+
+class MultiTargetRunner:
+    '''
+    Bootstraps several target roots (chroots, container filesystems) on one
+    host from a single resolved set of KickstartSalt kwargs. The bootstrap
+    script is downloaded and verified once, on the host; each target then
+    gets its own resolv.conf, master.d, yum install and bootstrap-salt run,
+    with at most max_workers targets in progress at a time.
+
+    command_prefix (e.g. ["chroot", "{target_root}"]) is what runs
+    bootstrap-salt inside a target, else the kwargs'
+    bootstrap_salt_command_prefix; one of them is required.
+
+    Each target is its own minion, so it gets its own minion id (passed to
+    bootstrap-salt as -i, and used to find its pre-generated key) from
+    minion_id_template, in which {minion_id} is the id the kwargs give,
+    {target_root} the target's root and {target_name} its last component.
+    '''
+    MINION_ID_TEMPLATE = "{minion_id}-{target_name}"
+
+    # pylint: disable=R0913
+    def __init__(self, kwargs, target_roots, max_workers=4, command_prefix=None,
+                 minion_id_template=None, force=False):
+        if kwargs is None:
+            raise ValueError("kwargs can't be None")
+        if not target_roots:
+            raise ValueError("target_roots can't be empty")
+        if not (command_prefix or kwargs.get('bootstrap_salt_command_prefix')):
+            raise ValueError("command_prefix can't be None without a "
+                             "bootstrap_salt_command_prefix")
+        self.kwargs = kwargs
+        self.target_roots = list(target_roots)
+        self.max_workers = max(1, max_workers)
+        self.command_prefix = command_prefix
+        self.minion_id_template = minion_id_template or self.MINION_ID_TEMPLATE
+        self.force = force
+        self.minion_ids = {root: self.minion_id(root) for root in self.target_roots}
+        if len(set(self.minion_ids.values())) != len(self.target_roots):
+            raise ValueError("minion_id_template {0!r} doesn't give every target "
+                             "its own minion id".format(self.minion_id_template))
+
+    def minion_id(self, target_root):
+        '''The minion id of the target at target_root'''
+        json_args = self.kwargs.get('bootstrap_salt_json_args') or {}
+        return self.minion_id_template.format(
+            minion_id=(self.kwargs.get('salt_minion_id') or json_args.get('-i') or
+                       socket.getfqdn()),
+            target_root=target_root,
+            target_name=os.path.basename(os.path.normpath(target_root))
+        )
+
+    def run_target(self, script_path, target_root):
+        '''Bootstraps one target; returns a summary instead of raising'''
+        minion_id = self.minion_ids[target_root]
+        kwargs = dict(self.kwargs, kickstart_salt_target_root=target_root,
+                      salt_minion_id=minion_id)
+        kwargs['bootstrap_salt_json_args'] = dict(kwargs.get('bootstrap_salt_json_args') or {},
+                                                  **{'-i': minion_id})
+        if self.command_prefix is not None:
+            kwargs['bootstrap_salt_command_prefix'] = self.command_prefix
+        result = {'target_root': target_root, 'minion_id': minion_id, 'status': 'ok'}
+        started = time.perf_counter()
+        try:
+            TargetKickstartSalt(shared_script_path=script_path, force=self.force,
+                                **kwargs).run()
+        except SystemExit as err:
+            result.update(status='failed', error="exited with {0}".format(err.code))
+        except Exception as err:  # pylint: disable=W0703
+            result.update(status='failed', error=repr(err))
+        result['wall_seconds'] = round(time.perf_counter() - started, 6)
+        return result
+
+    def run(self):
+        '''Bootstraps every target; returns a summary of the whole run'''
+        started = time.perf_counter()
+        script_path, download = TargetKickstartSalt.fetch(self.kwargs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            targets = list(pool.map(lambda root: self.run_target(script_path, root),
+                                    self.target_roots))
+        return {
+            'download': download,
+            'targets': targets,
+            'failed': sum(1 for target in targets if target['status'] != 'ok'),
+            'max_workers': self.max_workers,
+            'wall_seconds': round(time.perf_counter() - started, 6)
+        }
@@ -22,7 +22,7 @@ VERSION = 1.0
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'requests', 'deep_merge', 'pyyaml'
+    'requests', 'pyyaml'
 ]
 
 # What packages are optional?
@@ -0,0 +1,37 @@
+# pylint: disable=C0111
+import hashlib
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root, next to kickstart_salt.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from kickstart_salt import KickstartSalt
+
+@pytest.fixture
+def script():
+    '''The bootstrap-salt.sh the kwargs fixture's mirror serves'''
+    return b"#!/bin/sh\necho bootstrapped\n"
+
+@pytest.fixture
+def kwargs(tmp_path, monkeypatch, script):
+    '''
+    KickstartSalt kwargs for a run which downloads script from a file://
+    mirror in tmp_path and keeps its state there, without touching DNS.
+    '''
+    monkeypatch.setattr(KickstartSalt, "set_dns_linux", staticmethod(lambda *a, **k: None))
+    mirror = tmp_path / "mirror.sh"
+    mirror.write_bytes(script)
+    return {
+        'dns_entries': ["nameserver 10.0.0.1"],
+        'bootstrap_salt_download_url': mirror.as_uri(),
+        'bootstrap_salt_save_path': str(tmp_path / "bootstrap-salt.sh"),
+        'bootstrap_salt_hash_type': "sha256",
+        'bootstrap_salt_expected_hash': hashlib.sha256(script).hexdigest(),
+        'bootstrap_salt_json_args': {},
+        'kickstart_salt_state_path': str(tmp_path / "state.json"),
+        'kickstart_salt_admission': {'download_retries': 0}
+    }
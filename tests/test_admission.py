@@ -0,0 +1,90 @@
+# pylint: disable=C0111
+import email.utils
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from kickstart_salt_download import BootstrapSaltDownloader
+from kickstart_salt_phases import AdmissionControl, TokenBucket
+from kickstart_salt_standin import MirrorStandInServer
+
+SCRIPT = b"#!/bin/sh\necho bootstrapped\n"
+
+@pytest.fixture
+def mirror():
+    started = []
+
+    def start(**kwargs):
+        standin = MirrorStandInServer({'bootstrap-salt.sh': SCRIPT}, **kwargs).start()
+        started.append(standin)
+        return standin
+    yield start
+    for standin in started:
+        standin.stop()
+
+@pytest.fixture(autouse=True)
+def own_buckets(monkeypatch):
+    monkeypatch.setattr(AdmissionControl, "buckets", {})
+
+def run_all(target, count):
+    threads = [threading.Thread(target=target, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not any(thread.is_alive() for thread in threads)
+
+def test_jitter_is_seeded_and_spread():
+    phases = {'download': {'jitter_seconds': 30}}
+    delays = [AdmissionControl(phases, seed="node-{0}".format(index)).jitter("download")
+              for index in range(100)]
+    assert all(0 <= delay <= 30 for delay in delays)
+    assert min(delays) < 5 and max(delays) > 25
+    assert AdmissionControl(phases, seed="node-1").jitter("download") == delays[1]
+    assert AdmissionControl(phases, seed="node-1").jitter("bootstrap") == 0.0
+
+def test_token_bucket_bursts_then_limits_rate():
+    bucket = TokenBucket(rate=10, burst=3)
+    waits = [bucket.reserve() for _ in range(5)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] == pytest.approx(0.1, abs=0.02)
+    assert waits[4] == pytest.approx(0.2, abs=0.02)
+
+def test_retry_delay_honours_retry_after():
+    for attempt in range(1, 4):
+        assert 2 <= BootstrapSaltDownloader.retry_delay({'Retry-After': "2"}, attempt) <= 3
+    assert BootstrapSaltDownloader.retry_delay({'Retry-After': "600"}, 1, max_retry_after=5) == 5
+    later = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= BootstrapSaltDownloader.retry_delay({'retry-after': later}, 1) <= 15
+    assert 0 <= BootstrapSaltDownloader.retry_delay({}, 2) <= 2
+
+def test_throttled_downloads_retry_after_the_mirror_says(mirror, tmp_path):
+    standin = mirror(max_rps=2, retry_after=1)
+    results = {}
+
+    def fetch(index):
+        results[index] = BootstrapSaltDownloader.fetch_mirror(
+            standin.url + "/bootstrap-salt.sh", str(tmp_path / "bootstrap-salt.sh"),
+            "sha256", retries=5, max_retry_after=3)
+    started = time.monotonic()
+    run_all(fetch, 6)
+    assert [result['status'] for result in results.values()] == ['ok'] * 6
+    assert standin.throttled
+    assert standin.load()['peak_served_per_second'] <= 2
+    # Six downloads at two a second need at least two more seconds.
+    assert time.monotonic() - started >= 2
+
+def test_admitted_fleet_stays_under_the_mirror_limit(mirror):
+    standin = mirror(max_rps=8)
+    admission = AdmissionControl({'download': {'rate': 5, 'burst': 2}})
+
+    def node(index):
+        admission.admit("download")
+        urllib.request.urlopen(standin.url + "/node-{0}/bootstrap-salt.sh".format(index),
+                               timeout=10).read()
+    run_all(node, 12)
+    assert standin.requests == 12
+    assert standin.throttled == 0
+    assert standin.load()['peak_arrivals_per_second'] <= 2 + 5
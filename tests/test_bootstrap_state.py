@@ -0,0 +1,98 @@
+# pylint: disable=C0111
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_async import AsyncKickstartSalt, AsyncPhaseScheduler
+from kickstart_salt_phases import PhaseScheduler
+
+@pytest.fixture
+def mismatched_kwargs(kwargs):
+    kwargs['bootstrap_salt_expected_hash'] = hashlib.sha256(b"something else").hexdigest()
+    return kwargs
+
+def recorded_phases(kwargs):
+    try:
+        with open(kwargs['kickstart_salt_state_path']) as state_file:
+            return set(json.load(state_file)['phases'])
+    except IOError:
+        return set()
+
+def test_hash_mismatch_fails_and_records_nothing(mismatched_kwargs):
+    with pytest.raises(SystemExit) as exc:
+        KickstartSalt(**mismatched_kwargs)
+    assert exc.value.code == 1
+    assert not recorded_phases(mismatched_kwargs) & {"download", "bootstrap"}
+
+def test_hash_mismatch_fails_and_records_nothing_async(mismatched_kwargs):
+    with pytest.raises(SystemExit) as exc:
+        asyncio.run(AsyncKickstartSalt(**mismatched_kwargs).run())
+    assert exc.value.code == 1
+    assert not recorded_phases(mismatched_kwargs) & {"download", "bootstrap"}
+
+def test_matching_script_is_recorded(kwargs):
+    KickstartSalt(**kwargs)
+    assert {"download", "bootstrap"} <= recorded_phases(kwargs)
+
+def run_sync(scheduler):
+    return scheduler.run()
+
+def run_async(scheduler):
+    return asyncio.run(scheduler.run())
+
+SCHEDULERS = [(PhaseScheduler, run_sync), (AsyncPhaseScheduler, run_async)]
+
+@pytest.mark.parametrize("scheduler_class,run", SCHEDULERS, ids=["threads", "asyncio"])
+def test_dependency_cycle_is_rejected(scheduler_class, run):
+    ran = []
+    scheduler = scheduler_class()
+    scheduler.add("dns", ran.append)
+    scheduler.add("yum", ran.append, depends_on=["dns", "bootstrap"])
+    scheduler.add("bootstrap", ran.append, depends_on=["yum"])
+    with pytest.raises(ValueError, match="cycle"):
+        run(scheduler)
+    # Nothing runs, not even the phase outside the cycle.
+    assert not ran
+
+@pytest.mark.parametrize("scheduler_class,run", SCHEDULERS, ids=["threads", "asyncio"])
+def test_unknown_dependency_is_rejected(scheduler_class, run):
+    ran = []
+    scheduler = scheduler_class()
+    scheduler.add("dns", ran.append)
+    scheduler.add("bootstrap", ran.append, depends_on=["download"])
+    with pytest.raises(ValueError, match="unknown phase download"):
+        run(scheduler)
+    assert not ran
+
+@pytest.mark.parametrize("scheduler_class,run", SCHEDULERS, ids=["threads", "asyncio"])
+def test_failure_skips_dependents(scheduler_class, run):
+    ran = []
+    started = threading.Event()
+
+    def fail(span):
+        # Let the independent phase get going first.
+        started.wait(5)
+        raise SystemExit(1)
+
+    def independent(span):
+        started.set()
+        time.sleep(0.2)
+        ran.append("metadata")
+
+    scheduler = scheduler_class()
+    scheduler.add("download", fail)
+    scheduler.add("metadata", independent)
+    scheduler.add("bootstrap", lambda span: ran.append("bootstrap"), depends_on=["download"])
+    scheduler.add("highstate", lambda span: ran.append("highstate"),
+                  depends_on=["bootstrap", "metadata"])
+    with pytest.raises(SystemExit):
+        run(scheduler)
+    # The phase already running finished; nothing depending on the failure started.
+    assert ran == ["metadata"]
+    statuses = {span['phase']: span['status'] for span in scheduler.report.spans}
+    assert statuses == {'download': 'failed', 'metadata': 'ok'}
@@ -0,0 +1,81 @@
+# pylint: disable=C0111
+import os
+import stat
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_bundle import BootstrapBundle
+from kickstart_salt_keys import MinionKeys
+
+CONFIG = {'kwargs': {}}
+
+@pytest.fixture
+def repo(tmp_path):
+    packages = tmp_path / "packages"
+    (packages / "repodata").mkdir(parents=True)
+    (packages / "repodata" / "repomd.xml").write_text("<repomd/>")
+    (packages / "salt-3006.rpm").write_bytes(b"rpm")
+    (tmp_path / "bootstrap-salt.sh").write_bytes(b"#!/bin/sh\n")
+    return packages
+
+def build(tmp_path, packages, **kwargs):
+    archive = str(tmp_path / "bundle.tar.gz")
+    BootstrapBundle.build(archive, CONFIG, str(tmp_path / "bootstrap-salt.sh"),
+                          packages_dir=str(packages), **kwargs)
+    return BootstrapBundle.open(archive, extract_dir=str(tmp_path / "extracted"))
+
+def bundle_repo(tmp_path, bundle):
+    '''The .repo file phase_bundle_repo writes for bundle, under tmp_path/root'''
+    instance = KickstartSalt.__new__(KickstartSalt)
+    instance.target_root = str(tmp_path / "root")
+    instance.bundle = bundle
+    instance.phase_bundle_repo({})
+    return (tmp_path / "root" / KickstartSalt.YUM_BUNDLE_REPO_PATH.lstrip('/')).read_text()
+
+def test_repo_keys_are_bundled_and_configured(tmp_path, repo):
+    (repo / "SALT-PROJECT-GPG-PUBKEY-2023.pub").write_text("salt key")
+    bundle = build(tmp_path, repo)
+    assert bundle.manifest['gpg_keys'] == ["repo/SALT-PROJECT-GPG-PUBKEY-2023.pub"]
+    [key] = bundle.gpg_key_paths()
+    with open(key) as key_file:
+        assert key_file.read() == "salt key"
+    assert "gpgcheck=1\ngpgkey=file://{0}\n".format(key) in bundle_repo(tmp_path, bundle)
+
+def test_keys_outside_the_repo_are_added(tmp_path, repo):
+    (tmp_path / "salt.pub").write_text("salt key")
+    (repo / "RPM-GPG-KEY-EPEL-8").write_text("epel key")
+    bundle = build(tmp_path, repo, gpg_keys=[str(tmp_path / "salt.pub")])
+    assert bundle.manifest['gpg_keys'] == ["repo/RPM-GPG-KEY-EPEL-8", "repo/salt.pub"]
+    assert "repo/salt.pub" in bundle.manifest['files']
+    assert "gpgkey=file://{0} file://{1}\n".format(*bundle.gpg_key_paths()) in \
+        bundle_repo(tmp_path, bundle)
+
+def test_repo_without_keys_is_refused(tmp_path, repo):
+    with pytest.raises(ValueError):
+        build(tmp_path, repo)
+
+@pytest.fixture
+def keys_dir(tmp_path):
+    keys = str(tmp_path / "minion_keys")
+    MinionKeys(keys).generate(["web-1", "web-2"])
+    return keys
+
+def test_only_public_keys_are_bundled(tmp_path, repo, keys_dir):
+    (repo / "RPM-GPG-KEY-salt").write_text("salt key")
+    bundle = build(tmp_path, repo, keys_dir=keys_dir)
+    assert sorted(name for name in bundle.manifest['files'] if name.startswith("keys/")) == [
+        "keys/web-1/minion.pub", "keys/web-2/minion.pub"]
+    assert MinionKeys.public_keys(bundle.keys_path()) == MinionKeys.public_keys(keys_dir)
+    assert MinionKeys.load(bundle.keys_path(), "web-1") is None
+
+def test_private_key_only_for_the_minions_asked_for(tmp_path, repo, keys_dir):
+    (repo / "RPM-GPG-KEY-salt").write_text("salt key")
+    bundle = build(tmp_path, repo, keys_dir=keys_dir, private_keys=["web-1"])
+    assert bundle.manifest['private_keys'] == ["web-1"]
+    assert MinionKeys.load(bundle.keys_path(), "web-1") == MinionKeys.load(keys_dir, "web-1")
+    assert MinionKeys.load(bundle.keys_path(), "web-2") is None
+    pem = os.path.join(bundle.keys_path(), "web-1", MinionKeys.PEM_NAME)
+    assert stat.S_IMODE(os.stat(pem).st_mode) == 0o600
+    with pytest.raises(ValueError):
+        build(tmp_path, repo, keys_dir=keys_dir, private_keys=["web-3"])
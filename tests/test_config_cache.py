@@ -0,0 +1,101 @@
+# pylint: disable=C0111
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from kickstart_salt import KickstartSaltGoogleComputeEngine
+from kickstart_salt_metadata import StaticMetadataProvider
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def trees(dns_entries=("10.0.0.1",)):
+    kickstart_salt_args = {
+        'bootstrap_salt_download_url': "https://example.com/bootstrap-salt.sh",
+        'bootstrap_salt_expected_hash': "0" * 64,
+        'bootstrap_salt_hash_type': "sha256",
+        'bootstrap_salt_json_args': {}
+    }
+    return {
+        'instance': {
+            'attributes': {
+                'dns': json.dumps({'entries': list(dns_entries)}),
+                'kickstart_salt_args': json.dumps(kickstart_salt_args)
+            }
+        },
+        'project': {'projectId': "example", 'attributes': {}}
+    }
+
+def resolve(config_path, metadata=None):
+    return KickstartSaltGoogleComputeEngine(
+        metadata_provider=StaticMetadataProvider(metadata or trees()),
+        config_path=config_path, dump_config=True).config
+
+@pytest.fixture
+def parses(monkeypatch):
+    '''Counts how often metadata is parsed into a configuration'''
+    calls = []
+    check = KickstartSaltGoogleComputeEngine.check_metadata_json
+
+    def counted(metadata):
+        calls.append(metadata)
+        return check(metadata)
+    monkeypatch.setattr(KickstartSaltGoogleComputeEngine, "check_metadata_json",
+                        staticmethod(counted))
+    return calls
+
+def test_cache_hit_skips_parsing(tmp_path, parses):
+    config_path = str(tmp_path / "config.json")
+    config = resolve(config_path)
+    assert len(parses) == 1
+    assert json.loads((tmp_path / "config.json").read_text()) == config
+    assert resolve(config_path) == config
+    assert len(parses) == 1
+
+def test_changed_metadata_invalidates_the_cache(tmp_path, parses):
+    config_path = str(tmp_path / "config.json")
+    resolve(config_path)
+    config = resolve(config_path, trees(dns_entries=["10.0.0.2"]))
+    assert len(parses) == 2
+    assert "nameserver 10.0.0.2" in config['dns_entries']
+    assert json.loads((tmp_path / "config.json").read_text()) == config
+
+def test_config_version_invalidates_the_cache(tmp_path, parses, monkeypatch):
+    config_path = str(tmp_path / "config.json")
+    resolve(config_path)
+    monkeypatch.setattr(KickstartSaltGoogleComputeEngine, "CONFIG_VERSION",
+                        KickstartSaltGoogleComputeEngine.CONFIG_VERSION + 1)
+    config = resolve(config_path)
+    assert len(parses) == 2
+    assert config['version'] == KickstartSaltGoogleComputeEngine.CONFIG_VERSION
+
+def test_unreadable_cache_is_resolved_again(tmp_path, parses):
+    (tmp_path / "config.json").write_text("{not json")
+    config = resolve(str(tmp_path / "config.json"))
+    assert len(parses) == 1
+    assert json.loads((tmp_path / "config.json").read_text()) == config
+
+def dump_config(tmp_path, *args):
+    metadata_path = tmp_path / "metadata.json"
+    metadata_path.write_text(json.dumps(trees()))
+    return subprocess.run([sys.executable, os.path.join(HERE, "kickstart_salt.py"),
+                           "--metadata-file", str(metadata_path), "--dump-config"] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True,
+                          cwd=str(tmp_path)).stdout.decode('utf-8')
+
+def test_config_path_option(tmp_path):
+    config_path = tmp_path / "cache" / "config.json"
+    dump_config(tmp_path, "--config-path", str(config_path))
+    assert json.loads(config_path.read_text())['kwargs']
+    assert "Using the configuration resolved in" in dump_config(
+        tmp_path, "--config-path", str(config_path))
+
+def test_no_config_cache_option(tmp_path):
+    config_path = tmp_path / "config.json"
+    config_path.write_text("stale")
+    output = dump_config(tmp_path, "--config-path", str(config_path), "--no-config-cache")
+    assert "Using the configuration resolved in" not in output
+    # Neither read nor written.
+    assert config_path.read_text() == "stale"
@@ -0,0 +1,133 @@
+# pylint: disable=C0111
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_async import AsyncBootstrapSaltDownloader
+from kickstart_salt_download import BootstrapSaltCache, BootstrapSaltDownloader
+from kickstart_salt_standin import MirrorStandInServer
+
+SCRIPT = os.urandom(200 * 1024)
+EXPECTED = hashlib.sha256(SCRIPT).hexdigest()
+
+@pytest.fixture
+def mirrors():
+    started = []
+
+    def start(**kwargs):
+        kwargs.setdefault('files', {'bootstrap-salt.sh': SCRIPT})
+        mirror = MirrorStandInServer(**kwargs).start()
+        started.append(mirror)
+        return mirror
+    yield start
+    for mirror in started:
+        mirror.stop()
+
+def url(mirror):
+    return mirror.url + "/bootstrap-salt.sh"
+
+def race(urls, save_path, timeout=30):
+    '''Runs race() in a thread, so a hang fails the test instead of the run'''
+    outcome = {}
+    thread = threading.Thread(target=lambda: outcome.update(winner=BootstrapSaltDownloader.race(
+        urls, str(save_path), "sha256", expected_hash=EXPECTED, retries=1, max_retry_after=1)))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "race() hung"
+    return outcome['winner']
+
+def leftovers(directory):
+    return [name for name in os.listdir(str(directory)) if name.endswith(".tmp")]
+
+def test_slow_mirror_loses(mirrors, tmp_path):
+    slow, fast = mirrors(latency=3), mirrors()
+    started = time.monotonic()
+    winner = race([url(slow), url(fast)], tmp_path / "bootstrap-salt.sh")
+    assert winner['url'] == url(fast)
+    assert time.monotonic() - started < 3
+    assert (tmp_path / "bootstrap-salt.sh").read_bytes() == SCRIPT
+
+@pytest.mark.parametrize("broken", [
+    {'error_rate': 1.0, 'error_status': 500},
+    {'files': {'bootstrap-salt.sh': b"#!/bin/sh\nexit 1\n"}},
+])
+def test_broken_mirror_is_skipped(mirrors, tmp_path, broken):
+    bad, good = mirrors(**broken), mirrors(latency=0.5)
+    winner = race([url(bad), url(good)], tmp_path / "bootstrap-salt.sh")
+    assert bad.requests
+    assert winner['url'] == url(good)
+    assert (tmp_path / "bootstrap-salt.sh").read_bytes() == SCRIPT
+    assert not leftovers(tmp_path)
+
+def test_dropped_transfer_is_resumed(mirrors, tmp_path):
+    mirror = mirrors(drop_after=64 * 1024)
+    winner = race([url(mirror)], tmp_path / "bootstrap-salt.sh")
+    assert winner['digest'] == EXPECTED
+    assert mirror.dropped == 1
+    # The resumed request only fetched what the first one didn't.
+    assert mirror.requests == 2
+    assert mirror.bytes_sent == len(SCRIPT)
+    assert (tmp_path / "bootstrap-salt.sh").read_bytes() == SCRIPT
+
+def test_worker_exception_does_not_hang(mirrors, tmp_path, monkeypatch):
+    good = mirrors()
+    fetch_mirror = BootstrapSaltDownloader.fetch_mirror
+
+    def flaky(mirror_url, *args, **kwargs):
+        if mirror_url != url(good):
+            raise RuntimeError("worker blew up")
+        return fetch_mirror(mirror_url, *args, **kwargs)
+    monkeypatch.setattr(BootstrapSaltDownloader, "fetch_mirror", staticmethod(flaky))
+
+    assert race(["http://127.0.0.1:1/bootstrap-salt.sh"], tmp_path / "bootstrap-salt.sh") is None
+    winner = race(["http://127.0.0.1:1/bootstrap-salt.sh", url(good)],
+                  tmp_path / "bootstrap-salt.sh")
+    assert winner['url'] == url(good)
+
+def async_race(*args, **kwargs):
+    return asyncio.run(AsyncBootstrapSaltDownloader.race(*args, **kwargs))
+
+@pytest.mark.parametrize("transport", [BootstrapSaltDownloader.race, async_race])
+def test_unchanged_script_comes_from_the_cache(mirrors, tmp_path, transport):
+    mirror = mirrors()
+    cache = BootstrapSaltCache(str(tmp_path / "cache"))
+
+    def download(name):
+        stats = {}
+        assert KickstartSalt.download_salt(url(mirror), str(tmp_path / name), cache=cache,
+                                           hash_type="sha256", stats=stats, race=transport)
+        assert (tmp_path / name).read_bytes() == SCRIPT
+        return stats
+    assert download("first.sh")['bytes_downloaded'] == len(SCRIPT)
+    # The validators the first download stored are sent with the second.
+    assert download("second.sh") == {'bytes_downloaded': 0, 'source': 'cache'}
+    assert mirror.not_modified == 1
+    assert mirror.bytes_sent == len(SCRIPT)
+
+@pytest.mark.parametrize("transport", [BootstrapSaltDownloader.race, async_race])
+def test_upper_case_expected_hash_matches(mirrors, tmp_path, transport):
+    winner = transport([url(mirrors())], str(tmp_path / "bootstrap-salt.sh"), "sha256",
+                       expected_hash=EXPECTED.upper())
+    assert winner['digest'] == EXPECTED
+    assert (tmp_path / "bootstrap-salt.sh").read_bytes() == SCRIPT
+
+def test_not_modified_without_a_cache_is_a_miss(mirrors, tmp_path, monkeypatch):
+    good = mirrors(latency=0.5)
+    fetch_mirror = BootstrapSaltDownloader.fetch_mirror
+
+    def not_modified(mirror_url, *args, **kwargs):
+        if mirror_url != url(good):
+            return {'url': mirror_url, 'status': 'not_modified', 'path': None}
+        return fetch_mirror(mirror_url, *args, **kwargs)
+    monkeypatch.setattr(BootstrapSaltDownloader, "fetch_mirror", staticmethod(not_modified))
+
+    assert race(["http://127.0.0.1:1/bootstrap-salt.sh"], tmp_path / "bootstrap-salt.sh") is None
+    winner = race(["http://127.0.0.1:1/bootstrap-salt.sh", url(good)],
+                  tmp_path / "bootstrap-salt.sh")
+    assert winner['url'] == url(good)
@@ -0,0 +1,19 @@
+# pylint: disable=C0111
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Needed only by phases and CLI branches a plain minion run doesn't take.
+NOT_FOR_MINIONS = ["argparse", "concurrent.futures", "http.server", "mmap", "shlex", "yaml",
+                   "requests", "pprint", "kickstart_salt_peer", "kickstart_salt_bundle",
+                   "kickstart_salt_keys", "kickstart_salt_merge", "kickstart_salt_standin",
+                   "kickstart_salt_targets", "kickstart_salt_async"]
+
+def test_importing_kickstart_salt_stays_lean():
+    code = "import json, sys; import kickstart_salt; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR)
+    loaded = set(json.loads(output.decode('utf-8')))
+    assert not loaded & set(NOT_FOR_MINIONS)
@@ -0,0 +1,37 @@
+# pylint: disable=C0111
+import json
+
+import pytest
+
+from kickstart_salt import KickstartSaltGoogleComputeEngine
+
+def diagnose(doc):
+    with pytest.raises(json.JSONDecodeError) as exc:
+        json.loads(doc)
+    return exc.value, KickstartSaltGoogleComputeEngine.json_diagnostic(exc.value).split('\n')
+
+def numbered(lines):
+    return [int(line.split('|')[0]) for line in lines[1:] if line.split('|')[0].strip()]
+
+@pytest.mark.parametrize("doc", [
+    '{\n"a": 1\n',
+    '{\n\n\n',
+    '\n\n\n{"a": [1,2,\n\n',
+])
+def test_error_at_end_of_document_is_shown(doc):
+    err, lines = diagnose(doc)
+    assert numbered(lines)[-1] == err.lineno
+    # The caret follows the error line.
+    error_line = lines.index("{0:>6} | ".format(err.lineno))
+    assert lines[error_line + 1] == "       | ^"
+
+def test_empty_lines_after_the_error_are_context():
+    err, lines = diagnose('{"a": 1,}\n\n\n\n')
+    assert err.lineno == 1
+    assert numbered(lines) == [1, 2, 3]
+
+def test_error_in_the_middle_has_context_both_sides():
+    err, lines = diagnose('{\n"a": x\n}\n')
+    assert numbered(lines) == [1, 2, 3]
+    assert lines[lines.index("     2 | \"a\": x") + 1] == "       |      ^"
+    assert err.colno == 6
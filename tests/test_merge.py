@@ -0,0 +1,81 @@
+# pylint: disable=C0111
+import copy
+
+from kickstart_salt_merge import JSONMerge
+
+ORG = {
+    'dns': {'entries': ["10.0.0.1"], 'search': ["example.internal"]},
+    'grains': {'roles': ["base"], 'env': "prod"},
+    'master': "salt.example.internal"
+}
+PROJECT = {
+    'dns': {'entries': ["10.1.0.1"]},
+    'grains': {'roles': ["web"]}
+}
+INSTANCE = {
+    'grains': {'env': "canary", 'roles': ["cache"], 'rack': 7}
+}
+
+def layers(*names):
+    values = {'org': ORG, 'project': PROJECT, 'instance': INSTANCE}
+    return [(name, values.get(name)) for name in names]
+
+def test_later_layers_take_precedence():
+    result = JSONMerge().merge(layers('org', 'project', 'instance'))
+    assert result.value == {
+        'dns': {'entries': ["10.1.0.1"], 'search': ["example.internal"]},
+        'grains': {'roles': ["cache"], 'env': "canary", 'rack': 7},
+        'master': "salt.example.internal"
+    }
+
+def test_sources_record_where_each_value_came_from():
+    result = JSONMerge().merge(layers('org', 'project', 'instance'))
+    assert result.sources() == [
+        [[], 'org'],
+        [['dns'], 'org'],
+        [['dns', 'entries'], 'project'],
+        [['grains'], 'org'],
+        [['grains', 'env'], 'instance'],
+        [['grains', 'rack'], 'instance'],
+        [['grains', 'roles'], 'instance']
+    ]
+    assert result.source(['master']) == 'org'
+    assert result.source(['dns', 'search', 0]) == 'org'
+    assert result.source(['grains', 'rack']) == 'instance'
+
+def test_append_paths_extend_lists():
+    result = JSONMerge(append_paths=[['grains', 'roles']]).merge(
+        layers('org', 'project', 'instance'))
+    assert result.value['grains']['roles'] == ["base", "web", "cache"]
+    assert result.source(['grains', 'roles']) == ['org', 'project', 'instance']
+    # Lists which aren't on an append path are still replaced.
+    assert result.value['dns']['entries'] == ["10.1.0.1"]
+
+def test_type_change_replaces():
+    result = JSONMerge(append_paths=[['grains', 'roles']]).merge(
+        [('org', ORG), ('instance', {'grains': {'roles': "all"}, 'dns': None})])
+    assert result.value['grains']['roles'] == "all"
+    assert result.value['dns'] is None
+    assert result.source(['grains', 'roles']) == 'instance'
+
+def test_missing_layers_are_left_out():
+    result = JSONMerge().merge(layers('org', 'project', 'zone', 'instance'))
+    assert result.value == JSONMerge().merge(layers('org', 'project', 'instance')).value
+    assert 'zone' not in str(result.sources())
+    # The first present layer is the base.
+    assert JSONMerge().merge(layers('zone', 'instance')).sources() == [[[], 'instance']]
+    empty = JSONMerge().merge(layers('zone', 'region'))
+    assert empty.value is None
+    assert empty.sources() == []
+    assert empty.source(['grains']) is None
+
+def test_layers_are_not_modified():
+    before = copy.deepcopy([ORG, PROJECT, INSTANCE])
+    merger = JSONMerge(append_paths=[['grains', 'roles'], ['dns', 'entries']])
+    result = merger.merge(layers('org', 'project', 'instance'))
+    assert [ORG, PROJECT, INSTANCE] == before
+    assert result.value['dns']['entries'] == ["10.0.0.1", "10.1.0.1"]
+    # Merging again gives the same answer, so nothing leaked between runs.
+    assert merger.merge(layers('org', 'project', 'instance')).value == result.value
+    # Only what changed was copied; untouched values are shared.
+    assert result.value['dns']['search'] is ORG['dns']['search']
@@ -0,0 +1,112 @@
+# pylint: disable=C0111
+import json
+import time
+
+import pytest
+
+from kickstart_salt import GCEMetadataWrapper
+from kickstart_salt_metadata import (JSONFileMetadataProvider, MetadataProvider,
+                                     StaticMetadataProvider)
+from kickstart_salt_standin import MetadataStandInServer
+
+TREES = {
+    'instance': {
+        'hostname': "node-1.c.example.internal",
+        'networkInterfaces': [{'ip': "10.0.0.5"}],
+        'preempted': False,
+        'attributes': {
+            'dns': '{"entries": ["10.0.0.1"]}',
+            'shared': "instance",
+            'camelCaseKey': "kept as is"
+        }
+    },
+    'project': {
+        'projectId': "example",
+        'numericProjectId': 1234,
+        'attributes': {
+            'shared': "project",
+            'project-only': "project"
+        }
+    }
+}
+
+@pytest.fixture(params=[False, True], ids=["requests", "minimal"])
+def standin(request):
+    server = MetadataStandInServer(TREES).start()
+    server.minimal = request.param
+    yield server
+    server.stop()
+
+def wrapper(standin, snapshot):
+    return GCEMetadataWrapper(metadata_url=standin.url, snapshot=snapshot,
+                              minimal=standin.minimal, retries=0)
+
+@pytest.mark.parametrize("snapshot", [False, True], ids=["per-key", "snapshot"])
+def test_lookups(standin, snapshot):
+    metadata = wrapper(standin, snapshot)
+    # camelCase names in the recursive json are served under their path names.
+    assert metadata.get_project_metadata_value("project-id") == "example"
+    assert metadata.get_project_metadata_value("numeric-project-id") == "1234"
+    assert metadata.get_instance_metadata_value("network-interfaces/0/ip") == "10.0.0.5"
+    assert metadata.get_instance_metadata_value("preempted") == "FALSE"
+    # User-defined attribute names are left alone.
+    assert metadata.get_instance_metadata_value("attributes/camelCaseKey") == "kept as is"
+    assert metadata.get_instance_metadata_value("attributes/dns") == '{"entries": ["10.0.0.1"]}'
+    assert metadata.get_instance_metadata_value("attributes/missing") is None
+
+@pytest.mark.parametrize("snapshot", [False, True], ids=["per-key", "snapshot"])
+def test_any_metadata_value_precedence(standin, snapshot):
+    metadata = wrapper(standin, snapshot)
+    assert metadata.get_any_metadata_value("attributes/shared") == "instance"
+    assert metadata.get_any_metadata_value("attributes/project-only") == "project"
+    assert metadata.get_any_metadata_value("attributes/missing") is None
+    assert metadata.get_any_metadata_value("attributes/missing", default="x") == "x"
+
+def test_snapshot_makes_two_requests(standin):
+    metadata = wrapper(standin, snapshot=True)
+    for _ in range(3):
+        metadata.get_project_metadata_value("project-id")
+        metadata.get_any_metadata_value("attributes/shared")
+        metadata.get_many(["instance/hostname", "instance/attributes/dns",
+                           "project/attributes/missing"])
+    assert standin.requests == 2
+
+def test_per_key_requests_are_cached(standin):
+    metadata = wrapper(standin, snapshot=False)
+    metadata.get_any_metadata_value("attributes/shared")
+    metadata.get_any_metadata_value("attributes/shared")
+    metadata.get_project_metadata_value("project-id")
+    assert standin.requests == 3
+
+def test_snapshot_retries_errors(standin):
+    standin.error_rate = 1.0
+    metadata = GCEMetadataWrapper(metadata_url=standin.url, snapshot=True,
+                                  minimal=standin.minimal, retries=2, backoff_factor=0)
+    # Every request fails, so the trees are missing rather than wrong.
+    assert metadata.get_project_metadata_value("project-id") is None
+    assert standin.errors == 2 * 3
+
+def test_providers_must_implement_wait_for_change():
+    class GetOnly(MetadataProvider):
+        def get_many(self, keys):
+            return dict.fromkeys(keys)
+    with pytest.raises(TypeError):
+        GetOnly()
+
+@pytest.fixture(params=["static", "file"])
+def provider(request, tmp_path):
+    if request.param == "static":
+        return StaticMetadataProvider(TREES)
+    path = tmp_path / "metadata.json"
+    path.write_text(json.dumps(TREES))
+    return JSONFileMetadataProvider(str(path))
+
+def test_wait_for_change(provider):
+    key = "instance/attributes/?recursive=true&alt=json"
+    value, etag = provider.wait_for_change(key, timeout_sec=5)
+    assert json.loads(value) == TREES['instance']['attributes']
+    started = time.monotonic()
+    # Nothing changes, so an up to date caller waits out the timeout.
+    assert provider.wait_for_change(key, last_etag=etag, timeout_sec=0.2) == (value, etag)
+    assert time.monotonic() - started >= 0.2
+    assert provider.wait_for_change("instance/attributes/shared", timeout_sec=5)[0] == "instance"
@@ -0,0 +1,98 @@
+# pylint: disable=C0111
+import hashlib
+import os
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_peer import Peers, PeerServer
+
+SCRIPT = b"#!/bin/sh\necho bootstrapped\n"
+EXPECTED = hashlib.sha256(SCRIPT).hexdigest()
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A node serving its files to peers until its stdin is closed.
+SERVE = '''
+import sys
+from kickstart_salt_peer import PeerServer
+server = PeerServer(files=[sys.argv[1]], packages_dir=sys.argv[2] or None,
+                    host="127.0.0.1", port=0).start()
+print(server.server.server_address[1], flush=True)
+sys.stdin.read()
+'''
+
+@pytest.fixture
+def peer_process():
+    '''Starts PeerServers in their own processes; returns their "host:port"'''
+    processes = []
+
+    def start(path, packages_dir=None):
+        process = subprocess.Popen([sys.executable, "-c", SERVE, str(path),
+                                    str(packages_dir or "")],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   cwd=REPO_DIR, env=dict(os.environ, PYTHONPATH=REPO_DIR))
+        processes.append(process)
+        return "127.0.0.1:{0}".format(int(process.stdout.readline()))
+    yield start
+    for process in processes:
+        process.stdin.close()
+        process.wait(10)
+
+def fetch(peers, save_path):
+    return Peers(peers, fanout=len(peers), timeout=5).fetch(str(save_path), "sha256", EXPECTED)
+
+def test_fetch_chains_across_processes(peer_process, tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    first = peer_process(tmp_path / "a.sh")
+    assert fetch([first], tmp_path / "b.sh") == str(tmp_path / "b.sh")
+    # The node which fetched it serves it on to the next one.
+    second = peer_process(tmp_path / "b.sh")
+    (tmp_path / "a.sh").unlink()
+    assert fetch([first, second], tmp_path / "c.sh") == str(tmp_path / "c.sh")
+    assert (tmp_path / "c.sh").read_bytes() == SCRIPT
+
+def test_tampered_or_unreachable_peer_is_not_used(peer_process, tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT + b"rm -rf /\n")
+    tampered = peer_process(tmp_path / "a.sh")
+    assert fetch([tampered, "127.0.0.1:1"], tmp_path / "b.sh") is None
+    assert not (tmp_path / "b.sh").exists()
+
+def test_packages_are_served_read_only(peer_process, tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    packages = tmp_path / "packages"
+    packages.mkdir()
+    (packages / "salt.rpm").write_bytes(b"rpm")
+    url = "http://{0}{1}packages/".format(peer_process(tmp_path / "a.sh", packages),
+                                          PeerServer.ROOT)
+    assert urllib.request.urlopen(url + "salt.rpm", timeout=5).read() == b"rpm"
+    for name in ["..%2Fa.sh", "missing.rpm"]:
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(url + name, timeout=5)
+        assert exc.value.code == 404
+
+def test_bootstrap_prefers_peer_over_mirror(peer_process, tmp_path, monkeypatch):
+    monkeypatch.setattr(KickstartSalt, "set_dns_linux", staticmethod(lambda *a, **k: None))
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    KickstartSalt(
+        dns_entries=["nameserver 10.0.0.1"],
+        # Nothing is served here: the script can only come from the peer.
+        bootstrap_salt_download_url=(tmp_path / "no-mirror.sh").as_uri(),
+        bootstrap_salt_save_path=str(tmp_path / "bootstrap-salt.sh"),
+        bootstrap_salt_hash_type="sha256",
+        bootstrap_salt_expected_hash=EXPECTED,
+        bootstrap_salt_json_args={},
+        kickstart_salt_state_path=str(tmp_path / "state.json"),
+        kickstart_salt_admission={'download_retries': 0},
+        kickstart_salt_peer={'peers': [peer_process(tmp_path / "a.sh")]}
+    )
+    assert (tmp_path / "bootstrap-salt.sh").read_bytes() == SCRIPT
+
+def test_upper_case_expected_hash_finds_the_peer_copy(peer_process, tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    peers = [peer_process(tmp_path / "a.sh")]
+    assert Peers(peers, timeout=5).fetch(str(tmp_path / "b.sh"), "sha256",
+                                         EXPECTED.upper()) == str(tmp_path / "b.sh")
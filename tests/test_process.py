@@ -0,0 +1,104 @@
+# pylint: disable=C0111
+import asyncio
+import os
+import re
+import signal
+import sys
+import time
+
+import pytest
+
+from kickstart_salt_async import AsyncLiveProcess, AsyncPhaseScheduler
+from kickstart_salt_phases import BootstrapReport, PhaseScheduler
+from kickstart_salt_process import LiveProcess, RotatingLog
+
+# Half a second of CPU, and a second of none.
+BUSY = [sys.executable, "-c",
+        "import time\nend = time.process_time() + 0.5\nwhile time.process_time() < end: pass"]
+IDLE = [sys.executable, "-c", "import time; time.sleep(1)"]
+
+def spans(report):
+    return {span['phase']: span for span in report.spans}
+
+def test_cpu_time_goes_to_the_phase_which_ran_the_process():
+    report = BootstrapReport()
+    scheduler = PhaseScheduler(report=report)
+    scheduler.add("busy", lambda span: LiveProcess(BUSY).run())
+    scheduler.add("idle", lambda span: LiveProcess(IDLE).run())
+    scheduler.run()
+    phases = spans(report)
+    assert phases['busy']['subprocess_cpu_seconds'] >= 0.4
+    # Though busy's process finished while idle was running.
+    assert phases['idle']['subprocess_cpu_seconds'] < 0.2
+
+def test_cpu_time_goes_to_the_phase_which_ran_the_process_async():
+    report = BootstrapReport()
+    scheduler = AsyncPhaseScheduler(report=report)
+
+    async def busy(span):
+        return await AsyncLiveProcess(BUSY).run()
+    scheduler.add("busy", busy)
+    # A plain phase, run in the loop's thread pool.
+    scheduler.add("idle", lambda span: LiveProcess(IDLE).run())
+    asyncio.run(scheduler.run())
+    phases = spans(report)
+    assert phases['busy']['subprocess_cpu_seconds'] >= 0.4
+    assert phases['idle']['subprocess_cpu_seconds'] < 0.2
+
+def test_process_outside_a_phase_is_not_counted():
+    process = LiveProcess(BUSY)
+    assert process.run() == 0
+    assert process.cpu_seconds() >= 0.4
+
+def alive(pid):
+    '''True if pid is running (zombies waiting for init to reap them don't count)'''
+    try:
+        with open("/proc/{0}/stat".format(pid)) as stat:
+            return stat.read().rpartition(')')[2].split()[0] != 'Z'
+    except IOError:
+        return False
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_timeout_kills_the_process_group(tmp_path):
+    pid_path = tmp_path / "grandchild.pid"
+    process = LiveProcess(["sh", "-c", 'sleep 30 & echo $! > "$0"; wait', str(pid_path)],
+                          timeout=0.5)
+    started = time.monotonic()
+    assert process.run() == -signal.SIGTERM
+    assert process.timed_out
+    assert time.monotonic() - started < 5
+    grandchild = int(pid_path.read_text())
+    deadline = time.monotonic() + 5
+    while alive(grandchild) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not alive(grandchild)
+
+def test_log_rotates_at_the_size_limit(tmp_path):
+    log_path = str(tmp_path / "bootstrap.log")
+    # Each 6 byte line is its own read, and two don't fit under 8 bytes.
+    assert LiveProcess(["sh", "-c", "for i in 1 2 3 4; do echo line$i; sleep 0.1; done"],
+                       log_path=log_path, log_max_bytes=8, log_backups=2).run() == 0
+    assert (tmp_path / "bootstrap.log").read_bytes() == b"line4\n"
+    assert (tmp_path / "bootstrap.log.1").read_bytes() == b"line3\n"
+    assert (tmp_path / "bootstrap.log.2").read_bytes() == b"line2\n"
+    assert not (tmp_path / "bootstrap.log.3").exists()
+
+def test_log_without_backups_starts_over(tmp_path):
+    log = RotatingLog(str(tmp_path / "bootstrap.log"), max_bytes=8, backups=0)
+    for line in (b"line1\n", b"line2\n"):
+        log.write(line)
+    log.close()
+    assert (tmp_path / "bootstrap.log").read_bytes() == b"line2\n"
+    assert os.listdir(str(tmp_path)) == ["bootstrap.log"]
+
+def test_timestamps_prefix_every_line(tmp_path, capsys):
+    log_path = tmp_path / "bootstrap.log"
+    # "two" arrives without its newline, and is continued by the next read.
+    assert LiveProcess(["sh", "-c", r'printf "one\ntwo"; sleep 0.1; printf " more\nthree\n"'],
+                       log_path=str(log_path), timestamps=True).run() == 0
+    stamp = r"\[\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\] "
+    lines = log_path.read_text().splitlines()
+    assert len(lines) == 3
+    for line, text in zip(lines, ["one", "two more", "three"]):
+        assert re.match(stamp + re.escape(text) + "$", line), line
+    assert capsys.readouterr().out == log_path.read_text()
@@ -0,0 +1,39 @@
+# pylint: disable=C0111
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_targets import MultiTargetRunner
+
+# Runs on the host in these tests; records its arguments in the target.
+SCRIPT = b'#!/bin/sh\necho "$@" > "$ARGS_PATH"\n'
+
+@pytest.fixture
+def script():
+    return SCRIPT
+
+@pytest.fixture
+def kwargs(kwargs):
+    kwargs['bootstrap_salt_json_args'] = {'-i': "ci"}
+    return kwargs
+
+def test_target_root_requires_command_prefix(kwargs, tmp_path):
+    with pytest.raises(ValueError):
+        KickstartSalt(kickstart_salt_target_root=str(tmp_path / "1"), **kwargs)
+    with pytest.raises(ValueError):
+        MultiTargetRunner(kwargs, [str(tmp_path / "1")])
+
+def test_minion_ids_must_differ(kwargs):
+    with pytest.raises(ValueError):
+        MultiTargetRunner(kwargs, ["/srv/1", "/srv/2"], command_prefix=["env"],
+                          minion_id_template="{minion_id}")
+
+def test_each_target_gets_its_own_minion_id(kwargs, tmp_path):
+    roots = [str(tmp_path / "1"), str(tmp_path / "2")]
+    summary = MultiTargetRunner(kwargs, roots,
+                                command_prefix=["env", "ARGS_PATH={target_root}/args"]).run()
+    assert summary['failed'] == 0
+    assert [target['minion_id'] for target in summary['targets']] == ["ci-1", "ci-2"]
+    for root, minion_id in zip(roots, ["ci-1", "ci-2"]):
+        with open(root + "/args") as args_file:
+            assert args_file.read().split() == ["-i", minion_id]
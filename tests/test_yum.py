@@ -0,0 +1,99 @@
+# pylint: disable=C0111
+import stat
+
+import pytest
+
+from kickstart_salt import KickstartSalt
+
+QUERY = '''#!/bin/sh
+echo "$@" >> "{log}"
+status=0
+for package in "$@"; do
+    case " {installed} " in
+        *" $package "*) echo "$package-1.0-1.el8.x86_64" ;;
+        *) echo "package $package is not installed"; status=1 ;;
+    esac
+done
+exit $status
+'''
+
+@pytest.fixture
+def query(tmp_path):
+    '''A stand-in for rpm -q which knows of the installed packages given'''
+    def make(*installed):
+        path = tmp_path / "rpm-q"
+        path.write_text(QUERY.format(log=tmp_path / "queries", installed=' '.join(installed)))
+        path.chmod(path.stat().st_mode | stat.S_IXUSR)
+        return [str(path)]
+    return make
+
+def queries(tmp_path):
+    with open(str(tmp_path / "queries")) as log:
+        return log.read().splitlines()
+
+def kickstart(monkeypatch, query_command, **attributes):
+    '''A KickstartSalt with just the attributes the yum methods use, not run'''
+    monkeypatch.setattr(KickstartSalt, "PACKAGE_QUERY_COMMAND", query_command)
+    monkeypatch.setattr(KickstartSalt, "PACKAGE_INSTALL_COMMAND", ["yum", "install"])
+    instance = KickstartSalt.__new__(KickstartSalt)
+    instance.target_root = None
+    instance.salt_master_yum_repo_dir = None
+    instance.salt_master_yum_cache_dir = None
+    instance.bundle = None
+    instance.__dict__.update(attributes)
+    return instance
+
+def test_only_missing_packages_in_one_query(query, tmp_path):
+    missing = KickstartSalt.missing_packages(["git", "python3", "vim"],
+                                             query_command=query("python3"))
+    assert missing == ["git", "vim"]
+    assert queries(tmp_path) == ["git python3 vim"]
+
+def test_nothing_to_install(query, tmp_path, monkeypatch):
+    instance = kickstart(monkeypatch, query("git", "vim"))
+    assert instance.yum_install_command(["git", "vim"]) is None
+    assert len(queries(tmp_path)) == 1
+
+def test_query_which_cannot_run_installs_everything(tmp_path):
+    missing = KickstartSalt.missing_packages(["git", "vim"],
+                                             query_command=[str(tmp_path / "no-such-rpm")])
+    assert missing == ["git", "vim"]
+
+def test_install_command_is_offline_with_repo_and_cache(query, tmp_path, monkeypatch):
+    repo_dir, cache_dir, root = tmp_path / "repo", tmp_path / "cache", tmp_path / "root"
+    repo_dir.mkdir()
+    (repo_dir / "RPM-GPG-KEY-salt").write_text("key")
+    instance = kickstart(monkeypatch, query("git"), target_root=str(root),
+                         salt_master_yum_repo_dir=str(repo_dir),
+                         salt_master_yum_cache_dir=str(cache_dir))
+    command = instance.yum_install_command(["git", "vim"])
+    assert command == ["yum", "install",
+                       "--installroot={0}".format(root),
+                       "--disablerepo=*", "--enablerepo=kickstart_salt_local",
+                       "--setopt=cachedir={0}".format(cache_dir), "--setopt=keepcache=1",
+                       "vim", "-y"]
+    # The target's rpm database is queried; building the command writes nothing.
+    assert queries(tmp_path) == ["--root {0} git vim".format(root)]
+    assert not root.exists()
+
+def test_yum_phase_writes_the_local_repo_first(query, tmp_path, monkeypatch):
+    repo_dir, root = tmp_path / "repo", tmp_path / "root"
+    repo_dir.mkdir()
+    (repo_dir / "RPM-GPG-KEY-salt").write_text("key")
+    repo_file = root / KickstartSalt.YUM_LOCAL_REPO_PATH.lstrip('/')
+    instance = kickstart(monkeypatch, query("git"), target_root=str(root),
+                         salt_master_yum_repo_dir=str(repo_dir),
+                         salt_master_prerequisite_yum_packages=["git", "vim"])
+    installed = []
+
+    def install(packages=None):
+        # The repo the command enables is already in the target.
+        assert repo_file.exists()
+        installed.append(packages)
+    monkeypatch.setattr(instance, "install_yum_packages", install)
+    instance.phase_yum({})
+    assert installed == [["git", "vim"]]
+    repo = repo_file.read_text()
+    assert "[kickstart_salt_local]\n" in repo
+    assert "baseurl=file://{0}\n".format(repo_dir) in repo
+    assert "gpgcheck=1\ngpgkey=file://{0}/RPM-GPG-KEY-salt\n".format(repo_dir) in repo